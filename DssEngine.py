@@ -1,22 +1,62 @@
 from dbconnector import DBConnector
+from sqlite_connector import SQLiteDBConnector
+from state_timelines import StateTimelineStore, fingerprint_patient_logs, replace_fingerprint_logs
+from metrics import METRICS, instrument_public_methods
 from build_ontology import *
 from datetime import datetime , timedelta
 import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 
+# The states inferred for every patient
+STATE_NAMES = ['Hemoglobin State', 'Hematological State', 'Systemic Toxicity', 'Treatment']
+
+@instrument_public_methods
 class DSSEngine:
-    def __init__(self , db_folder = '.' , ontology_folder = '.'):
+    def __init__(self , db_folder = '.' , ontology_folder = '.', storage = 'csv', inference_mode = 'records'):
         """
         Initializes a new DSS engine instance, capable of connecting to a db and knowledge base.
-
+        :param storage: str, storage backend of the db - 'csv', 'arrow' or 'sqlite'
+        :param inference_mode: str, 'records' runs the state rules on lightweight patient records,
+                               'ontology' creates (and destroys) patient individuals in the ontology for every inference
         """
-        self.db_con = DBConnector(db_folder)
-        self.ontology = get_ontology(os.path.join(ontology_folder,"cdss.owl")).load()
+        if inference_mode not in ('records', 'ontology'):
+            raise ValueError(f'Unknown inference mode {inference_mode}')
+        self.inference_mode = inference_mode
+        self.db_folder, self.ontology_folder, self.storage = db_folder, ontology_folder, storage
+        self._ontology = None
+        if storage == 'sqlite':
+            self.db_con = SQLiteDBConnector(db_folder)
+        else:
+            self.db_con = DBConnector(db_folder, storage = storage)
+        self.timeline_store = StateTimelineStore(os.path.join(db_folder, 'state_timelines'))
 
         # NOY : I've Decided that the Engine should only handle the names of patients and tests, no codes or IDS.
         self.patient_list = self.db_con.get_patients_names()
         self.test_list = self.db_con.get_test_names()
 
 
+    @property
+    def ontology(self):
+        """
+        The ontology of the knowledge base, loaded from the ontology folder on its first use
+        """
+        if self._ontology is None:
+            self._ontology = load_ontology(self.ontology_folder)
+        return self._ontology
+
+    def reload_data_source(self, file_name):
+        """
+        Reloads a single data source of the db from its file, if it changed since it was loaded
+        :param file_name: str, csv file name of the data source - 'patient_data.csv', 'patients.csv' or 'loinc_data.csv'
+        :return: True if the data source was reloaded
+        """
+        reloaded = self.db_con.reload_data_source(file_name)
+        if reloaded:
+            self.patient_list = self.db_con.get_patients_names()
+            self.test_list = self.db_con.get_test_names()
+        return reloaded
+
     def retrival_query(self ,target , patient , date , pov_date, hour = None , pov_hour = None ):
         """
         recieves parameters for a query to be retrived from the db
@@ -53,6 +93,7 @@ class DSSEngine:
          :param prev_date: str, the earliest date to retrieve records from
          :param prev_hour: str, hour corresponding to the earliest date
          :return: retrieves all records documented for patient - INCLUDING DELETED RECORDS!
+                  Records set aside for an invalid value are in the quarantine file, and are not retrieved
          """
 
         ## date should be formatted  -  %d.%m.%Y
@@ -69,6 +110,31 @@ class DSSEngine:
                                                  prev_date= prev_date,
                                                  prev_hour = prev_hour,
                                                  historic =True )
+    def insert_query(self, measurements):
+        """
+        Inserts a batch of new measurements to the db, all with the current transaction time.
+        :param measurements: DataFrame or iterable of dictionaries with 'Patient ID' (name or id), 'Test Name'
+                             (test name or loinc num), 'Value' and 'Valid Start Time', and optionally 'Units' and
+                             'Valid End Time'
+        :return: inserted rows, or a string describing why the batch was rejected
+        """
+        try:
+            return self.db_con.insert_patients_data(measurements)
+        except ValueError as e:
+            return f'No measurements were inserted: {e}'
+
+    def correction_query(self, corrections):
+        """
+        Applies a batch of updates and deletions of existing measurements, atomically - a batch holding an invalid
+        correction is not applied at all.
+        :param corrections: DataFrame or iterable of dictionaries with 'Patient ID' (name or id), 'Test Name' (test
+                            name or loinc num), 'Measurement Time' and 'Action' ('update' or 'delete'), and for
+                            updates 'Value' and optionally 'Update Time'
+        :return: report DataFrame with the 'Status' of every correction - 'applied', 'no matching measurement',
+                 'batch rejected' or the reason it is invalid
+        """
+        return self.db_con.correct_patients_data(corrections)
+
     def update_query(self, patient, target, measure_date, measure_time , update_date , update_time , updated_value):
         """
         Updates an existing value in the db, creates a *new* row with the new value updated in the specific transaction time.
@@ -79,8 +145,14 @@ class DSSEngine:
         :param update_date: str formatted 'DD.MM.YYYY', update date of the measurement
         :param update_time: str formatted 'HH:MM' , update time of the measurement
         :param updated_value: any , new value to be inserted
-        :return: updated rows, or a string indicating no measurment exists for corresponding date
+        :return: updated rows, or a string indicating no measurment exists for corresponding date or the value is invalid
         """
+        # Values that do not match the type of the test are rejected before looking for the measurement
+        try:
+            self.db_con.validate_test_values(pd.Series([self.db_con.standartisize_target_key(target)]),
+                                             pd.Series([updated_value]))
+        except ValueError:
+            return f'Invalid value {updated_value!r} for test {target}'
 
         try:
             changed_row = self.db_con.update_patient_data(patient_name = patient,
@@ -95,6 +167,7 @@ class DSSEngine:
             return f'No entries found for {patient} and test {target} for the specified date'
 
         else:
+            self.update_state_timeline(changed_row, mode = 'update')
             return changed_row
 
     def delete_query(self, patient, target, measure_date, measure_time ,):
@@ -120,6 +193,7 @@ class DSSEngine:
             return f'No entries found for {patient} and test {target} for the specified date'
 
         else:
+            self.update_state_timeline(changed_row, mode = 'delete')
             return changed_row
 
     def retrieve_relevant_tests_for_patient(self, patient, req_date, req_hour, use_pov = True):
@@ -165,33 +239,62 @@ class DSSEngine:
             pid = self.db_con.standartisize_patient(single_patient_id)
             patients_dict[pid] = self.db_con.get_patients_dict()[pid]
 
+        if single_patient_id is None: # If not a single patient is specified, retrieve the tests of the whole ward at once
+            with METRICS.time_phase('data_retrieval'):
+                ward_tests_logs = self.db_con.get_valid_tests_snapshot(req_date, req_hour, use_pov = False)
+                ward_test_scores = {}
+                for pid, test_name, value in zip(ward_tests_logs['Patient ID'], ward_tests_logs['Test Name'],
+                                                 self.db_con.get_test_values(ward_tests_logs)):
+                    ward_test_scores.setdefault(pid, {})[test_name] = value
+
         # Retrieve patients states for all the required patients
         for pid , p_dict in patients_dict.items():
-            cur_patient = self.ontology.Patient(f"Patient_{pid}")
-            cur_patient.gender = [p_dict['Gender']]
-
             # Retrieve the tests for the patient
-            if single_patient_id is None: # If not a single patient is specified, we filter the db using date and time
-                most_recent_tests_logs = self.retrieve_relevant_tests_for_patient(pid ,req_date, req_hour, use_pov = False)
+            if single_patient_id is None:
+                patients_test_scores = ward_test_scores.get(pid, {})
             else: # If we check for a single patient - retrieve future relevant test results as well
-                most_recent_tests_logs = self.retrieve_relevant_tests_for_patient(pid, req_date, req_hour, use_pov=False)
-            patients_test_scores = {}
+                with METRICS.time_phase('data_retrieval'):
+                    most_recent_tests_logs = self.retrieve_relevant_tests_for_patient(pid, req_date, req_hour, use_pov=False)
+                    patients_test_scores = dict(zip(most_recent_tests_logs['Test Name'],
+                                                    self.db_con.get_test_values(most_recent_tests_logs)))
 
+            res_dict[pid] = self.infer_patient_states(pid, p_dict, patients_test_scores)
 
-            for i,row in most_recent_tests_logs.iterrows():
-                patients_test_scores[row['Test Name']] = row['Value']
+        return res_dict
+
+    def infer_patient_states(self, pid, p_dict, patients_test_scores):
+        """
+        Runs the state rules of the knowledge base on a single patient
+        :param pid: str, patient id
+        :param p_dict: dictionary of the patient personal data (name, age and gender)
+        :param patients_test_scores: dictionary in the form of {loinc num : test value}, with the values typed by
+                                     get_test_values of the db connector - floats for the numeric tests
+        :return: dictionary with the patient personal data and its states
+        """
+        laps = METRICS.phase_laps()  # None when metrics are disabled
+        # A missing level (NaN) is not a measurement - the rules see the test as not measured
+        patients_test_scores = {test_name: value for test_name, value in patients_test_scores.items() if value == value}
+        ontology = self.ontology
+        if self.inference_mode == 'ontology':
+            cur_patient = ontology.Patient(f"Patient_{pid}")
+            symptom = ontology.Symptom(f"Symptom_{pid}")
+        else:  # Plain records, the ontology only supplies the states
+            cur_patient = PatientRecord()
+            symptom = SymptomRecord()
+
+        try:
+            cur_patient.gender = [p_dict['Gender']]
 
             # insert test data into patient instance
             if '718-7' in patients_test_scores:
-                cur_patient.hemoglobin_level = [float(patients_test_scores['718-7'])]
+                cur_patient.hemoglobin_level = [patients_test_scores['718-7']]
             if '53286-1' in patients_test_scores:
-                cur_patient.wbc_level = [float(patients_test_scores['53286-1'])]
+                cur_patient.wbc_level = [patients_test_scores['53286-1']]
 
-            # Create new symptom
-            symptom = self.ontology.Symptom(f"Symptom_{pid}")
+            # Fill the symptom
             any_symptom = False
             if '386661006' in patients_test_scores:
-                symptom.fever = [float(patients_test_scores['386661006'])]
+                symptom.fever = [patients_test_scores['386661006']]
                 any_symptom = True
             if '43724002' in patients_test_scores:
                 symptom.chills = [patients_test_scores['43724002']]
@@ -204,71 +307,218 @@ class DSSEngine:
                 any_symptom = True
             if any_symptom:
                 cur_patient.has_symptom = [symptom]
+            if laps:
+                laps.lap('individual_creation')
 
-            res_dict[pid] = p_dict.copy() # contains the patients name, age and gender
+            states = p_dict.copy() # contains the patients name, age and gender
             try:
-                hemoglobin_state = determine_hemoglobin_state(cur_patient)
+                hemoglobin_state = determine_hemoglobin_state(cur_patient, ontology)
                 cur_patient.has_hemoglobin_state = [hemoglobin_state]
-                res_dict[pid]["Hemoglobin State"] = hemoglobin_state.name
+                states["Hemoglobin State"] = hemoglobin_state.name
             except ValueError as e:
-                res_dict[pid]["Hemoglobin State"] = f"Error: {str(e)}"
+                states["Hemoglobin State"] = f"Error: {str(e)}"
+            if laps:
+                laps.lap('determine_hemoglobin_state')
 
             try:
-                hematological_state = determine_hematological_state(cur_patient)
+                hematological_state = determine_hematological_state(cur_patient, ontology)
                 cur_patient.has_hematological_state = [hematological_state]
-                res_dict[pid]["Hematological State"] = hematological_state.name
+                states["Hematological State"] = hematological_state.name
             except ValueError as e:
-                res_dict[pid]["Hematological State"] = f"Error: {str(e)}"
+                states["Hematological State"] = f"Error: {str(e)}"
+            if laps:
+                laps.lap('determine_hematological_state')
 
             try:
-                systemic_toxicity = determine_systemic_toxicity(cur_patient)
+                systemic_toxicity = determine_systemic_toxicity(cur_patient, ontology)
                 cur_patient.has_systemic_toxicity = [systemic_toxicity]
-                res_dict[pid]["Systemic Toxicity"] = systemic_toxicity.name
+                states["Systemic Toxicity"] = systemic_toxicity.name
             except ValueError as e:
-                res_dict[pid]["Systemic Toxicity"] = f"Error: {str(e)}"
+                states["Systemic Toxicity"] = f"Error: {str(e)}"
+            if laps:
+                laps.lap('determine_systemic_toxicity')
 
             try:
-                treatment = determine_treatment(cur_patient)
+                treatment = determine_treatment(cur_patient, ontology)
                 cur_patient.has_treatment = [treatment]
-                res_dict[pid]["Treatment"] = treatment.name
+                states["Treatment"] = treatment.name
             except ValueError as e:
-                res_dict[pid]["Treatment"] = f"Error: {str(e)}"
-
-            # Delete the Patient instance
-            destroy_entity(cur_patient)
-            destroy_entity(symptom)
+                states["Treatment"] = f"Error: {str(e)}"
+            if laps:
+                laps.lap('determine_treatment')
+        finally:
+            if self.inference_mode == 'ontology':
+                # Delete the Patient instance
+                destroy_entity(cur_patient)
+                destroy_entity(symptom)
+                if laps:
+                    laps.lap('destroy_entity')
+
+        return states
+
+    def get_state_timeline_inputs(self, pid):
+        """
+        Collects the inputs of a patient's state timeline
+        :param pid: str, id of the patient
+        :return: tuple of (patient logs, validity windows of the logs, sorted datetime64 array of the time points where
+                 a window starts or ends)
+        """
+        patient_logs = self.db_con.get_patient_logs(pid)
 
-        return res_dict
+        # Windows of the tests known to system, deleted entries also define time points
+        windows = self.db_con.get_validity_windows(patient_logs)
+        known_tests = windows['Window Start'].notna().to_numpy()
+        timepoints = np.unique(np.concatenate([windows['Window Start'].to_numpy(dtype='datetime64[ns]')[known_tests],
+                                               windows['Window End'].to_numpy(dtype='datetime64[ns]')[known_tests]]))
+        return patient_logs, windows, timepoints
 
-    def retrieve_state_intervals(self , patient, state):
+    def infer_state_samples(self, pid, patient_logs, windows, timepoints):
+        """
+        Infers the states of a patient at a sorted set of time points.
+        The rules run again only at the time points where the most recent valid value of some test changes.
+        :param pid: str, id of the patient
+        :param patient_logs: DataFrame of all the logs of the patient
+        :param windows: DataFrame of the validity windows of the logs
+        :param timepoints: sorted datetime64 array
+        :return: list of the states dictionaries inferred at each time point
+        """
+        if len(timepoints) == 0:
+            return []
+        p_dict = self.db_con.get_patients_dict()[pid]
+        eval_times = timepoints.astype('datetime64[m]').astype('datetime64[ns]')  # States are inferred per minute
+
+        # For every test, find the most recent valid entry at each time point.
+        # All the windows of a test have the same length, so it is the last entry starting before the time point
+        # ends its window, if that entry is still valid at the time point.
+        live_rows = windows['Window Start'].notna().to_numpy() & ~patient_logs['Deleted'].to_numpy()
+        live_logs, live_windows = patient_logs[live_rows], windows[live_rows]
+        values_by_label = dict(zip(live_logs.index, self.db_con.get_test_values(live_logs)))
+        recent_entries = {}
+        for test_name, test_logs in live_logs.groupby('Test Name', observed=True):
+            valid_start = test_logs['Valid Start Time'].to_numpy(dtype='datetime64[ns]')
+            transaction = test_logs['Transaction Time'].to_numpy(dtype='datetime64[ns]')
+            labels = test_logs.index.to_numpy()
+            good_before = valid_start[0] - live_windows.loc[labels[0], 'Window Start'].to_datetime64()
+            good_after = live_windows.loc[labels[0], 'Window End'].to_datetime64() - valid_start[0]
+
+            # Equal start times - the last entry, the latest recorded version of the measurement, is the one found
+            order = np.lexsort((labels, transaction, valid_start))
+            valid_start, labels = valid_start[order], labels[order]
+            positions = np.searchsorted(valid_start, eval_times + good_before, side='left') - 1
+            is_valid = positions >= 0
+            is_valid[is_valid] = valid_start[positions[is_valid]] >= eval_times[is_valid] - good_after
+            recent_entries[test_name] = np.where(is_valid, labels[positions], -1)
+
+        recent_entries_matrix = np.array(list(recent_entries.values())).reshape(len(recent_entries), len(timepoints))
+        inputs_changed = np.ones(len(timepoints), dtype=bool)
+        inputs_changed[1:] = (recent_entries_matrix[:, 1:] != recent_entries_matrix[:, :-1]).any(axis=0)
+
+        # Run the rules only where the inputs changed
+        samples = []
+        for i, timepoint in enumerate(timepoints):
+            if inputs_changed[i]:
+                patients_test_scores = {test_name: values_by_label[entries[i]]
+                                        for test_name, entries in recent_entries.items() if entries[i] != -1}
+                try:
+                    patient_states = self.infer_patient_states(pid, p_dict, patients_test_scores)
+                except:
+                    patient_states = {}
+                    print(f'Exception has occured on {pd.Timestamp(timepoint).to_pydatetime()}')
+            samples.append(patient_states)
+        return samples
+
+    def retrieve_state_timelines(self, patient, states = STATE_NAMES):
+        """
+        Computes the intervals of every value of the required states of a patient.
+        The state samples are read from the timeline store, and computed (and stored) only if the patient's logs changed
+        since they were stored.
+        :param patient: str, name or id of the patient in the db
+        :param states: list of state names to compute intervals for
+        :return: dictionary in the form of {state : {state value : [[start, end], ...]}}, with no state values for a
+        patient with no logs, None for unknown patients
+        """
         try:
-            patient_intervals = self.db_con.get_patient_intervals(patient , unmerged = True)
+            pid = self.db_con.standartisize_patient(patient)
+            patient_logs, windows, timepoints = self.get_state_timeline_inputs(pid)
         except:
             print('Patient Name was not found in db! ')
             return
+        if len(timepoints) == 0:
+            return {state: {} for state in states}
+
+        fingerprint = fingerprint_patient_logs(patient_logs, windows, self.db_con.get_patients_dict()[pid])
+        timeline = self.timeline_store.load(pid, fingerprint)
+        if timeline is None:
+            timeline = (timepoints, self.infer_state_samples(pid, patient_logs, windows, timepoints), fingerprint)
+            self.timeline_store.save(pid, *timeline)
+        timepoints, samples, _ = timeline
+
+        python_timepoints = [pd.Timestamp(timepoint).to_pydatetime() for timepoint in timepoints]
+        return {state: self.build_state_intervals(python_timepoints,
+                                                  [patient_states.get(state, 'No condition')
+                                                   for patient_states in samples])
+                for state in states}
+
+    def update_state_timeline(self, changed_row, mode):
+        """
+        Splices a changed observation into the stored timeline of its patient - only the samples inside the validity
+        window of the observation are inferred again, from the logs valid inside it, and the fingerprint of the
+        timeline is updated with the hash of the changed observation alone.
+        A timeline that did not match the logs from before the change keeps not matching them, and is recomputed on read.
+        :param changed_row: Series, the row returned by the db update, labeled by its row id
+        :param mode: str, 'update' or 'delete'
+        :return:
+        """
+        pid = changed_row['Patient ID']
+        timeline = self.timeline_store.load(pid)
+        if timeline is None:
+            return
+        timepoints, old_samples, old_fingerprint = timeline
 
-        if len(patient_intervals) == 0 :
-            return []
-
-        flatten_timepoints = list(itertools.chain(*patient_intervals))
-        sorted_unique_timepoints = sorted(set(flatten_timepoints))
-
+        # A new version has the window of the version it replaces, and deleted logs keep their time points - so the
+        # change adds no time points, and only the samples inside its window are affected
+        test_window = self.db_con.get_test_windows().get(changed_row['Test Name'].strip())
+        if test_window is None:
+            self.timeline_store.invalidate(pid)
+            return
+        valid_start = np.datetime64(changed_row['Valid Start Time'], 'ns')
+        window_start, window_end = valid_start - test_window[0], valid_start + test_window[1]
+        if not (np.isin(window_start, timepoints) and np.isin(window_end, timepoints)):
+            self.timeline_store.invalidate(pid)
+            return
+        window_logs = self.db_con.get_patient_logs_in_window(pid, window_start, window_end)
+        windows = self.db_con.get_validity_windows(window_logs)
+
+        eval_times = timepoints.astype('datetime64[m]').astype('datetime64[ns]')
+        affected = (window_start <= eval_times) & (eval_times <= window_end)
+        new_samples = iter(self.infer_state_samples(pid, window_logs, windows, timepoints[affected]))
+        samples = [next(new_samples) if is_affected else sample
+                   for sample, is_affected in zip(old_samples, affected)]
+
+        changed_logs, changed_windows = window_logs.loc[[changed_row.name]], windows.loc[[changed_row.name]]
+        if mode == 'update':  # The new version was added
+            old_logs, old_windows = changed_logs.iloc[:0], changed_windows.iloc[:0]
+        else:  # The log was not deleted before
+            old_logs, old_windows = changed_logs.copy(), changed_windows
+            old_logs['Deleted'] = False
+        fingerprint = replace_fingerprint_logs(old_fingerprint, old_logs, old_windows, changed_logs, changed_windows)
+        self.timeline_store.save(pid, timepoints, samples, fingerprint)
+
+    @staticmethod
+    def build_state_intervals(timepoints, state_values):
+        """
+        Builds the intervals of each state value, from the values of the state at consecutive time points
+        :param timepoints: sorted list of datetimes
+        :param state_values: list of the state value at each time point
+        :return: dictionary in the form of {state value : [[start, end], ...]}
+        """
         intervals_dict = {}
         cur_state_value = 'No condition'  # set to represent a patient has no possible value for the state
         OPEN_INTERVAL_EXISTS = False
 
-        for timepoint in sorted_unique_timepoints:
+        for timepoint, state_value in zip(timepoints, state_values):
             prev_state_value = cur_state_value
-            try :
-                patient_dict = self.infer_patients_states_for_timepoint(single_patient_id=patient,
-                                                                        req_time_data=timepoint)
-            except:
-                patient_dict = {patient : {}}
-                print(f'Exception has occured on {timepoint}')
-
-            patient_symptoms = list(patient_dict.values())[0]
-            # Check for condition:
-            cur_state_value = patient_symptoms.get(state, 'No condition')
+            cur_state_value = state_value
             if cur_state_value == prev_state_value:
                     # If the current state equal the prev state, no need to do anything.
                     continue
@@ -290,10 +540,73 @@ class DSSEngine:
         for state_value , intervals in intervals_dict.items():
             # Might happen that the last interval remains open
             if len(intervals[-1]) == 1 :
-                intervals[-1].append(timepoint)
+                intervals[-1].append(timepoints[-1])
 
         return intervals_dict
 
+    def retrieve_state_interval_records(self, patient, states = STATE_NAMES):
+        """
+        Flattens the state timelines of a patient to compact records
+        :param patient: str, name or id of the patient in the db
+        :param states: list of state names
+        :return: list of (patient id, state, state value, start, end) tuples
+        """
+        state_timelines = self.retrieve_state_timelines(patient, states = states)
+        if state_timelines is None:
+            return []
+        pid = self.db_con.standartisize_patient(patient)
+        return [(pid, state, state_value, start, end)
+                for state, intervals_dict in state_timelines.items()
+                for state_value, intervals in dict(intervals_dict).items()
+                for start, end in intervals]
+
+    def iter_state_interval_records(self, patients = None, states = STATE_NAMES):
+        """
+        Generates the state interval records of a cohort, one patient at a time
+        :param patients: list of patient names or ids, None for all the patients in the db
+        :param states: list of state names
+        :return: generator of (patient id, state, state value, start, end) tuples
+        """
+        if patients is None:
+            patients = self.db_con.get_patients_ids()
+        for patient in patients:
+            yield from self.retrieve_state_interval_records(patient, states)
+
+    def retrieve_cohort_state_intervals(self, patients = None, states = STATE_NAMES, workers = None, chunksize = 4):
+        """
+        Computes the state intervals of a cohort of patients, spread over a pool of worker processes.
+        Every worker loads the db and the ontology once, and computes the intervals of whole patients.
+        :param patients: list of patient names or ids, None for all the patients in the db
+        :param states: list of state names
+        :param workers: int, number of worker processes, None for the number of cores. 1 computes in this process
+        :param chunksize: int, number of patients sent to a worker at a time
+        :return: list of (patient id, state, state value, start, end) tuples, ordered by patient
+        """
+        if patients is None:
+            patients = self.db_con.get_patients_ids()
+        if workers == 1:
+            return [record for patient in patients for record in self.retrieve_state_interval_records(patient, states)]
+
+        with ProcessPoolExecutor(max_workers = workers, initializer = _init_cohort_worker,
+                                 initargs = (self.db_folder, self.ontology_folder, self.storage,
+                                             self.inference_mode)) as executor:
+            patients_records = executor.map(_cohort_worker_state_interval_records, patients,
+                                            [states] * len(patients), chunksize = chunksize)
+            return [record for records in patients_records for record in records]
+
+    def retrieve_state_intervals(self , patient, state):
+        """
+        Retrieves the intervals of every value of a single state of a patient
+        :param patient: str, name or id of the patient in the db
+        :param state: str, name of the state, e.g. 'Hemoglobin State'
+        :return: dictionary in the form of {state value : [[start, end], ...]}, an empty dictionary if the patient has
+        no logs
+        """
+        state_timelines = self.retrieve_state_timelines(patient, states = [state])
+        if state_timelines is None:
+            return
+        return state_timelines[state]
+
     # def retrieve_interval_for_patient(self, patient, test_name, required_value):
     #     """
     #     Checks patient's test values across all medical logs, and retrives a list of time intervals where the patient
@@ -399,6 +712,17 @@ class DSSEngine:
     #     return intervals
 
 
+# Engine of a cohort worker process, loaded once by the pool initializer
+_cohort_engine = None
+
+def _init_cohort_worker(db_folder, ontology_folder, storage, inference_mode):
+    global _cohort_engine
+    _cohort_engine = DSSEngine(db_folder, ontology_folder, storage = storage, inference_mode = inference_mode)
+
+def _cohort_worker_state_interval_records(patient, states):
+    return _cohort_engine.retrieve_state_interval_records(patient, states)
+
+
 if __name__ == "__main__":
     dss = DSSEngine()
     patient_name = 'James Smith'
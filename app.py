@@ -3,18 +3,30 @@ import pandas as pd
 import numpy as np
 from datetime import datetime, time
 from DssEngine import DSSEngine
+from data_watcher import DataSourceWatcher
 import plotly.graph_objects as go
 import random
 import pytz
 
 
+@st.cache_resource
+def get_dss_engine():
+    """
+    Loads the engine once per process, it is shared by all sessions and reruns.
+    Data sources are reloaded by the watcher when their files change.
+    """
+    dss = DSSEngine()
+    DataSourceWatcher(dss).start()
+    return dss
+
+
 # Load data
-dss = DSSEngine()
+dss = get_dss_engine()
 patients_df = dss.db_con.patients_personal_data    #pd.read_csv('patients.csv')
-observations_df = dss.db_con.patients_medical_data #pd.read_csv('patient_data.csv', na_values=["NA", "N/A", ""], keep_default_na=False)
 loinc_data = dss.db_con.loinc_data     #pd.read_csv('loinc_data.csv')
 
 local_tz = pytz.timezone('Asia/Jerusalem')
+OBSERVATIONS_PAGE_SIZE = 500
 
 
 st.markdown("""
@@ -523,5 +535,8 @@ if st.checkbox('Show Raw Data'):
     st.subheader('Patient Data')
     st.write(patients_df)
     st.subheader('Observations Data')
-    st.write(observations_df)
+    # Only a page of the observations is read on every rerun
+    observations_page = st.number_input('Page', min_value=1, value=1, step=1)
+    st.write(dss.db_con.get_medical_data_rows(offset=(observations_page - 1) * OBSERVATIONS_PAGE_SIZE,
+                                              limit=OBSERVATIONS_PAGE_SIZE))
 
@@ -0,0 +1,151 @@
+import bisect
+import copy
+
+import numpy as np
+
+
+class AsOfSnapshots:
+    """
+    Checkpointed views of the patients medical data as it was known at past transaction times.
+    Rows are kept in transaction time order, every row linked to the version of its measurement - (Patient ID,
+    Test Name, Valid Start Time) - it replaced. Every checkpoint_interval rows, a checkpoint marks the rows that were
+    the latest version of their measurement at its transaction time, as a bitmap.
+    The view at any transaction time starts from the nearest earlier checkpoint, and applies only the rows recorded
+    since it - every such row is known, and hides the version it replaced.
+    The deleted flag is not kept - it is read from the data itself, so deleting a row needs no update.
+    """
+
+    def __init__(self, medical_data=None, checkpoint_interval=50000):
+        """
+        :param medical_data: DataFrame of the patients medical data, labeled by row positions
+        :param checkpoint_interval: int, number of rows recorded between checkpoints
+        """
+        self.checkpoint_interval = checkpoint_interval
+        self.rebuild(medical_data)
+
+    def rebuild(self, medical_data):
+        """
+        Builds the snapshots from scratch
+        :param medical_data: DataFrame of the patients medical data, labeled by row positions
+        :return:
+        """
+        if medical_data is None or len(medical_data) == 0:
+            self.transaction = np.array([], dtype='datetime64[ns]')
+            self.labels = np.array([], dtype=np.int64)
+            self.previous = np.array([], dtype=np.int64)
+            self.positions = np.array([], dtype=np.int64)
+            self.checkpoint_ends, self.checkpoint_masks = [], []
+            return
+        transaction = medical_data['Transaction Time'].to_numpy(dtype='datetime64[ns]')
+        labels = medical_data.index.to_numpy(dtype=np.int64)
+        order = np.lexsort((labels, transaction))  # Rows recorded at the same time are ordered by label
+        self.transaction, self.labels = transaction[order], labels[order]
+        self.positions = np.full(self.labels.max() + 1, -1, dtype=np.int64)
+        self.positions[self.labels] = np.arange(len(self.labels))
+
+        # The previous version of a row is the row just before it, in transaction order, of the same measurement
+        measurements = medical_data.groupby(['Patient ID', 'Test Name', 'Valid Start Time'], observed=True, sort=False,
+                                            dropna=False).ngroup().to_numpy()[order]
+        by_measurement = np.lexsort((np.arange(len(order)), measurements))
+        same_measurement = measurements[by_measurement[1:]] == measurements[by_measurement[:-1]]
+        self.previous = np.full(len(order), -1, dtype=np.int64)
+        self.previous[by_measurement[1:][same_measurement]] = by_measurement[:-1][same_measurement]
+
+        self.checkpoint_ends, self.checkpoint_masks = [], []
+        self._add_checkpoints()
+
+    def _add_checkpoints(self):
+        """
+        Adds checkpoints for every checkpoint_interval rows recorded since the last checkpoint
+        """
+        start = self.checkpoint_ends[-1] if self.checkpoint_ends else 0
+        while len(self.transaction) - start >= self.checkpoint_interval:
+            # A checkpoint includes all the rows recorded at the transaction time it ends at
+            end = int(np.searchsorted(self.transaction, self.transaction[start + self.checkpoint_interval - 1],
+                                      side='right'))
+            self.checkpoint_masks.append(np.packbits(self._known_rows(end)))
+            self.checkpoint_ends.append(end)
+            start = end
+
+    def _known_rows(self, end):
+        """
+        :param end: int, number of rows recorded up to the required transaction time
+        :return: bool array over the first end rows, True for the latest version of every measurement among them
+        """
+        checkpoint = bisect.bisect_right(self.checkpoint_ends, end) - 1
+        if checkpoint >= 0:
+            start = self.checkpoint_ends[checkpoint]
+            known = np.unpackbits(self.checkpoint_masks[checkpoint], count=start).astype(bool)
+            known = np.concatenate([known, np.ones(end - start, dtype=bool)])
+        else:
+            start, known = 0, np.ones(end, dtype=bool)
+        replaced = self.previous[start:end]
+        known[replaced[replaced >= 0]] = False
+        return known
+
+    def copy(self):
+        """
+        :return: AsOfSnapshots sharing the rows and checkpoints of these snapshots - rows added to the copy do not
+                 change these snapshots
+        """
+        snapshots = copy.copy(self)
+        snapshots.positions = self.positions.copy()  # The only array add_rows changes in place
+        snapshots.checkpoint_ends, snapshots.checkpoint_masks = list(self.checkpoint_ends), list(self.checkpoint_masks)
+        return snapshots
+
+    def add_rows(self, medical_data_rows, previous_labels):
+        """
+        Appends new rows, that were recorded no earlier than the rows already kept
+        :param medical_data_rows: DataFrame of the new rows, labeled by their labels in the medical data
+        :param previous_labels: array of the label of the version every new row replaces, -1 for new measurements
+        :return: True if the rows were added, False if some row was recorded earlier than the kept rows - the
+                 snapshots have to be rebuilt
+        """
+        transaction = medical_data_rows['Transaction Time'].to_numpy(dtype='datetime64[ns]')
+        labels = medical_data_rows.index.to_numpy(dtype=np.int64)
+        if len(labels) == 0:
+            return True
+        if len(self.transaction) > 0 and transaction.min() < self.transaction[-1]:
+            return False
+        order = np.lexsort((labels, transaction))
+        first_position = len(self.labels)
+        self.transaction = np.concatenate([self.transaction, transaction[order]])
+        self.labels = np.concatenate([self.labels, labels[order]])
+        if labels.max() >= len(self.positions):
+            self.positions = np.concatenate([self.positions,
+                                             np.full(labels.max() + 1 - len(self.positions), -1, dtype=np.int64)])
+        self.positions[labels[order]] = np.arange(first_position, len(self.labels))
+        previous_labels = np.asarray(previous_labels, dtype=np.int64)[order]
+        previous = np.full(len(order), -1, dtype=np.int64)
+        previous[previous_labels >= 0] = self.positions[previous_labels[previous_labels >= 0]]
+        self.previous = np.concatenate([self.previous, previous])
+        self._add_checkpoints()
+        return True
+
+    def lookup(self, pov, deleted=None):
+        """
+        Returns the rows of the data as known at a transaction time - the latest version of every measurement
+        recorded up to then
+        :param pov: datetime, the transaction time to view the data at
+        :param deleted: bool array of the deleted flag of the rows, by label - if given, a deleted version is replaced
+                        by the latest earlier version of its measurement that is not deleted
+        :return: sorted numpy array of row labels
+        """
+        end = int(np.searchsorted(self.transaction, np.datetime64(pov, 'ns'), side='right'))
+        positions = np.flatnonzero(self._known_rows(end))
+        if deleted is None:
+            return np.sort(self.labels[positions])
+        visible = []
+        while len(positions) > 0:
+            is_deleted = deleted[self.labels[positions]]
+            visible.append(positions[~is_deleted])
+            positions = self.previous[positions[is_deleted]]
+            positions = positions[positions >= 0]
+        return np.sort(self.labels[np.concatenate(visible)]) if visible else np.array([], dtype=np.int64)
+
+    def memory_usage(self):
+        """
+        :return: int, bytes held by the snapshots
+        """
+        return int(self.transaction.nbytes + self.labels.nbytes + self.previous.nbytes + self.positions.nbytes +
+                   sum(mask.nbytes for mask in self.checkpoint_masks))
@@ -0,0 +1,183 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from DssEngine import DSSEngine
+from synthetic_cohort import draw_test_values, generate_cohort
+
+DEFAULT_SIZES = ['100:10000', '1000:100000', '10000:1000000']
+
+
+def summarize_durations(durations):
+    """
+    :param durations: list of the durations of the calls of an operation, in seconds
+    :return: dictionary of the statistics of the durations
+    """
+    durations = np.asarray(durations)
+    return {'calls': len(durations),
+            'total_seconds': float(durations.sum()),
+            'mean_seconds': float(durations.mean()),
+            'median_seconds': float(np.median(durations)),
+            'p95_seconds': float(np.percentile(durations, 95)),
+            'min_seconds': float(durations.min()),
+            'max_seconds': float(durations.max())}
+
+
+def time_calls(func, calls_arguments):
+    """
+    Calls a function once for every arguments tuple, and measures every call
+    :return: list of durations in seconds
+    """
+    durations = []
+    for arguments in calls_arguments:
+        start = time.perf_counter()
+        func(*arguments)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def benchmark_engine(db_folder, ontology_folder='.', storage='csv', samples=20, batch_size=1000, seed=0):
+    """
+    Times every public operation of the engine on a db folder. Read operations run first, the operations that change
+    the data run last, each on its own sample of measurements.
+    :param db_folder: str, folder of the db files
+    :param ontology_folder: str, folder of the ontology
+    :param storage: str, storage backend of the db
+    :param samples: int, number of calls of every operation
+    :param batch_size: int, number of measurements in every batch of the batch operations
+    :param seed: int, seed of the sampled arguments
+    :return: tuple of (dictionary of operation name to the statistics of its durations, memory usage of the loaded
+             medical data)
+    """
+    rng = np.random.default_rng(seed)
+    results = {}
+
+    start = time.perf_counter()
+    dss = DSSEngine(db_folder, ontology_folder, storage=storage)
+    results['engine_init'] = summarize_durations([time.perf_counter() - start])
+    memory_usage = dss.db_con.get_memory_usage()
+
+    # Arguments are sampled from existing measurements, so the queries find data
+    medical_data = dss.db_con.get_medical_data_rows()
+    measurements = medical_data[~medical_data['Deleted']]
+    measurements = measurements.iloc[rng.choice(len(measurements), size=min(samples * 4, len(measurements)),
+                                                replace=False)].drop_duplicates(['Patient ID', 'Test Name',
+                                                                                 'Valid Start Time'])
+    sampled = list(zip(measurements['Patient ID'], measurements['Test Name'], measurements['Valid Start Time']))
+    read_sample, update_sample, delete_sample = (sampled[:samples], sampled[samples:2 * samples],
+                                                 sampled[2 * samples:3 * samples])
+    patients = rng.choice(dss.db_con.get_patients_ids(), size=min(samples, len(dss.patient_list)), replace=False)
+    day = lambda timestamp: timestamp.strftime('%d.%m.%Y')
+    hour = lambda timestamp: timestamp.strftime('%H:%M')
+    now = datetime.now()
+
+    results['retrival_query'] = summarize_durations(time_calls(
+        dss.retrival_query, [(test, pid, day(t), day(now), hour(t), hour(now)) for pid, test, t in read_sample]))
+    results['retrival_historic_query'] = summarize_durations(time_calls(
+        dss.retrival_historic_query, [(test, pid, day(t), '01.01.1990') for pid, test, t in read_sample]))
+    results['retrieve_relevant_tests_for_patient'] = summarize_durations(time_calls(
+        dss.retrieve_relevant_tests_for_patient, [(pid, day(t), hour(t)) for pid, test, t in read_sample]))
+    snapshot_times = [t for pid, test, t in read_sample[:max(samples // 4, 1)]]
+    results['get_valid_tests_snapshot'] = summarize_durations(time_calls(
+        dss.db_con.get_valid_tests_snapshot, [(day(t), hour(t)) for t in snapshot_times]))
+    results['get_data_as_of'] = summarize_durations(time_calls(
+        dss.db_con.get_data_as_of, [(t.to_pydatetime(),) for t in snapshot_times]))
+    results['infer_patient_states'] = summarize_durations(time_calls(
+        dss.infer_patients_states_for_timepoint, [(t.to_pydatetime(), pid) for pid, test, t in read_sample]))
+    results['infer_ward_states'] = summarize_durations(time_calls(
+        dss.infer_patients_states_for_timepoint, [(t.to_pydatetime(),) for t in snapshot_times]))
+
+    dss.timeline_store.invalidate()
+    results['retrieve_state_intervals_cold'] = summarize_durations(time_calls(
+        dss.retrieve_state_intervals, [(pid, 'Treatment') for pid in patients]))
+    results['retrieve_state_intervals_stored'] = summarize_durations(time_calls(
+        dss.retrieve_state_intervals, [(pid, 'Treatment') for pid in patients]))
+
+    update_values, _ = draw_test_values(np.array([test for pid, test, t in update_sample], dtype=object), rng)
+    results['update_query'] = summarize_durations(time_calls(
+        dss.update_query, [(pid, test, day(t), hour(t), day(now), hour(now), value)
+                           for (pid, test, t), value in zip(update_sample, update_values)]))
+    results['delete_query'] = summarize_durations(time_calls(
+        dss.delete_query, [(pid, test, day(t), hour(t)) for pid, test, t in delete_sample]))
+
+    # Batches copy existing measurements, to new measurement times and to their current values
+    def make_batch():
+        rows = medical_data.iloc[rng.integers(0, len(medical_data), size=batch_size)]
+        return pd.DataFrame({'Patient ID': rows['Patient ID'].to_numpy(),
+                             'Test Name': rows['Test Name'].to_numpy(),
+                             'Value': rows['Value'].to_numpy(),
+                             'Valid Start Time': rows['Valid Start Time'].to_numpy() + np.timedelta64(1, 'm')})
+    insert_batches = [(make_batch(),) for _ in range(max(samples // 4, 1))]
+    results['insert_query'] = summarize_durations(time_calls(dss.insert_query, insert_batches))
+    correction_batches = []
+    for (batch,) in insert_batches:
+        corrections = batch.rename(columns={'Valid Start Time': 'Measurement Time'})
+        corrections['Action'] = np.where(rng.random(len(corrections)) < 0.9, 'update', 'delete')
+        correction_batches.append((corrections,))
+    results['correction_query'] = summarize_durations(time_calls(dss.correction_query, correction_batches))
+    return results, memory_usage
+
+
+def run_benchmarks(sizes, output_path, ontology_folder='.', storage='csv', samples=20, batch_size=1000, seed=0,
+                   data_folder=None):
+    """
+    Generates a synthetic cohort of every size, benchmarks the engine on it and writes a json report
+    :param sizes: list of (number of patients, number of medical data rows) tuples
+    :param output_path: str, path of the json report
+    :param data_folder: str, folder to keep the generated cohorts in, defaults to temporary folders that are removed
+    :return: the report dictionary
+    """
+    report = {'created': datetime.now().isoformat(timespec='seconds'),
+              'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                              'numpy': np.__version__, 'pandas': pd.__version__},
+              'storage': storage, 'samples': samples, 'batch_size': batch_size, 'seed': seed,
+              'results': []}
+    for n_patients, n_rows in sizes:
+        if data_folder is None:
+            cohort_folder = tempfile.mkdtemp(prefix='cdss_benchmark_')
+        else:
+            cohort_folder = os.path.join(data_folder, f'cohort_{n_patients}_{n_rows}')
+        try:
+            start = time.perf_counter()
+            written = generate_cohort(cohort_folder, n_patients, n_rows, seed)
+            generate_seconds = time.perf_counter() - start
+            operations, memory_usage = benchmark_engine(cohort_folder, ontology_folder, storage, samples, batch_size, seed)
+        finally:
+            if data_folder is None:
+                shutil.rmtree(cohort_folder, ignore_errors=True)
+        report['results'].append({'patients': written['patients'], 'rows': written['rows'],
+                                  'generate_seconds': generate_seconds, 'memory': memory_usage,
+                                  'operations': operations})
+        print(f'{written["patients"]} patients, {written["rows"]} rows, '
+              f'{memory_usage["bytes per row"]:.1f} bytes per row:')
+        for name, stats in operations.items():
+            print(f'    {name:40s} median {stats["median_seconds"]:.4f}s  p95 {stats["p95_seconds"]:.4f}s')
+
+        # The report is rewritten after every size, so a long run keeps the results of the sizes it finished
+        with open(output_path + '.tmp', 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+        os.replace(output_path + '.tmp', output_path)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the DSS engine on synthetic cohorts of growing size')
+    parser.add_argument('--sizes', nargs='+', default=DEFAULT_SIZES, help='cohort sizes, as patients:rows')
+    parser.add_argument('--output', default='benchmark_report.json')
+    parser.add_argument('--ontology-folder', default='.')
+    parser.add_argument('--storage', choices=['csv', 'sqlite'], default='csv')
+    parser.add_argument('--samples', type=int, default=20, help='number of calls of every operation')
+    parser.add_argument('--batch-size', type=int, default=1000, help='measurements in every insert/correction batch')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-folder', default=None, help='folder to keep the generated cohorts in')
+    args = parser.parse_args()
+    run_benchmarks([tuple(int(part) for part in size.split(':')) for size in args.sizes], args.output,
+                   args.ontology_folder, args.storage, args.samples, args.batch_size, args.seed, args.data_folder)
@@ -0,0 +1,195 @@
+import numpy as np
+
+
+class BitemporalIndex:
+    """
+    Index over the patients medical data, keyed by (Patient ID, Test Name).
+    Every key holds the row labels of its measurements, sorted by valid start time and then by transaction time,
+    so time range lookups are done with binary search and never touch rows of other patients or tests.
+    All the validity windows of a test have the same length, so the windows of a key are sorted by their start and by
+    their end alike - the rows valid at a time point are a contiguous range of the key, found with binary search too.
+    The deleted flag is not kept in the index - it is read from the data itself, so deleting a row needs no update.
+    """
+
+    def __init__(self, medical_data=None):
+        self.entries = {}
+        self.patient_tests = {}  # The tests of every patient, in the order they were first indexed
+        if medical_data is not None:
+            self.rebuild(medical_data)
+
+    def rebuild(self, medical_data):
+        """
+        Builds the index from scratch
+        :param medical_data: DataFrame of the patients medical data
+        :return:
+        """
+        self.entries = {}
+        self.patient_tests = {}
+        if len(medical_data) == 0:
+            return
+        ordered = medical_data.sort_values(by=['Patient ID', 'Test Name', 'Valid Start Time', 'Transaction Time'],
+                                           kind='mergesort')
+        patient_ids = ordered['Patient ID'].to_numpy()
+        test_names = ordered['Test Name'].to_numpy()
+        valid_start = ordered['Valid Start Time'].to_numpy(dtype='datetime64[ns]')
+        transaction = ordered['Transaction Time'].to_numpy(dtype='datetime64[ns]')
+        labels = ordered.index.to_numpy()
+
+        # Find the boundaries of every (patient, test) block in the sorted arrays
+        key_changed = np.ones(len(ordered), dtype=bool)
+        key_changed[1:] = (patient_ids[1:] != patient_ids[:-1]) | (test_names[1:] != test_names[:-1])
+        starts = np.flatnonzero(key_changed)
+        ends = np.append(starts[1:], len(ordered))
+        for start, end in zip(starts, ends):
+            self.entries[(patient_ids[start], test_names[start])] = (valid_start[start:end],
+                                                                     transaction[start:end],
+                                                                     labels[start:end])
+            self.patient_tests.setdefault(patient_ids[start], []).append(test_names[start])
+
+    def copy(self):
+        """
+        :return: BitemporalIndex sharing the arrays of this index - additions to the copy, that replace the arrays of
+                 their keys, do not change this index
+        """
+        index = BitemporalIndex()
+        index.entries = dict(self.entries)
+        index.patient_tests = {patient_id: list(tests) for patient_id, tests in self.patient_tests.items()}
+        return index
+
+    def add(self, label, patient_id, test_name, valid_start_time, transaction_time):
+        """
+        Inserts a single new row into the index, keeping its key sorted
+        :param label: index label of the row in the medical data
+        :param patient_id: str
+        :param test_name: str, loinc num of the test
+        :param valid_start_time: datetime of the measurement
+        :param transaction_time: datetime of the transaction
+        :return:
+        """
+        valid_start_time = np.datetime64(valid_start_time, 'ns')
+        transaction_time = np.datetime64(transaction_time, 'ns')
+        entry = self.entries.get((patient_id, test_name))
+        if entry is None:
+            self.entries[(patient_id, test_name)] = (np.array([valid_start_time]),
+                                                     np.array([transaction_time]),
+                                                     np.array([label]))
+            self.patient_tests.setdefault(patient_id, []).append(test_name)
+            return
+        valid_start, transaction, labels = entry
+        # Position after all rows with an earlier (valid start, transaction) pair
+        lo = np.searchsorted(valid_start, valid_start_time, side='left')
+        hi = np.searchsorted(valid_start, valid_start_time, side='right')
+        pos = lo + np.searchsorted(transaction[lo:hi], transaction_time, side='right')
+        self.entries[(patient_id, test_name)] = (np.insert(valid_start, pos, valid_start_time),
+                                                 np.insert(transaction, pos, transaction_time),
+                                                 np.insert(labels, pos, label))
+
+    def add_rows(self, medical_data_rows):
+        """
+        Inserts a batch of new rows into the index, every affected key is merged and sorted once
+        :param medical_data_rows: DataFrame of the new rows, labeled by their index labels in the medical data
+        :return:
+        """
+        for (patient_id, test_name), rows in medical_data_rows.groupby(['Patient ID', 'Test Name'], sort=False,
+                                                                       observed=True):
+            valid_start = rows['Valid Start Time'].to_numpy(dtype='datetime64[ns]')
+            transaction = rows['Transaction Time'].to_numpy(dtype='datetime64[ns]')
+            labels = rows.index.to_numpy()
+            entry = self.entries.get((patient_id, test_name))
+            if entry is not None:
+                valid_start = np.concatenate([entry[0], valid_start])
+                transaction = np.concatenate([entry[1], transaction])
+                labels = np.concatenate([entry[2], labels])
+            else:
+                self.patient_tests.setdefault(patient_id, []).append(test_name)
+            order = np.lexsort((transaction, valid_start))  # Stable, existing rows stay before new rows on ties
+            self.entries[(patient_id, test_name)] = (valid_start[order], transaction[order], labels[order])
+
+    def lookup(self, patient_id, test_name, valid_from, valid_to, pov=None):
+        """
+        Returns the labels of the rows of a patient and test measured between valid_from and valid_to (inclusive)
+        :param patient_id: str
+        :param test_name: str, loinc num of the test
+        :param valid_from: datetime, earliest valid start time
+        :param valid_to: datetime, latest valid start time
+        :param pov: datetime, if supplied only rows recorded up to this transaction time are returned
+        :return: numpy array of row labels, in the order of the original data
+        """
+        entry = self.entries.get((patient_id, test_name))
+        if entry is None:
+            return np.array([], dtype=np.int64)
+        valid_start, transaction, labels = entry
+        lo = np.searchsorted(valid_start, np.datetime64(valid_from, 'ns'), side='left')
+        hi = np.searchsorted(valid_start, np.datetime64(valid_to, 'ns'), side='right')
+        selected = labels[lo:hi]
+        if pov is not None:
+            selected = selected[transaction[lo:hi] <= np.datetime64(pov, 'ns')]
+        return np.sort(selected)
+
+    def lookup_valid_at(self, patient_id, test_windows, target_time):
+        """
+        Stabbing query - returns the labels of the rows of a patient valid at a time point, in any of its tests.
+        A row is valid while: valid start - good before < target time <= valid start + good after
+        :param patient_id: str
+        :param test_windows: dictionary of loinc num to its (good before, good after) timedelta64 pair, rows of other
+                             tests have no validity window and are never valid
+        :param target_time: datetime
+        :return: sorted numpy array of row labels
+        """
+        target_time = np.datetime64(target_time, 'ns')
+        selected = []
+        for test_name in self.patient_tests.get(patient_id, []):
+            windows = test_windows.get(test_name.strip())
+            if windows is None:
+                continue
+            good_before, good_after = windows
+            valid_start, transaction, labels = self.entries[(patient_id, test_name)]
+            lo = np.searchsorted(valid_start, target_time - good_after, side='left')
+            hi = np.searchsorted(valid_start, target_time + good_before, side='left')
+            selected.append(labels[lo:hi])
+        return np.sort(np.concatenate(selected)) if selected else np.array([], dtype=np.int64)
+
+    def get_patient_windows(self, patient_id, test_windows):
+        """
+        Returns the validity windows of all the rows of a patient
+        :param patient_id: str
+        :param test_windows: dictionary of loinc num to its (good before, good after) timedelta64 pair
+        :return: tuple of (window starts, window ends, row labels) arrays of the rows of tests with a window, sorted by
+                 window start and then by label, and a list of the test names of the rows of tests without a window
+        """
+        starts, ends, selected, unknown_tests = [], [], [], []
+        for test_name in self.patient_tests.get(patient_id, []):
+            valid_start, transaction, labels = self.entries[(patient_id, test_name)]
+            windows = test_windows.get(test_name.strip())
+            if windows is None:
+                unknown_tests += [test_name] * len(labels)
+                continue
+            starts.append(valid_start - windows[0])
+            ends.append(valid_start + windows[1])
+            selected.append(labels)
+        if not selected:
+            return (np.array([], dtype='datetime64[ns]'), np.array([], dtype='datetime64[ns]'),
+                    np.array([], dtype=np.int64), unknown_tests)
+        starts, ends, selected = np.concatenate(starts), np.concatenate(ends), np.concatenate(selected)
+        order = np.lexsort((selected, starts))
+        return starts[order], ends[order], selected[order], unknown_tests
+
+    def previous_versions(self, medical_data_rows):
+        """
+        Finds the version every row replaces - the row just before it in its key, with the same valid start time
+        :param medical_data_rows: DataFrame of rows already in the index, labeled by their index labels
+        :return: numpy array of row labels, -1 for rows that are the first version of their measurement
+        """
+        previous = np.full(len(medical_data_rows), -1, dtype=np.int64)
+        for (patient_id, test_name), row_positions in medical_data_rows.groupby(['Patient ID', 'Test Name'], sort=False,
+                                                                                observed=True).indices.items():
+            valid_start, transaction, labels = self.entries[(patient_id, test_name)]
+            row_labels = medical_data_rows.index.to_numpy()[row_positions]
+            entry_positions = np.flatnonzero(np.isin(labels, row_labels))
+            entry_positions = entry_positions[np.argsort(labels[entry_positions])]
+            has_previous = entry_positions > 0
+            has_previous[has_previous] = (valid_start[entry_positions[has_previous] - 1] ==
+                                          valid_start[entry_positions[has_previous]])
+            row_previous = np.where(has_previous, labels[entry_positions - 1], -1)
+            previous[row_positions[np.argsort(row_labels)]] = row_previous
+        return previous
@@ -1,165 +1,270 @@
+import threading
+
 from owlready2 import *
 
-# Load or create ontology
-onto = get_ontology("http://example.com/CDSSproject")
+ONTOLOGY_IRI = "http://example.com/CDSSproject"
+QUADSTORE_FILE = "cdss.sqlite3"
+OWL_FILE = "cdss.owl"
+
+# Individuals of each state class, in the form of {python name : individual name}.
+# The state rules below get the individuals of the ontology they run with by their python names.
+HEMOGLOBIN_STATE_INDIVIDUALS = {
+    "severe_anemia": "Severe_Anemia",
+    "moderate_anemia": "Moderate_Anemia",
+    "mild_anemia": "Mild_Anemia",
+    "normal_hemoglobin": "Normal_Hemoglobin",
+    "polycythemia": "Polycythemia"}
+
+HEMATOLOGICAL_STATE_INDIVIDUALS = {
+    "pancytopenia": "Pancytopenia",
+    "anemia": "Anemia",
+    "leukopenia": "Leukopenia",
+    "suspected_leukemia": "Suspected_Leukemia",
+    "leukemoid_reaction": "Leukemoid_Reaction",
+    "suspected_polycythemia_vera": "Suspected_Polycythemia_Vera",
+    "normal_hematological": "Normal_Hematological",
+    "polyhemia": "Polyhemia"}
+
+SYSTEMIC_TOXICITY_INDIVIDUALS = {
+    "grade_i": "Grade_I",
+    "grade_ii": "Grade_II",
+    "grade_iii": "Grade_III",
+    "grade_iv": "Grade_IV"}
+
+TREATMENT_INDIVIDUALS = {
+    "M_I": "M_I Measure_BP_once_a_week",
+    "M_II": "M_II Measure_BP_every_3_days_Give_aspirin_5g_twice_a_week",
+    "M_III": "M_III Measure_BP_every_day_Give_aspirin_15g_every_day_Diet_consultation",
+    "M_IV": "M_IV Measure_BP_twice_a_day_Give_aspirin_15g_every_day_Exercise_consultation_Diet_consultation",
+    "M_V": "M_V Measure_BP_every_hour_Give_1gr_magnesium_every_hour_Exercise_consultation_Call_family",
+    "F_I": "F_I Measure_BP_every_3_days",
+    "F_II": "F_II Measure_BP_every_3_days_Give_Celectone_2g_twice_a_day_for_two_days_drug_treatment",
+    "F_III": "F_III Measure_BP_every_day_Give_1gr_magnesium_every_3_hours_Diet_consultation",
+    "F_IV": "F_IV Measure_BP_twice_a_day_Give_1gr_magnesium_every_hour_Exercise_consultation_Diet_consultation",
+    "F_V": "F_V Measure_BP_every_hour_Give_1gr_magnesium_every_hour_Exercise_consultation_Call_help"}
+
 
+def build_ontology(world=None):
+    """
+    Constructs the classes, individuals and properties of the ontology
+    :param world: owlready2 World to build the ontology in, None for a new in memory world
+    :return: the built ontology
+    """
+    if world is None:
+        world = World()
+    onto = world.get_ontology(ONTOLOGY_IRI)
 
-# Define the classes with namespace
-class Patient(Thing):
-    namespace = onto
+    # Define the classes with namespace
+    class Patient(Thing):
+        namespace = onto
 
 
-class Symptom(Thing):
-    namespace = onto
+    class Symptom(Thing):
+        namespace = onto
 
-class HemoglobinState(Thing):
-    namespace = onto
+    class HemoglobinState(Thing):
+        namespace = onto
 
-class HematologicalState(Thing):
-    namespace = onto
+    class HematologicalState(Thing):
+        namespace = onto
 
 
-class SystemicToxicity(Thing):
-    namespace = onto
+    class SystemicToxicity(Thing):
+        namespace = onto
 
 
-class Treatment(Thing):
-    namespace = onto
+    class Treatment(Thing):
+        namespace = onto
 
 
-# Define individuals for HemoglobinState
-with onto:
-    severe_anemia = HemoglobinState("Severe_Anemia")
-    moderate_anemia = HemoglobinState("Moderate_Anemia")
-    mild_anemia = HemoglobinState("Mild_Anemia")
-    normal_hemoglobin = HemoglobinState("Normal_Hemoglobin")
-    polycythemia = HemoglobinState("Polycythemia")
+    # Define the individuals of every state class
+    with onto:
+        for state_class, individuals in [(HemoglobinState, HEMOGLOBIN_STATE_INDIVIDUALS),
+                                         (HematologicalState, HEMATOLOGICAL_STATE_INDIVIDUALS),
+                                         (SystemicToxicity, SYSTEMIC_TOXICITY_INDIVIDUALS),
+                                         (Treatment, TREATMENT_INDIVIDUALS)]:
+            for individual_name in individuals.values():
+                state_class(individual_name)
 
-# Define individuals for HematologicalState
-with onto:
-    pancytopenia = HematologicalState("Pancytopenia")
-    anemia = HematologicalState("Anemia")
-    leukopenia = HematologicalState("Leukopenia")
-    suspected_leukemia = HematologicalState("Suspected_Leukemia")
-    leukemoid_reaction = HematologicalState("Leukemoid_Reaction")
-    suspected_polycythemia_vera = HematologicalState("Suspected_Polycythemia_Vera")
-    normal_hematological = HematologicalState("Normal_Hematological")
-    polyhemia = HematologicalState("Polyhemia")
+    # Define object properties and explicitly add them to the ontology
+    with onto:
+        class has_hemoglobin_state(ObjectProperty):
+            domain = [Patient]
+            range = [HemoglobinState]
+
+
+        class has_hematological_state(ObjectProperty):
+            domain = [Patient]
+            range = [HematologicalState]
+
+
+        class has_systemic_toxicity(ObjectProperty):
+            domain = [Patient]
+            range = [SystemicToxicity]
+
+
+        class has_treatment(ObjectProperty):
+            domain = [Patient]
+            range = [Treatment]
+
+
+        class has_symptom(ObjectProperty):
+            domain = [Patient]
+            range = [Symptom]
 
-# Define individuals for SystemicToxicity
-with onto:
-    grade_i = SystemicToxicity("Grade_I")
-    grade_ii = SystemicToxicity("Grade_II")
-    grade_iii = SystemicToxicity("Grade_III")
-    grade_iv = SystemicToxicity("Grade_IV")
+    # Define data properties and explicitly add them to the ontology
+    with onto:
+        class gender(DataProperty):
+            domain = [Patient]
+            range = [str]
 
-# Define individuals for Treatment
-with onto:
-    M_I = Treatment("M_I Measure_BP_once_a_week")
-    M_II = Treatment("M_II Measure_BP_every_3_days_Give_aspirin_5g_twice_a_week")
-    M_III = Treatment("M_III Measure_BP_every_day_Give_aspirin_15g_every_day_Diet_consultation")
-    M_IV = Treatment("M_IV Measure_BP_twice_a_day_Give_aspirin_15g_every_day_Exercise_consultation_Diet_consultation")
-    M_V = Treatment("M_V Measure_BP_every_hour_Give_1gr_magnesium_every_hour_Exercise_consultation_Call_family")
-    F_I = Treatment("F_I Measure_BP_every_3_days")
-    F_II = Treatment("F_II Measure_BP_every_3_days_Give_Celectone_2g_twice_a_day_for_two_days_drug_treatment")
-    F_III = Treatment("F_III Measure_BP_every_day_Give_1gr_magnesium_every_3_hours_Diet_consultation")
-    F_IV = Treatment("F_IV Measure_BP_twice_a_day_Give_1gr_magnesium_every_hour_Exercise_consultation_Diet_consultation")
-    F_V = Treatment("F_V Measure_BP_every_hour_Give_1gr_magnesium_every_hour_Exercise_consultation_Call_help")
 
-# Define object properties and explicitly add them to the ontology
-with onto:
-    class has_hemoglobin_state(ObjectProperty):
-        domain = [Patient]
-        range = [HemoglobinState]
+        class hemoglobin_level(DataProperty):
+            domain = [Patient]
+            range = [float]
 
 
-    class has_hematological_state(ObjectProperty):
-        domain = [Patient]
-        range = [HematologicalState]
+        class wbc_level(DataProperty):
+            domain = [Patient]
+            range = [float]
 
 
-    class has_systemic_toxicity(ObjectProperty):
-        domain = [Patient]
-        range = [SystemicToxicity]
+        class fever(DataProperty):
+            domain = [Symptom]
+            range = [float]
 
 
-    class has_treatment(ObjectProperty):
-        domain = [Patient]
-        range = [Treatment]
+        class chills(DataProperty):
+            domain = [Symptom]
+            range = [str]
 
 
-    class has_symptom(ObjectProperty):
-        domain = [Patient]
-        range = [Symptom]
+        class skin_look(DataProperty):
+            domain = [Symptom]
+            range = [str]
 
-# Define data properties and explicitly add them to the ontology
-with onto:
-    class gender(DataProperty):
-        domain = [Patient]
-        range = [str]
 
+        class allergic_state(DataProperty):
+            domain = [Symptom]
+            range = [str]
 
-    class hemoglobin_level(DataProperty):
-        domain = [Patient]
-        range = [float]
+    return onto
 
 
-    class wbc_level(DataProperty):
-        domain = [Patient]
-        range = [float]
+def save_ontology(ontology_folder='.'):
+    """
+    Builds the ontology and persists it - as an owlready2 SQLite quadstore, loaded on startup,
+    and as an OWL file for viewing in ontology editors
+    :param ontology_folder: str, folder to save the files in
+    :return:
+    """
+    quadstore_path = os.path.join(ontology_folder, QUADSTORE_FILE)
+    # Build in a temporary file first, so processes starting meanwhile never see a half written quadstore
+    if os.path.exists(quadstore_path + '.tmp'):
+        os.remove(quadstore_path + '.tmp')
+    world = World(filename=quadstore_path + '.tmp')
+    onto = build_ontology(world)
+    world.save()
+    onto.save(file=os.path.join(ontology_folder, OWL_FILE), format="rdfxml")
+    world.close()
+    os.replace(quadstore_path + '.tmp', quadstore_path)
+
+
+_loaded_ontologies = {}
+_load_lock = threading.Lock()
+
+def load_ontology(ontology_folder='.'):
+    """
+    Loads the ontology persisted in the quadstore of a folder, or builds it in memory if there is no quadstore.
+    The quadstore is opened read only and copied to memory, so individuals created during inference never reach the
+    file. Every folder is loaded once per process, on its first use, with the individuals of its state rules kept on
+    the ontology as rule_individuals.
+    :param ontology_folder: str, folder of the quadstore
+    :return: the loaded ontology
+    """
+    quadstore_path = os.path.abspath(os.path.join(ontology_folder, QUADSTORE_FILE))
+    with _load_lock:
+        if quadstore_path not in _loaded_ontologies:
+            if os.path.exists(quadstore_path):
+                world = World(filename=quadstore_path, read_only=True, exclusive=False)
+                world.set_backend(filename=":memory:")  # Copies the quadstore to memory
+                onto = world.get_ontology(ONTOLOGY_IRI).load()
+            else:
+                onto = build_ontology()
+            onto.rule_individuals = RuleIndividuals(onto)
+            _loaded_ontologies[quadstore_path] = onto
+        return _loaded_ontologies[quadstore_path]
+
 
+class RuleIndividuals:
+    """
+    The individuals of an ontology returned by the state rules, as attributes named by their python names
+    """
 
-    class fever(DataProperty):
-        domain = [Symptom]
-        range = [float]
+    def __init__(self, onto):
+        for individuals in [HEMOGLOBIN_STATE_INDIVIDUALS, HEMATOLOGICAL_STATE_INDIVIDUALS,
+                            SYSTEMIC_TOXICITY_INDIVIDUALS, TREATMENT_INDIVIDUALS]:
+            for python_name, individual_name in individuals.items():
+                individual = onto[individual_name]
+                if individual is None:
+                    raise ValueError(f'Individual {individual_name} is missing from the ontology, '
+                                     f'rebuild it with "python build_ontology.py"')
+                setattr(self, python_name, individual)
 
 
-    class chills(DataProperty):
-        domain = [Symptom]
-        range = [str]
+# Lightweight stand-ins for the Patient and Symptom individuals.
+# The state rules below only read and write properties, so they run on these records as well,
+# without creating individuals in the ontology.
+class PatientRecord:
+    __slots__ = ('gender', 'hemoglobin_level', 'wbc_level', 'has_symptom', 'has_hemoglobin_state',
+                 'has_hematological_state', 'has_systemic_toxicity', 'has_treatment')
 
+    def __init__(self):
+        for attr in self.__slots__:
+            setattr(self, attr, [])
 
-    class skin_look(DataProperty):
-        domain = [Symptom]
-        range = [str]
 
+class SymptomRecord:
+    __slots__ = ('fever', 'chills', 'skin_look', 'allergic_state')
 
-    class allergic_state(DataProperty):
-        domain = [Symptom]
-        range = [str]
+    def __init__(self):
+        for attr in self.__slots__:
+            setattr(self, attr, [])
 
 
 # Define functions to determine states
-def determine_hemoglobin_state(patient):
+def determine_hemoglobin_state(patient, onto):
+    individuals = onto.rule_individuals
     if not patient.gender or not patient.hemoglobin_level:
         raise ValueError("Gender and hemoglobin level cannot be None")
     hemoglobin_level = patient.hemoglobin_level[0]
     gender = patient.gender[0]
     if gender == "Male":
         if hemoglobin_level < 9:
-            return severe_anemia
+            return individuals.severe_anemia
         elif hemoglobin_level < 11:
-            return moderate_anemia
+            return individuals.moderate_anemia
         elif hemoglobin_level < 13:
-            return mild_anemia
+            return individuals.mild_anemia
         elif hemoglobin_level < 16:
-            return normal_hemoglobin
+            return individuals.normal_hemoglobin
         else:
-            return polycythemia
+            return individuals.polycythemia
     elif gender == "Female":
         if hemoglobin_level < 8:
-            return severe_anemia
+            return individuals.severe_anemia
         elif hemoglobin_level < 10:
-            return moderate_anemia
+            return individuals.moderate_anemia
         elif hemoglobin_level < 12:
-            return mild_anemia
+            return individuals.mild_anemia
         elif hemoglobin_level < 14:
-            return normal_hemoglobin
+            return individuals.normal_hemoglobin
         else:
-            return polycythemia
+            return individuals.polycythemia
 
 
-def determine_hematological_state(patient):
+def determine_hematological_state(patient, onto):
+    individuals = onto.rule_individuals
     if not patient.gender or not patient.hemoglobin_level or not patient.wbc_level:
         raise ValueError("Gender, hemoglobin level, and WBC level cannot be None")
     hemoglobin_level = patient.hemoglobin_level[0]
@@ -168,50 +273,51 @@ def determine_hematological_state(patient):
     if gender == "Male":
         if hemoglobin_level < 13:
             if wbc_level < 4000:
-                return pancytopenia
+                return individuals.pancytopenia
             elif wbc_level < 10000:
-                return anemia
+                return individuals.anemia
             else:
-                return suspected_leukemia
+                return individuals.suspected_leukemia
         elif hemoglobin_level < 16:
             if wbc_level < 4000:
-                return leukopenia
+                return individuals.leukopenia
             elif wbc_level < 10000:
-                return normal_hematological
+                return individuals.normal_hematological
             else:
-                return leukemoid_reaction
+                return individuals.leukemoid_reaction
         else:
             if wbc_level < 4000:
-                return suspected_polycythemia_vera
+                return individuals.suspected_polycythemia_vera
             elif wbc_level < 10000:
-                return polyhemia
+                return individuals.polyhemia
             else:
-                return suspected_polycythemia_vera
+                return individuals.suspected_polycythemia_vera
     elif gender == "Female":
         if hemoglobin_level < 12:
             if wbc_level < 4000:
-                return pancytopenia
+                return individuals.pancytopenia
             elif wbc_level < 10000:
-                return anemia
+                return individuals.anemia
             else:
-                return suspected_leukemia
+                return individuals.suspected_leukemia
         elif hemoglobin_level < 14:
             if wbc_level < 4000:
-                return leukopenia
+                return individuals.leukopenia
             elif wbc_level < 10000:
-                return normal_hematological
+                return individuals.normal_hematological
             else:
-                return leukemoid_reaction
+                return individuals.leukemoid_reaction
         else:
             if wbc_level < 4000:
-                return suspected_polycythemia_vera
+                return individuals.suspected_polycythemia_vera
             elif wbc_level < 10000:
-                return polyhemia
+                return individuals.polyhemia
             else:
-                return suspected_polycythemia_vera
+                return individuals.suspected_polycythemia_vera
 
 
-def determine_systemic_toxicity(patient):
+def determine_systemic_toxicity(patient, onto):
+    individuals = onto.rule_individuals
     if not patient.has_symptom:
         raise ValueError("Patient does not have symptoms")
     grades = []
@@ -220,48 +326,49 @@ def determine_systemic_toxicity(patient):
     if symptom.fever:
         fever = symptom.fever[0]
         if fever >= 40.0:
-            grades.append(grade_iii)
+            grades.append(individuals.grade_iii)
         elif fever >= 38.5:
-            grades.append(grade_ii)
+            grades.append(individuals.grade_ii)
         else:
-            grades.append(grade_i)
+            grades.append(individuals.grade_i)
 
     if symptom.chills:
         chills = symptom.chills[0]
         if chills == "Rigor":
-            grades.append(grade_iii)
+            grades.append(individuals.grade_iii)
         elif chills == "Shaking":
-            grades.append(grade_ii)
+            grades.append(individuals.grade_ii)
         else:
-            grades.append(grade_i)
+            grades.append(individuals.grade_i)
 
     if symptom.skin_look:
         skin_look = symptom.skin_look[0]
         if skin_look == "Exfoliation":
-            grades.append(grade_iv)
+            grades.append(individuals.grade_iv)
         elif skin_look == "Desquamation":
-            grades.append(grade_iii)
+            grades.append(individuals.grade_iii)
         elif skin_look == "Vesiculation":
-            grades.append(grade_ii)
+            grades.append(individuals.grade_ii)
         else:
-            grades.append(grade_i)
+            grades.append(individuals.grade_i)
 
     if symptom.allergic_state:
         allergic_state = symptom.allergic_state[0]
         if allergic_state == "Anaphylactic Shock":
-            grades.append(grade_iv)
+            grades.append(individuals.grade_iv)
         elif allergic_state == "Severe Bronchospasm":
-            grades.append(grade_iii)
+            grades.append(individuals.grade_iii)
         elif allergic_state == "Bronchospasm":
-            grades.append(grade_ii)
+            grades.append(individuals.grade_ii)
         else:
-            grades.append(grade_i)
+            grades.append(individuals.grade_i)
 
     if grades:
         return max(grades, key=lambda x: ["Grade_I", "Grade_II", "Grade_III", "Grade_IV"].index(x.name))
 
 
-def determine_treatment(patient):
+def determine_treatment(patient, onto):
+    individuals = onto.rule_individuals
     if not patient.gender or not patient.has_hemoglobin_state or not patient.has_hematological_state or not patient.has_systemic_toxicity:
         raise ValueError("Gender, hemoglobin state, hematological state, and systemic toxicity cannot be None")
 
@@ -272,31 +379,31 @@ def determine_treatment(patient):
 
     # Define treatment based on the classification table
     if gender == "Male":
-        if hemoglobin_state == severe_anemia and hematological_state == pancytopenia and systemic_toxicity == grade_i:
-            return M_I
-        elif hemoglobin_state == moderate_anemia and hematological_state == anemia and systemic_toxicity == grade_ii:
-            return M_II
-        elif hemoglobin_state == mild_anemia and hematological_state == suspected_leukemia and systemic_toxicity == grade_iii:
-            return M_III
-        elif hemoglobin_state == normal_hemoglobin and hematological_state == leukemoid_reaction and systemic_toxicity == grade_iv:
-            return M_IV
-        elif hemoglobin_state == polycythemia and hematological_state == suspected_polycythemia_vera and systemic_toxicity == grade_iv:
-            return M_V
+        if hemoglobin_state == individuals.severe_anemia and hematological_state == individuals.pancytopenia and systemic_toxicity == individuals.grade_i:
+            return individuals.M_I
+        elif hemoglobin_state == individuals.moderate_anemia and hematological_state == individuals.anemia and systemic_toxicity == individuals.grade_ii:
+            return individuals.M_II
+        elif hemoglobin_state == individuals.mild_anemia and hematological_state == individuals.suspected_leukemia and systemic_toxicity == individuals.grade_iii:
+            return individuals.M_III
+        elif hemoglobin_state == individuals.normal_hemoglobin and hematological_state == individuals.leukemoid_reaction and systemic_toxicity == individuals.grade_iv:
+            return individuals.M_IV
+        elif hemoglobin_state == individuals.polycythemia and hematological_state == individuals.suspected_polycythemia_vera and systemic_toxicity == individuals.grade_iv:
+            return individuals.M_V
 
     elif gender == "Female":
-        if hemoglobin_state == severe_anemia and hematological_state == pancytopenia and systemic_toxicity == grade_i:
-            return F_I
-        elif hemoglobin_state == moderate_anemia and hematological_state == anemia and systemic_toxicity == grade_ii:
-            return F_II
-        elif hemoglobin_state == mild_anemia and hematological_state == suspected_leukemia and systemic_toxicity == grade_iii:
-            return F_III
-        elif hemoglobin_state == normal_hemoglobin and hematological_state == leukemoid_reaction and systemic_toxicity == grade_iv:
-            return F_IV
-        elif hemoglobin_state == polycythemia and hematological_state == suspected_polycythemia_vera and systemic_toxicity == grade_iv:
-            return F_V
+        if hemoglobin_state == individuals.severe_anemia and hematological_state == individuals.pancytopenia and systemic_toxicity == individuals.grade_i:
+            return individuals.F_I
+        elif hemoglobin_state == individuals.moderate_anemia and hematological_state == individuals.anemia and systemic_toxicity == individuals.grade_ii:
+            return individuals.F_II
+        elif hemoglobin_state == individuals.mild_anemia and hematological_state == individuals.suspected_leukemia and systemic_toxicity == individuals.grade_iii:
+            return individuals.F_III
+        elif hemoglobin_state == individuals.normal_hemoglobin and hematological_state == individuals.leukemoid_reaction and systemic_toxicity == individuals.grade_iv:
+            return individuals.F_IV
+        elif hemoglobin_state == individuals.polycythemia and hematological_state == individuals.suspected_polycythemia_vera and systemic_toxicity == individuals.grade_iv:
+            return individuals.F_V
 
     raise ValueError("No matching treatment found for the given conditions.")
 
 
-# Save the ontology
-onto.save(file="cdss.owl", format="rdfxml")
\ No newline at end of file
+if __name__ == "__main__":
+    save_ontology(sys.argv[1] if len(sys.argv) > 1 else ".")
@@ -0,0 +1,176 @@
+import json
+import os
+import zlib
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from compact_table import concat_medical_data
+
+
+def _to_json_value(value):
+    """
+    json.dumps fallback for the pandas / numpy values stored in the medical data
+    """
+    if isinstance(value, datetime):  # Also covers pandas Timestamps
+        return value.isoformat()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'Object of type {type(value).__name__} can not be journaled')
+
+
+class ChangeJournal:
+    """
+    Append-only journal of the changes made to the patients medical data.
+    Each line is a json record of either a new row version ('insert') or a delete tombstone ('delete'),
+    both pointing to the row label in the medical data so replaying the journal is idempotent.
+    Changes that must be applied together are journaled as a single 'batch' record holding their records.
+    A compaction closes the journal it folds with a 'compacted' record identifying the new base file, so the folded
+    records are not applied again if the compaction stops after the base file was replaced.
+    """
+
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+        self.compacting_path = journal_path + '.compacting'
+        self.entries_count = 0
+
+    def append(self, records):
+        """
+        Appends records to the journal with a single fsync'd write
+        :param records: list of dictionaries
+        :return:
+        """
+        lines = ''.join(json.dumps(record, default=_to_json_value) + '\n' for record in records)
+        with open(self.journal_path, 'a', encoding='utf-8') as journal_file:
+            journal_file.write(lines)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        self.entries_count += len(records)
+
+    def read(self, base_file_path=None):
+        """
+        Reads all the records that were not folded into the base file yet, oldest first.
+        A partially written last line (crash during append) is ignored.
+        :param base_file_path: str, path of the base file, to skip the records a compaction already folded into it
+        :return: list of dictionaries
+        """
+        records = []
+        for path in [self.compacting_path, self.journal_path]:
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as journal_file:
+                for line in journal_file:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        break
+            compacted = [i for i, record in enumerate(records) if record['op'] == 'compacted']
+            if path == self.compacting_path and compacted and base_file_path is not None and \
+                    _holds_compaction(base_file_path, records[compacted[-1]]):
+                records = records[compacted[-1] + 1:]  # The compaction stopped after replacing the base file
+        records = [record for record in records if record['op'] != 'compacted']
+        self.entries_count = len(records)
+        return records
+
+    def rotate(self):
+        """
+        Moves the current journal aside for compaction, new records are appended to a fresh journal
+        :return: True if there was anything to compact
+        """
+        if os.path.exists(self.compacting_path):  # A previous compaction did not finish, fold it as well
+            with open(self.compacting_path, 'a', encoding='utf-8') as compacting_file:
+                if os.path.exists(self.journal_path):
+                    with open(self.journal_path, 'r', encoding='utf-8') as journal_file:
+                        compacting_file.write(journal_file.read())
+                compacting_file.flush()
+                os.fsync(compacting_file.fileno())
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+        elif os.path.exists(self.journal_path):
+            os.replace(self.journal_path, self.compacting_path)
+        else:
+            return False
+        self.entries_count = 0
+        return True
+
+    def mark_compacted(self, base_file_path):
+        """
+        Closes the rotated journal with a record identifying the base file it is folded into - its size and checksum.
+        Called once the new base file is written, before it replaces the old one.
+        :param base_file_path: str, path of the new base file
+        :return:
+        """
+        with open(base_file_path, 'rb') as base_file:
+            base_bytes = base_file.read()
+        record = {'op': 'compacted', 'bytes': len(base_bytes), 'crc': zlib.crc32(base_bytes)}
+        with open(self.compacting_path, 'a', encoding='utf-8') as compacting_file:
+            compacting_file.write(json.dumps(record) + '\n')
+            compacting_file.flush()
+            os.fsync(compacting_file.fileno())
+
+    def finish_compaction(self):
+        """
+        Removes the rotated journal once its records are stored in the base file
+        """
+        if os.path.exists(self.compacting_path):
+            os.remove(self.compacting_path)
+
+
+def _holds_compaction(base_file_path, compacted_record):
+    """
+    :return: True if the base file starts with the file written by the compaction of a 'compacted' record - rows may
+             have been appended to it since
+    """
+    if not os.path.exists(base_file_path):
+        return False
+    with open(base_file_path, 'rb') as base_file:
+        base_bytes = base_file.read(compacted_record['bytes'])
+    return len(base_bytes) == compacted_record['bytes'] and zlib.crc32(base_bytes) == compacted_record['crc']
+
+
+def apply_journal_records(medical_data, records):
+    """
+    Applies journal records on top of the medical data loaded from the base file.
+    Journaled rows are placed at their labels, and the rows of the base file fill the other labels in file order - so
+    rows appended to the file after a journaled change keep the labels they were ingested with.
+    :param medical_data: DataFrame of the patients medical data in the base file, in file order
+    :param records: list of journal records
+    :return: DataFrame with the journaled changes applied, labeled by row positions
+    """
+    new_rows, deleted_rows = {}, []
+    # A batch is journaled as a single line, so it is either fully applied or not at all
+    records = [batch_record for record in records
+               for batch_record in (record['records'] if record['op'] == 'batch' else [record])]
+    for record in records:
+        if record['op'] == 'insert':
+            new_rows.setdefault(record['row'], record['data'])  # A label is inserted once
+        elif record['op'] == 'delete':
+            deleted_rows.append(record['row'])
+
+    medical_data = medical_data.reset_index(drop=True)
+    if new_rows:
+        new_rows_df = pd.DataFrame(list(new_rows.values()), columns=medical_data.columns)
+        for col in new_rows_df.columns:
+            if 'Time' in col:
+                new_rows_df[col] = pd.to_datetime(new_rows_df[col])
+        new_rows_df['Deleted'] = new_rows_df['Deleted'].astype(bool)
+
+        rows_count = len(medical_data) + len(new_rows_df)
+        new_labels = np.array(list(new_rows), dtype=np.int64)
+        in_table = new_labels < rows_count
+        free_labels = np.ones(rows_count, dtype=bool)
+        free_labels[new_labels[in_table]] = False
+        free_labels = np.flatnonzero(free_labels)
+        # Rows journaled past the end of the table (the base file holds fewer rows than when they were journaled)
+        # follow the rows of the base file
+        new_labels[~in_table] = free_labels[len(medical_data):]
+        labels = np.concatenate([free_labels[:len(medical_data)], new_labels])
+        positions = np.empty(rows_count, dtype=np.int64)
+        positions[labels] = np.arange(rows_count)
+        medical_data = concat_medical_data([medical_data, new_rows_df]).iloc[positions]
+        medical_data = medical_data.set_axis(pd.RangeIndex(rows_count))
+    deleted_rows = [label for label in deleted_rows if label < len(medical_data)]
+    if deleted_rows:
+        medical_data.loc[deleted_rows, 'Deleted'] = True
+    return medical_data
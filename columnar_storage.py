@@ -0,0 +1,85 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+# Low cardinality columns that are stored dictionary encoded
+CATEGORICAL_COLUMNS = ['Patient ID', 'Test Name', 'Units', 'Gender', 'source']
+COLUMNAR_SUFFIX = '.arrow'
+
+
+def columnar_path(csv_path):
+    """
+    Returns the columnar file path matching a csv file path
+    :param csv_path: str, path of a csv data file
+    :return: str
+    """
+    return os.path.splitext(csv_path)[0] + COLUMNAR_SUFFIX
+
+
+def write_table(df, file_path, before_replace=None):
+    """
+    Writes a DataFrame as an uncompressed Arrow IPC file, so it can later be opened memory mapped.
+    Low cardinality string columns are dictionary encoded, times and time deltas keep their native types.
+    :param df: DataFrame to write
+    :param file_path: str, destination path
+    :param before_replace: callable, called with the path of the written temporary file before it replaces the
+                           destination
+    :return:
+    """
+    df = df.copy()
+    for col in df.columns:
+        if col in CATEGORICAL_COLUMNS:
+            df[col] = df[col].astype('category')
+    if 'Value' in df.columns:  # Values hold both numbers and free text
+        values = df['Value'].astype(object)
+        df['Value'] = values.where(values.isna(), values.astype(str))
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    # Write to a temporary file first, so readers never see a half written file
+    with pa.OSFile(file_path + '.tmp', 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    if before_replace is not None:
+        before_replace(file_path + '.tmp')
+    os.replace(file_path + '.tmp', file_path)
+
+
+def read_table(file_path):
+    """
+    Opens an Arrow IPC file memory mapped, and converts it to a DataFrame with the same dtypes the csv loaders create
+    :param file_path: str
+    :return: DataFrame
+    """
+    with pa.memory_map(file_path, 'r') as source:
+        table = pa.ipc.open_file(source).read_all()
+        # Decode dictionary columns to plain strings, the rest of the system works on object columns
+        columns = [col.cast(col.type.value_type) if pa.types.is_dictionary(col.type) else col
+                   for col in table.columns]
+        df = pa.table(columns, names=table.column_names).to_pandas()
+    for col in df.columns:
+        if df[col].dtype == object:  # Arrow nulls become None, csv loading gives NaN
+            df[col] = df[col].where(df[col].notna(), np.nan)
+    return df
+
+
+def convert_csv_to_columnar(db_folder='.'):
+    """
+    One shot conversion of the csv data files (including journaled changes) to columnar files
+    :param db_folder: str, folder of the db files
+    :return:
+    """
+    from dbconnector import DBConnector
+
+    db_con = DBConnector(db_folder, storage='csv')
+    db_con.compact_journal()  # The columnar file holds the journaled changes, the journal is emptied
+    db_con.storage = 'arrow'
+    db_con.save_patients_medical_data()
+    db_con.save_patients_personal_data()
+    db_con.save_loinc_data()
+
+
+if __name__ == '__main__':
+    convert_csv_to_columnar(sys.argv[1] if len(sys.argv) > 1 else '.')
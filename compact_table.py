@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+
+# Columns of the medical data held as categoricals - an integer code per row, into a small table of distinct values
+CATEGORICAL_MEDICAL_COLUMNS = ['Patient ID', 'Test Name', 'Value', 'Units']
+
+
+def compact_medical_data(medical_data):
+    """
+    Converts medical data to its compact in-memory representation - ids, test codes, values and units become
+    categoricals with sorted categories, and values are kept as text, as they are read from the csv file.
+    Times are already held as int64 nanoseconds since the epoch (datetime64[ns]), and deletion as a bool column.
+    :param medical_data: DataFrame with the medical data columns
+    :return: DataFrame in the compact representation
+    """
+    medical_data = medical_data.copy()
+    for col in CATEGORICAL_MEDICAL_COLUMNS:
+        if isinstance(medical_data[col].dtype, pd.CategoricalDtype):
+            continue
+        # Every distinct value is converted to text once - numbers and free text share the value column
+        values = pd.Categorical(medical_data[col])
+        categories, category_codes = np.unique(values.categories.astype(str), return_inverse=True)
+        # Missing values have the code -1, which picks the -1 appended after the new codes of the categories
+        codes = np.append(category_codes, -1)[values.codes]
+        medical_data[col] = pd.Categorical.from_codes(codes, categories=categories)
+    medical_data['Deleted'] = medical_data['Deleted'].astype(bool)
+    return medical_data
+
+
+def concat_medical_data(frames):
+    """
+    Concatenates medical data frames, keeping the categorical columns categorical.
+    Categories of the frames are merged, so the result can hold the values of all the frames.
+    :param frames: list of DataFrames with the medical data columns, the first in the compact representation
+    :return: DataFrame in the compact representation, labeled as the concatenated frames
+    """
+    frames = [frames[0].copy(deep=False)] + [compact_medical_data(frame) for frame in frames[1:]]
+    for col in CATEGORICAL_MEDICAL_COLUMNS:
+        categories = frames[0][col].cat.categories
+        for frame in frames[1:]:
+            categories = categories.union(frame[col].cat.categories)
+        for frame in frames:
+            if not frame[col].cat.categories.equals(categories):  # Recodes the column only if it gained categories
+                frame[col] = frame[col].cat.set_categories(categories)
+    return pd.concat(frames)
+
+
+def parse_numeric_values(values, test_names, numeric_tests):
+    """
+    Parses the values of the numeric tests - every distinct value is parsed once
+    :param values: categorical Series of values
+    :param test_names: categorical Series of the loinc nums of the values
+    :param numeric_tests: collection of the loinc nums of the numeric tests
+    :return: float64 Series with the same index, NaN for coded tests and where the value is not a number
+    """
+    category_numbers = pd.to_numeric(values.cat.categories.to_series(), errors='coerce').to_numpy(dtype=np.float64)
+    # Missing values have the code -1, which picks the NaN appended after the numbers of the categories
+    numbers = np.append(category_numbers, np.nan)[values.cat.codes.to_numpy()]
+    numbers[~is_numeric_test(test_names, numeric_tests)] = np.nan
+    return pd.Series(numbers, index=values.index)
+
+
+def is_numeric_test(test_names, numeric_tests):
+    """
+    :param test_names: Series of loinc nums, categorical or not
+    :param numeric_tests: collection of the loinc nums of the numeric tests
+    :return: bool array, True where the test is numeric
+    """
+    if isinstance(test_names.dtype, pd.CategoricalDtype):  # Checked once per distinct test
+        category_numeric = test_names.cat.categories.astype(str).str.strip().isin(list(numeric_tests))
+        return np.append(category_numeric, False)[test_names.cat.codes.to_numpy()]
+    return test_names.astype(str).str.strip().isin(list(numeric_tests)).to_numpy()
+
+
+def find_invalid_values(test_names, values, numeric_tests):
+    """
+    Checks values against the type of their tests - numeric tests need a finite number, coded tests any value
+    :param test_names: Series of loinc nums
+    :param values: Series of the values, as given or categorical
+    :param numeric_tests: collection of the loinc nums of the numeric tests
+    :return: bool array, True where the value is invalid
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):  # Every distinct value is checked once
+        categories = values.cat.categories.to_series()
+        category_numbers = pd.to_numeric(categories, errors='coerce').to_numpy(dtype=np.float64)
+        category_blank = (categories.astype(str).str.strip() == '').to_numpy()
+        # Missing values have the code -1, which picks the missing value appended after the categories
+        codes = values.cat.codes.to_numpy()
+        numbers = np.append(category_numbers, np.nan)[codes]
+        missing = np.append(category_blank, True)[codes]
+    else:
+        values = pd.Series(values.to_numpy(dtype=object))
+        numbers = pd.to_numeric(values, errors='coerce').to_numpy(dtype=np.float64)
+        missing = values.isna().to_numpy() | (values.astype(str).str.strip() == '').to_numpy()
+    return missing | (is_numeric_test(test_names, numeric_tests) & ~np.isfinite(numbers))
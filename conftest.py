@@ -0,0 +1,22 @@
+import shutil
+
+import pytest
+
+from dbconnector import DBConnector, LOINC_DATA_FILE, MEDICAL_DATA_FILE, PERSONAL_DATA_FILE
+
+DATA_FILES = [MEDICAL_DATA_FILE, PERSONAL_DATA_FILE, LOINC_DATA_FILE]
+
+
+@pytest.fixture
+def db_folder(tmp_path):
+    """
+    A db folder holding copies of the data files of the repository
+    """
+    for file_name in DATA_FILES:
+        shutil.copy(file_name, tmp_path / file_name)
+    return tmp_path
+
+
+@pytest.fixture
+def connector(db_folder):
+    return DBConnector(str(db_folder))
@@ -0,0 +1,64 @@
+import os
+import threading
+
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+
+
+class DataSourceWatcher(FileSystemEventHandler):
+    """
+    Watches the data source files of a DSS engine, and reloads only the data source whose file changed.
+    Reloads are delayed until the file stops changing for a short while, so a file is never read in the middle of a
+    write. Changes written by the engine itself are recognized by the db connector and not reloaded.
+    """
+
+    def __init__(self, dss, debounce_seconds=0.5):
+        """
+        :param dss: DSSEngine to reload
+        :param debounce_seconds: float, quiet time after the last change of a file before it is reloaded
+        """
+        self.dss = dss
+        self.debounce_seconds = debounce_seconds
+        self.source_paths = dss.db_con.get_data_source_paths()
+        self._timers = {}
+        self._lock = threading.Lock()
+        self.observer = Observer()
+        for folder in {os.path.dirname(path) for path in self.source_paths}:
+            self.observer.schedule(self, folder, recursive=False)
+
+    def start(self):
+        self.observer.daemon = True
+        self.observer.start()
+        return self
+
+    def stop(self):
+        self.observer.stop()
+        self.observer.join()
+        with self._lock:
+            for timer in self._timers.values():
+                timer.cancel()
+
+    def on_any_event(self, event):
+        # Files written atomically show up as the destination of a move
+        for path in [event.src_path, getattr(event, 'dest_path', '')]:
+            file_name = self.source_paths.get(os.path.abspath(path)) if path else None
+            if file_name is not None and not event.is_directory:
+                self._schedule_reload(file_name)
+
+    def _schedule_reload(self, file_name):
+        with self._lock:
+            if file_name in self._timers:
+                self._timers[file_name].cancel()
+            timer = threading.Timer(self.debounce_seconds, self._reload, args=(file_name,))
+            timer.daemon = True
+            self._timers[file_name] = timer
+            timer.start()
+
+    def _reload(self, file_name):
+        with self._lock:
+            self._timers.pop(file_name, None)
+        try:
+            if self.dss.reload_data_source(file_name):
+                print(f'Reloaded {file_name}')
+        except Exception as e:  # Keep serving the previous data, the next change will be picked up
+            print(f'Failed to reload {file_name}: {e}')
@@ -1,34 +1,200 @@
+import numpy as np
 import pandas as pd
+import copy
+import io
+import logging
 import os
 from datetime import datetime, timedelta
 import pytz
-
-
-
+import threading
+
+from as_of_snapshots import AsOfSnapshots
+from bitemporal_index import BitemporalIndex
+from change_journal import ChangeJournal, apply_journal_records
+from columnar_storage import columnar_path, read_table, write_table
+from compact_table import (CATEGORICAL_MEDICAL_COLUMNS, compact_medical_data, concat_medical_data,
+                           find_invalid_values, is_numeric_test, parse_numeric_values)
+from metrics import instrument_public_methods
+from query_cache import QueryCache
+
+logger = logging.getLogger(__name__)
+
+# Number of bytes kept from the end of the last read of the medical data file, to recognize it was not rewritten
+READ_POSITION_TAIL_SIZE = 64
+
+# Files of the data sources, in the db folder
+MEDICAL_DATA_FILE = 'patient_data.csv'
+PERSONAL_DATA_FILE = 'patients.csv'
+LOINC_DATA_FILE = 'loinc_data.csv'
+# Entries of the medical data file with invalid values, set aside when the base file is rewritten
+QUARANTINE_DATA_FILE = 'patient_data_quarantine.csv'
+
+# Format of the times given as text in batches of measurements and corrections, as entered in the app
+INPUT_TIME_FORMAT = '%d.%m.%Y %H:%M'
+
+MEDICAL_DATA_COLUMNS = ['Patient ID', 'Test Name', 'Value', 'Units', 'Valid Start Time', 'Valid End Time',
+                        'Transaction Time', 'Deleted']
+
+
+def _file_signature(file_path):
+    """
+    :return: (modification time, size) of a file, None if it does not exist
+    """
+    try:
+        file_stat = os.stat(file_path)
+    except OSError:
+        return None
+    return file_stat.st_mtime_ns, file_stat.st_size
+
+
+def _parse_input_times(times):
+    """
+    Parses the times of a batch of measurements or corrections. Text is parsed with INPUT_TIME_FORMAT only, so no
+    format is inferred from the batch, and datetime objects are kept as they are.
+    :param times: Series of times, as text or datetime objects
+    :return: datetime64 Series, NaT where a time is missing or can not be parsed
+    """
+    parsed_times = pd.Series(pd.NaT, index=times.index, dtype='datetime64[ns]')
+    is_text = times.map(lambda time: isinstance(time, str))
+    parsed_times[is_text] = pd.to_datetime(times[is_text].str.strip(), format=INPUT_TIME_FORMAT, errors='coerce')
+    is_datetime = times.map(lambda time: isinstance(time, (datetime, np.datetime64)))
+    parsed_times[is_datetime] = pd.to_datetime(times[is_datetime].tolist())
+    return parsed_times
+
+
+class DataState:
+    """
+    The loinc catalog and the patients medical data, with all the structures derived from them.
+    A reload builds a new state and swaps it in as a single object, so a reader that takes the state once never sees
+    structures of different versions of the data.
+    """
+
+    def __init__(self, loinc_data, test2loincmap, numeric_tests, test_windows, patients_medical_data=None,
+                 medical_data_index=None, validity_windows=None, numeric_values=None):
+        self.loinc_data, self.test2loincmap = loinc_data, test2loincmap
+        self.numeric_tests, self.test_windows = numeric_tests, test_windows
+        self.patients_medical_data, self.medical_data_index = patients_medical_data, medical_data_index
+        self.validity_windows, self.numeric_values = validity_windows, numeric_values
+        self.as_of_snapshots = None  # Built on the first point of view query of the whole ward
+
+
+def _data_state_attribute(name):
+    """
+    :return: property reading and writing an attribute of the current data state of a connector
+    """
+    return property(lambda self: getattr(self.data_state, name),
+                    lambda self, value: setattr(self.data_state, name, value))
+
+
+@instrument_public_methods
 class DBConnector:
-    def __init__(self, db_folder=''):
+    # The structures of the current data state. Incremental changes swap in a new state holding grown copies of them,
+    # under the connector lock - only the deleted flags of rows are set in place
+    loinc_data = _data_state_attribute('loinc_data')
+    test2loincmap = _data_state_attribute('test2loincmap')
+    numeric_tests = _data_state_attribute('numeric_tests')
+    test_windows = _data_state_attribute('test_windows')
+    patients_medical_data = _data_state_attribute('patients_medical_data')
+    medical_data_index = _data_state_attribute('medical_data_index')
+    validity_windows = _data_state_attribute('validity_windows')
+    numeric_values = _data_state_attribute('numeric_values')
+    as_of_snapshots = _data_state_attribute('as_of_snapshots')
+
+    def __init__(self, db_folder='', journal_compaction_threshold=1000, storage='csv', query_cache_size=1024):
+        """
+        :param db_folder: str, folder of the db files
+        :param journal_compaction_threshold: int, number of journaled changes that triggers a compaction
+        :param storage: str, 'csv' to use the csv files, 'arrow' to use the columnar files
+                        (created by columnar_storage.convert_csv_to_columnar)
+        :param query_cache_size: int, maximal number of cached retrieval results, 0 disables the cache
+        """
         # self.type = type
+        if storage not in ('csv', 'arrow'):
+            raise ValueError(f'Unknown storage backend {storage}')
         self.db_folder_path = db_folder
-        self.patients_medical_data = self.load_patients_medical_data()
-        self.patients_personal_data, self.id2name_map, self.name2id_map = self.load_patients_personal_data()
-        self.loinc_data, self.test2loincmap = self.load_loinc_data()
+        self.storage = storage
+
+        # Changes are appended to a journal, and folded into the base file by a background compaction
+        self.journal = ChangeJournal(os.path.join(self.db_folder_path, 'patient_data.journal'))
+        self.journal_compaction_threshold = journal_compaction_threshold
+        self._write_lock = threading.RLock()
+        self._compaction_thread = None
+        # Signatures of the data source files as last loaded or saved by this connector
+        self.source_signatures = {}
+        # Bytes of the medical data file already read, its header and the bytes just before the read position
+        self.medical_data_read_position = None
+
+        # Bumped on every change of the data, cached results of older versions are never served
+        self.data_version = 0
+        self.query_cache = QueryCache(query_cache_size)
+
+        # The loinc catalog is loaded first, the values of the medical data are checked against the types of its tests
+        self.load_reference_data()
+        self.open_medical_data()
+
+    def open_medical_data(self):
+        """
+        Loads the patients medical data from its base file and journal, and builds the data state of it
+        :return:
+        """
+        medical_data = apply_journal_records(self.load_patients_medical_data(), self.read_journal())
+        self.data_state = self.build_data_state(self.loinc_data, self.test2loincmap, medical_data)
+
+    def build_data_state(self, loinc_data, test2loincmap, medical_data=None):
+        """
+        Builds a data state - indexes the medical data, and computes its validity windows and numeric values
+        :param loinc_data: DataFrame of the loinc catalog
+        :param test2loincmap: dictionary of test name to loinc num
+        :param medical_data: DataFrame of the patients medical data, None for a state of the loinc catalog only
+        :return: DataState
+        """
+        numeric_tests = self.get_numeric_tests(loinc_data)
+        data_state = DataState(loinc_data, test2loincmap, numeric_tests, self.get_test_windows(loinc_data))
+        if medical_data is not None:
+            data_state.patients_medical_data = medical_data
+            data_state.medical_data_index = BitemporalIndex(medical_data)
+            data_state.validity_windows = self.get_validity_windows(medical_data, loinc_data)
+            data_state.numeric_values = parse_numeric_values(medical_data['Value'], medical_data['Test Name'],
+                                                             numeric_tests)
+        return data_state
+
+    def load_reference_data(self):
+        """
+        Loads the patients personal data and the loinc catalog
+        :return:
+        """
         self.local_tz = pytz.timezone('Asia/Jerusalem')
+        self.refresh_patients_personal_data()
+        self.data_state = self.build_data_state(*self.load_loinc_data())
 
-        # Create patients dictionary for easier retrival
-        self.patients_dict = {}
-        for i, row in self.patients_personal_data.iterrows():
-            self.patients_dict[row['ID']] = {'Name': row['First Name'] + ' ' + row['Last Name'],
-                                             'Gender': row['Gender'],
-                                             'Age': row['Age']}
+    def refresh_patients_personal_data(self):
+        """
+        Loads the patients personal data, with the maps between names and ids and the patients dictionary
+        :return:
+        """
+        patients_personal_data, id2name_map, name2id_map = self.load_patients_personal_data()
 
-    def load_patients_personal_data(self, patients_csv_path='patients.csv'):
+        # Create patients dictionary for easier retrival
+        patients_dict = {}
+        for i, row in patients_personal_data.iterrows():
+            patients_dict[row['ID']] = {'Name': row['First Name'] + ' ' + row['Last Name'],
+                                        'Gender': row['Gender'],
+                                        'Age': row['Age']}
+        self.patients_personal_data, self.id2name_map, self.name2id_map = patients_personal_data, id2name_map, name2id_map
+        self.patients_dict = patients_dict
+
+    def load_patients_personal_data(self, patients_csv_path=PERSONAL_DATA_FILE):
         """
         Loads patients personal data, and returns it with 2-d mapping between names and patients ids
         :param patients_csv_path:
         :return:
         """
-        file_path = os.path.join(self.db_folder_path, patients_csv_path)
-        patients_csv = pd.read_csv(file_path)
+        file_path = self.get_data_source_path(patients_csv_path)
+        self.source_signatures[file_path] = _file_signature(file_path)
+        if self.storage == 'arrow':
+            patients_csv = read_table(file_path)
+        else:
+            patients_csv = pd.read_csv(file_path)
 
         id2name_map, name2id_map = {}, {}
         for i, row in patients_csv.iterrows():
@@ -38,47 +204,294 @@ class DBConnector:
             name2id_map[name] = id
         return patients_csv, id2name_map, name2id_map
 
-    def load_patients_medical_data(self, patients_data_path='patient_data.csv'):
+    def load_patients_medical_data(self, patients_data_path=MEDICAL_DATA_FILE):
         """
-        Loads data from csv file
+        Loads data from csv file. Entries with invalid values are set aside.
         :param patients_data_path:
+        :return: DataFrame in the compact representation, labeled by row positions
+        """
+        file_path = self.get_data_source_path(patients_data_path)
+        self.source_signatures[file_path] = _file_signature(file_path)
+        self.quarantined_medical_data = []  # The whole file is read again
+        if self.storage == 'arrow':  # Columnar files already hold typed columns
+            patients_data = compact_medical_data(read_table(file_path))
+        else:
+            with open(file_path, 'rb') as data_file:
+                file_bytes = data_file.read()
+            self._set_medical_data_read_position(file_bytes)
+            patients_data_csv = pd.read_csv(io.BytesIO(file_bytes))
+            self.medical_data_time_formats = {}
+            patients_data = compact_medical_data(self.parse_medical_data_columns(patients_data_csv))
+        return self.set_aside_invalid_rows(patients_data).reset_index(drop=True)
+
+    def set_aside_invalid_rows(self, medical_data):
+        """
+        Sets aside the entries whose value does not match the type of their test - a missing value, or a value that is
+        not a finite number for a numeric test - so they never reach the state rules.
+        The entries set aside are not part of the medical data, so no query returns them - historic retrieval included.
+        They are kept in quarantined_medical_data, and moved to the quarantine file when the base file is rewritten.
+        Their number is logged as a warning of this module's logger, with no patient data.
+        :param medical_data: DataFrame of entries read from the medical data file
+        :return: DataFrame of the valid entries
+        """
+        invalid_values = find_invalid_values(medical_data['Test Name'], medical_data['Value'], self.numeric_tests)
+        if not invalid_values.any():
+            return medical_data
+        logger.warning('Set aside %d medical data entries with invalid values', invalid_values.sum())
+        self.quarantined_medical_data.append(medical_data[invalid_values])
+        return medical_data[~invalid_values]
+
+    def save_quarantined_medical_data(self):
+        """
+        Appends the entries set aside since the last save to the quarantine file, before they are dropped from the
+        base file
         :return:
         """
-        file_path = os.path.join(self.db_folder_path, patients_data_path)
-        patients_data_csv = pd.read_csv(file_path)
+        if not self.quarantined_medical_data:
+            return
+        quarantined = pd.concat([rows.astype({col: object for col in CATEGORICAL_MEDICAL_COLUMNS})
+                                 for rows in self.quarantined_medical_data])
+        quarantined['Deleted'] = quarantined['Deleted'].astype(int)
+        file_path = os.path.join(self.db_folder_path, QUARANTINE_DATA_FILE)
+        quarantined[MEDICAL_DATA_COLUMNS].to_csv(file_path, mode='a', index=False,
+                                                 header=not os.path.exists(file_path))
+        self.quarantined_medical_data = []
+
+    def parse_medical_data_columns(self, patients_data_csv):
+        """
+        Converts the time columns and the deleted column of medical data read from csv.
+        The time format found for every column is kept, so rows read later are parsed the same way.
+        :param patients_data_csv: DataFrame as read from the csv file
+        :return: DataFrame with typed columns
+        """
         for col in patients_data_csv.columns:
             if 'Time' in col:
-                try:
-                    patients_data_csv[col] = pd.to_datetime(patients_data_csv[col])
-                except:
-                    patients_data_csv[col] = pd.to_datetime(patients_data_csv[col], format='%d/%m/%Y %H:%M')
+                patients_data_csv[col] = self.parse_medical_data_times(patients_data_csv[col], col)
         # Make sure deleted row is a boolean column
-        patients_data_csv['Deleted'] = patients_data_csv['Deleted'].astype(bool)
+        deleted = patients_data_csv['Deleted']
+        if deleted.dtype == object:  # Compactions write 0 / 1, rows appended after them may hold TRUE / FALSE
+            deleted = deleted.astype(str).str.strip().str.upper().isin(['1', 'TRUE'])
+        patients_data_csv['Deleted'] = deleted.astype(bool)
 
         return patients_data_csv
 
-    def load_loinc_data(self, loinc_csv_path='loinc_data.csv'):
+    def parse_medical_data_times(self, times, col):
+        """
+        Parses a time column of medical data read from csv, trying the format found for the column before.
+        A compaction writes the rows of the file in the ISO format, while rows appended after it by other writers may
+        keep their own format - a column mixing formats is parsed element by element.
+        :param times: Series of time strings
+        :param col: str, name of the time column
+        :return: datetime64 Series
+        """
+        time_formats = ['ISO8601', '%d/%m/%Y %H:%M']
+        if col in self.medical_data_time_formats:
+            time_formats.insert(0, self.medical_data_time_formats[col])
+        for time_format in time_formats:
+            try:
+                parsed_times = pd.to_datetime(times, format=time_format)
+            except ValueError:
+                continue
+            self.medical_data_time_formats[col] = time_format
+            return parsed_times
+        return pd.to_datetime(times, format='mixed', dayfirst=True)
+
+    def _set_medical_data_read_position(self, file_bytes):
+        """
+        Remembers how much of the medical data file was read
+        :param file_bytes: bytes, the whole file content that was read
+        :return:
+        """
+        header = file_bytes[:file_bytes.find(b'\n') + 1]
+        self.medical_data_read_position = (len(file_bytes), header, file_bytes[-READ_POSITION_TAIL_SIZE:])
+
+    def ingest_appended_medical_data(self):
+        """
+        Reads only the rows appended to the medical data file since it was last read, and adds them to the medical
+        data. A partially written last line is left for the next ingest.
+        :return: DataFrame of the ingested rows, or None if the file was rewritten and has to be reloaded as a whole
+        """
+        if self.storage != 'csv':
+            raise ValueError('Incremental ingest is supported for the csv storage only')
+        file_path = self.get_data_source_path(MEDICAL_DATA_FILE)
+        with self._write_lock:
+            position, header, tail = self.medical_data_read_position
+            with open(file_path, 'rb') as data_file:
+                new_bytes = self._read_unread_medical_data(data_file)
+            if new_bytes is None:
+                return None
+            new_bytes = new_bytes[:new_bytes.rfind(b'\n') + 1]
+            self.source_signatures[file_path] = _file_signature(file_path)
+            if not new_bytes.strip():
+                return self.patients_medical_data.iloc[:0]
+
+            new_rows = pd.read_csv(io.BytesIO(header + new_bytes))
+            new_rows = self.parse_medical_data_columns(new_rows)
+            self.medical_data_read_position = (position + len(new_bytes), header,
+                                               (tail + new_bytes)[-READ_POSITION_TAIL_SIZE:])
+            new_rows = self.set_aside_invalid_rows(new_rows)
+            if len(new_rows) == 0:
+                return self.patients_medical_data.iloc[:0]
+            # The journal keeps the labels of journaled rows only, on reload the file rows fill the other labels in
+            # file order - so these rows keep their labels with no rewrite of the file
+            new_rows = self.append_medical_rows(new_rows)
+        return new_rows
+
+    def _read_unread_medical_data(self, data_file):
+        """
+        :param data_file: the medical data file, opened for binary reading
+        :return: bytes appended to the medical data file since it was last read, None if it was rewritten since
+        """
+        position, header, tail = self.medical_data_read_position
+        # Make sure the file was only appended to since it was read
+        data_file.seek(max(position - len(tail), 0))
+        if data_file.read(len(tail)) != tail:
+            return None
+        return data_file.read()
+
+    def append_medical_rows(self, new_rows):
+        """
+        Adds new rows to the medical data, its index, its validity windows and its numeric values
+        :param new_rows: DataFrame with the medical data columns
+        :return: the added rows, labeled by their labels in the medical data
+        """
+        with self._write_lock:
+            # The grown structures are swapped in as a new state, readers of the current state never see them change
+            data_state = copy.copy(self.data_state)
+            new_rows = new_rows[data_state.patients_medical_data.columns].reset_index(drop=True)
+            new_rows.index += len(data_state.patients_medical_data)
+            data_state.patients_medical_data = concat_medical_data([data_state.patients_medical_data, new_rows])
+            data_state.validity_windows = pd.concat([data_state.validity_windows, self.get_validity_windows(new_rows)])
+            new_entries = data_state.patients_medical_data.loc[new_rows.index]  # With the compact column types
+            data_state.numeric_values = pd.concat([data_state.numeric_values,
+                                                   parse_numeric_values(new_entries['Value'], new_entries['Test Name'],
+                                                                        data_state.numeric_tests)])
+            data_state.medical_data_index = data_state.medical_data_index.copy()
+            data_state.medical_data_index.add_rows(new_rows)
+            self.add_as_of_rows(data_state, new_rows)
+            self.data_state = data_state
+            self.bump_data_version()
+        return new_rows
+
+    def load_loinc_data(self, loinc_csv_path=LOINC_DATA_FILE):
 
         def convert_to_time_delta(in_str):
             days, hours, minutes = map(int, in_str.split(','))
             return timedelta(days=days, hours=hours, minutes=minutes)
 
-        file_path = os.path.join(self.db_folder_path, loinc_csv_path)
-        loinc_df = pd.read_csv(file_path)
+        file_path = self.get_data_source_path(loinc_csv_path)
+        self.source_signatures[file_path] = _file_signature(file_path)
+        if self.storage == 'arrow':
+            loinc_df = read_table(file_path)
+        else:
+            loinc_df = pd.read_csv(file_path)
+            loinc_df['good_before'] = loinc_df['good_before'].apply(convert_to_time_delta)
+            loinc_df['good_after'] = loinc_df['good_after'].apply(convert_to_time_delta)
         test2loincmap = {}
         for i, row in loinc_df.iterrows():
             test_name = row['name']
             loinc_id = row['id']
             test2loincmap[test_name] = loinc_id
-        loinc_df['good_before'] = loinc_df['good_before'].apply(convert_to_time_delta)
-        loinc_df['good_after'] = loinc_df['good_after'].apply(convert_to_time_delta)
 
         return loinc_df, test2loincmap
 
+    def get_validity_windows(self, medical_data, loinc_data=None):
+        """
+        Computes the validity window of each entry, using the good before / good after deltas of its test
+        :param medical_data: DataFrame of medical data entries
+        :param loinc_data: DataFrame of the loinc catalog, defaults to the current catalog
+        :return: DataFrame with 'Window Start' and 'Window End' columns, NaT for tests not known to system
+        """
+        if loinc_data is None:
+            loinc_data = self.loinc_data
+        test_windows = loinc_data.set_index(loinc_data['id'].str.strip())
+        test_names = medical_data['Test Name'].str.strip()
+        return pd.DataFrame({'Window Start': medical_data['Valid Start Time'] - test_names.map(test_windows['good_before']),
+                             'Window End': medical_data['Valid Start Time'] + test_names.map(test_windows['good_after'])},
+                            index=medical_data.index)
+
+    def get_test_windows(self, loinc_data=None):
+        """
+        :param loinc_data: DataFrame of the loinc catalog, defaults to the current catalog
+        :return: dictionary of loinc num to its (good before, good after) timedelta64 pair
+        """
+        if loinc_data is None:
+            loinc_data = self.loinc_data
+        return {test_id.strip(): (pd.Timedelta(good_before).to_timedelta64(), pd.Timedelta(good_after).to_timedelta64())
+                for test_id, good_before, good_after in
+                zip(loinc_data['id'], loinc_data['good_before'], loinc_data['good_after'])}
+
+    def refresh_validity_windows(self):
+        """
+        Recomputes the validity windows of all the entries, needed whenever the loinc windows change
+        :return:
+        """
+        with self._write_lock:
+            data_state = copy.copy(self.data_state)
+            data_state.test_windows = self.get_test_windows(data_state.loinc_data)
+            data_state.validity_windows = self.get_validity_windows(data_state.patients_medical_data,
+                                                                    data_state.loinc_data)
+            self.data_state = data_state
+
+    def get_numeric_tests(self, loinc_data=None):
+        """
+        :param loinc_data: DataFrame of the loinc catalog, defaults to the current catalog
+        :return: set of the loinc nums of the numeric tests - the tests with units in the loinc catalog
+        """
+        if loinc_data is None:
+            loinc_data = self.loinc_data
+        units = loinc_data['units']
+        has_units = units.notna() & (units.astype(str).str.strip() != '')
+        return set(loinc_data.loc[has_units, 'id'].astype(str).str.strip())
+
+    def get_test_values(self, medical_data):
+        """
+        Reads the typed values of entries - a float for numeric tests, the value text for coded tests
+        :param medical_data: DataFrame of medical data entries, labeled by their labels in the medical data
+        :return: list of the values, in the order of the entries
+        """
+        data_state = self.data_state
+        labels = medical_data.index.to_numpy(dtype=np.int64)  # Labels are positions
+        numbers = data_state.numeric_values.to_numpy()[labels]
+        is_numeric = is_numeric_test(medical_data['Test Name'], data_state.numeric_tests)
+        return np.where(is_numeric, numbers, medical_data['Value'].to_numpy(dtype=object)).tolist()
+
+    def validate_test_values(self, test_names, values):
+        """
+        Raises ValueError if a new value does not match the type of its test
+        :param test_names: Series of loinc nums
+        :param values: Series of the new values
+        :return:
+        """
+        invalid_values = find_invalid_values(test_names, values, self.numeric_tests)
+        if invalid_values.any():
+            raise ValueError(f'{invalid_values.sum()} measurements have a missing value, or a value that is not a '
+                             f'number for a numeric test, at positions {np.flatnonzero(invalid_values)[:10].tolist()}')
+
+    def get_memory_usage(self):
+        """
+        Reports the memory held by the medical data and the per entry structures kept next to it
+        :return: dictionary with the number of rows, the bytes of every column and structure, their total and the
+                 bytes per row
+        """
+        data_state = self.data_state
+        usage = {f'column {col}': int(col_bytes) for col, col_bytes in
+                 data_state.patients_medical_data.memory_usage(deep=True).items()}
+        usage['validity windows'] = int(data_state.validity_windows.memory_usage(deep=True).sum())
+        usage['numeric values'] = int(data_state.numeric_values.memory_usage(deep=True))
+        if data_state.as_of_snapshots is not None:
+            usage['as of snapshots'] = data_state.as_of_snapshots.memory_usage()
+        rows = len(data_state.patients_medical_data)
+        total = sum(usage.values())
+        usage.update({'rows': rows, 'total': total, 'bytes per row': total / rows if rows else 0.0})
+        return usage
+
     def save_loinc_data(self):
         """
         Save the updated loinc_data DataFrame back to the CSV file.
         """
+        self.refresh_validity_windows()
+        self.bump_data_version()
 
         def timedelta_to_dhm_str(td):
             days = td.days
@@ -86,23 +499,209 @@ class DBConnector:
             minutes, _ = divmod(remainder, 60)
             return f"{days},{hours},{minutes}"
 
-        temp_df = self.loinc_data.copy()
-        temp_df['good_before'] = temp_df['good_before'].apply(timedelta_to_dhm_str)
-        temp_df['good_after'] = temp_df['good_after'].apply(timedelta_to_dhm_str)
+        file_path = self.get_data_source_path(LOINC_DATA_FILE)
+        if self.storage == 'arrow':
+            write_table(self.loinc_data, file_path)
+        else:
+            temp_df = self.loinc_data.copy()
+            temp_df['good_before'] = temp_df['good_before'].apply(timedelta_to_dhm_str)
+            temp_df['good_after'] = temp_df['good_after'].apply(timedelta_to_dhm_str)
+
+            temp_df.to_csv(file_path + '.tmp', index=False)
+            os.replace(file_path + '.tmp', file_path)
+        self.source_signatures[file_path] = _file_signature(file_path)
 
-        file_path = os.path.join(self.db_folder_path, 'loinc_data.csv')
-        temp_df.to_csv(file_path, index=False)
+    def save_patients_personal_data(self, patients_csv_path=PERSONAL_DATA_FILE):
+        """
+        Saves patients personal data back to the db
+        :param patients_csv_path:
+        :return:
+        """
+        file_path = self.get_data_source_path(patients_csv_path)
+        if self.storage == 'arrow':
+            write_table(self.patients_personal_data, file_path)
+        else:
+            self.patients_personal_data.to_csv(file_path + '.tmp', index=False)
+            os.replace(file_path + '.tmp', file_path)
+        self.source_signatures[file_path] = _file_signature(file_path)
 
-    def save_patients_medical_data(self, patients_data_path='patient_data.csv'):
+    def save_patients_medical_data(self, patients_data_path=MEDICAL_DATA_FILE, medical_data=None, before_replace=None):
         """
         Saves patients medical data back to csv
         :param patients_data_path:
+        :param medical_data: DataFrame to save, defaults to the current patients medical data
+        :param before_replace: callable, called with the path of the new file once it is written, before it replaces
+                               the old file
+        :return:
+        """
+        if medical_data is None:
+            medical_data = self.patients_medical_data
+        file_path = self.get_data_source_path(patients_data_path)
+        if self.storage == 'arrow':
+            write_table(medical_data, file_path, before_replace)
+        else:
+            temp = medical_data.copy()
+            temp['Deleted'] = temp['Deleted'].astype(int)
+            file_bytes = temp.to_csv(index=False).encode('utf-8')
+            # Rows appended to the file since it was read (e.g. by the lab feed) are kept at the end of the new file,
+            # where the next ingest reads them
+            carry_unread_rows = patients_data_path == MEDICAL_DATA_FILE and self.medical_data_read_position is not None
+            old_file = open(file_path, 'rb') if carry_unread_rows and os.path.exists(file_path) else None
+            try:
+                # Write to a temporary file first, so a crash never leaves a half written base file
+                with open(file_path + '.tmp', 'wb') as data_file:
+                    data_file.write(file_bytes)
+                    unread_bytes = self._read_unread_medical_data(old_file) if old_file is not None else None
+                    if unread_bytes is not None:  # None if the file was rewritten by others
+                        data_file.write(unread_bytes)
+                if before_replace is not None:
+                    before_replace(file_path + '.tmp')
+                os.replace(file_path + '.tmp', file_path)
+                if unread_bytes is not None:
+                    # Rows written to the old file between the read above and the replace are still read from it
+                    late_bytes = old_file.read()
+                    if late_bytes:
+                        with open(file_path, 'ab') as data_file:
+                            data_file.write(late_bytes)
+            finally:
+                if old_file is not None:
+                    old_file.close()
+            if patients_data_path == MEDICAL_DATA_FILE:
+                self._set_medical_data_read_position(file_bytes)
+        self.source_signatures[file_path] = _file_signature(file_path)
+
+    def compact_journal(self):
+        """
+        Folds the journaled changes into the base patients medical data file.
+        The connector lock is held until the new base file replaces the old one, so no change is journaled against
+        the old file meanwhile. Rows appended to the file by other writers during the rewrite are carried over.
+        :return:
+        """
+        with self._write_lock:
+            if self.storage == 'csv':  # Rows appended to the base file are read first, and written as known rows
+                self.ingest_appended_medical_data()
+            if not self.journal.rotate():
+                return
+            self.save_quarantined_medical_data()  # The base file is rewritten without them
+            self.save_patients_medical_data(before_replace=self.journal.mark_compacted)
+            self.journal.finish_compaction()
+            if self.storage == 'csv':  # The rows carried over to the new file
+                self.ingest_appended_medical_data()
+
+    def read_journal(self):
+        """
+        :return: list of the journal records not folded into the base medical data file yet
+        """
+        return self.journal.read(self.get_data_source_path(MEDICAL_DATA_FILE))
+
+    def _journal_changes(self, records):
+        """
+        Durably appends changes to the journal, and starts a background compaction once the journal is long enough
+        :param records: list of journal records
+        :return:
+        """
+        self.journal.append(records)
+        if (self.journal.entries_count >= self.journal_compaction_threshold and
+                (self._compaction_thread is None or not self._compaction_thread.is_alive())):
+            self._compaction_thread = threading.Thread(target=self.compact_journal, daemon=True)
+            self._compaction_thread.start()
+
+    def get_as_of_snapshots(self, data_state=None):
+        """
+        :param data_state: DataState to get the snapshots of, defaults to the current state
+        :return: AsOfSnapshots of the medical data of the state, built on first use
+        """
+        with self._write_lock:
+            if data_state is None:
+                data_state = self.data_state
+            if data_state.as_of_snapshots is None:
+                data_state.as_of_snapshots = AsOfSnapshots(data_state.patients_medical_data)
+            return data_state.as_of_snapshots
+
+    def add_as_of_rows(self, data_state, new_rows):
+        """
+        Adds new rows, already in the medical data and the index of a new state, to a copy of its as of snapshots.
+        Rows recorded earlier than the last recorded row can not be appended - the snapshots are rebuilt on next use.
+        :param data_state: DataState not yet swapped in
+        :param new_rows: DataFrame of the new rows, labeled by their labels in the medical data
+        :return:
+        """
+        if data_state.as_of_snapshots is None:
+            return
+        data_state.as_of_snapshots = data_state.as_of_snapshots.copy()
+        if not data_state.as_of_snapshots.add_rows(new_rows,
+                                                   data_state.medical_data_index.previous_versions(new_rows)):
+            data_state.as_of_snapshots = None
+
+    def get_data_as_of(self, pov_datetime):
+        """
+        Reconstructs the medical data as it was known at a transaction time - the latest version, recorded up to then
+        and not deleted, of every measurement of every patient
+        :param pov_datetime: datetime, the point of view
+        :return: DataFrame with a single row per (Patient ID, Test Name, Valid Start Time)
+        """
+        data_state = self.data_state
+        medical_data = data_state.patients_medical_data
+        labels = self.get_as_of_snapshots(data_state).lookup(pov_datetime, medical_data['Deleted'].to_numpy())
+        return medical_data.loc[labels]
+
+    def get_data_source_path(self, file_name):
+        """
+        :param file_name: str, csv file name of a data source
+        :return: str, path of the file the data source is stored in, with the current storage
+        """
+        file_path = os.path.join(self.db_folder_path, file_name)
+        if self.storage == 'arrow':
+            return columnar_path(file_path)
+        return file_path
+
+    def get_data_source_paths(self):
+        """
+        :return: dictionary in the form of {file path : data source file name} of the data sources that can be reloaded
+        """
+        return {os.path.abspath(self.get_data_source_path(file_name)): file_name
+                for file_name in [MEDICAL_DATA_FILE, PERSONAL_DATA_FILE, LOINC_DATA_FILE]}
+
+    def reload_data_source(self, file_name):
+        """
+        Reloads a single data source from its file, if the file changed since this connector loaded or saved it
+        :param file_name: str, csv file name of the data source - 'patient_data.csv', 'patients.csv' or 'loinc_data.csv'
+        :return: True if the data source was reloaded
+        """
+        file_path = self.get_data_source_path(file_name)
+        with self._write_lock:
+            if _file_signature(file_path) == self.source_signatures.get(file_path):
+                return False
+            if file_name == MEDICAL_DATA_FILE and self.storage == 'csv' and \
+                    self.ingest_appended_medical_data() is not None:
+                return True  # Rows were appended to the file, only they were read
+            # The new state is built aside, and replaces the current state as a whole
+            if file_name == MEDICAL_DATA_FILE:
+                medical_data = apply_journal_records(self.load_patients_medical_data(), self.read_journal())
+                self.data_state = self.build_data_state(self.loinc_data, self.test2loincmap, medical_data)
+            elif file_name == PERSONAL_DATA_FILE:
+                self.refresh_patients_personal_data()
+            elif file_name == LOINC_DATA_FILE:
+                # Units and windows of the tests may have changed
+                self.data_state = self.build_data_state(*self.load_loinc_data(), self.patients_medical_data)
+            else:
+                raise ValueError(f'Unknown data source {file_name}')
+            self.bump_data_version()
+        return True
+
+    def bump_data_version(self):
+        """
+        Marks the data as changed, invalidating all cached query results
         :return:
         """
-        file_path = os.path.join(self.db_folder_path, patients_data_path)
-        temp = self.patients_medical_data.copy()
-        temp['Deleted'] = temp['Deleted'].astype(int)
-        self.patients_medical_data.to_csv(file_path, index=False)
+        self.data_version += 1
+        self.query_cache.clear()
+
+    def get_query_cache_stats(self):
+        """
+        :return: dictionary of the retrieval cache counters - size, hits, misses, evictions and hit rate
+        """
+        return self.query_cache.stats()
 
     def standartisize_datetime(self, date_str, hour_str='23:59'):
         """
@@ -142,6 +741,32 @@ class DBConnector:
         else:
             raise ValueError('Patient Name Unknown to System')
 
+    def get_retrieval_time_range(self, target_date, pov_date, target_hour=None, pov_hour=None,
+                                 historic=False, prev_date='1.1.1990', prev_hour=None):
+        """
+        Translates the time parameters of a retrieval query to the range of valid start times to retrieve,
+        and the transaction time (point of view) to filter by
+        :return: (valid_from, valid_to, pov_datetime) - pov_datetime is None for historic queries
+        """
+        if pov_hour is None:  # To retrieve the full day in case its was not supplied
+            pov_hour = '23:59'
+        if prev_hour is None:
+            prev_hour = '00:00'  # To get the full day
+
+        target_datetime = self.standartisize_datetime(target_date, target_hour)
+        if historic:
+            prev_datetime = self.standartisize_datetime(prev_date, prev_hour)
+            valid_from, valid_to = prev_datetime, target_datetime
+            if target_hour is not None:  # Only the exact measurement time is relevant
+                valid_from = max(prev_datetime, target_datetime)
+            pov_datetime = None
+        else:
+            valid_from, valid_to = target_datetime, target_datetime
+            if target_hour is None:  # Retrieve the full day
+                valid_to = self.standartisize_datetime(target_date)
+            pov_datetime = self.standartisize_datetime(pov_date, pov_hour)
+        return valid_from, valid_to, pov_datetime
+
     def retrieve_patient_data(self, patient_name, target_key, target_date, pov_date, target_hour=None, pov_hour=None,
                               historic=False, prev_date='1.1.1990', prev_hour=None):
         """
@@ -154,40 +779,39 @@ class DBConnector:
         :param pov_hour:
         :return:
         """
-        if pov_hour is None:  # To retrieve the full day in case its was not supplied
-            pov_hour = '23:59'
-        if prev_hour is None:
-            prev_hour = '00:00'  # To get the full day
-
         loinc_num = self.standartisize_target_key(target_key)
         patient_id = self.standartisize_patient(patient_name)
-        target_datetime = self.standartisize_datetime(target_date, target_hour)
-
-
-        # Creates a temporal view of the patients medical data
-        if historic:
-            prev_datetime = self.standartisize_datetime(prev_date, prev_hour)
-            temporal_view = self.patients_medical_data[
-                (self.patients_medical_data['Valid Start Time'] <= target_datetime) &
-                (self.patients_medical_data['Valid Start Time'] >= prev_datetime)]
-        else:
-            pov_datetime = self.standartisize_datetime(pov_date, pov_hour)
-            temporal_view = self.patients_medical_data[self.patients_medical_data['Transaction Time'] <= pov_datetime]
+        valid_from, valid_to, pov_datetime = self.get_retrieval_time_range(target_date, pov_date, target_hour, pov_hour,
+                                                                           historic, prev_date, prev_hour)
+
+        # Results are cached by the normalized query and the version of the data they were computed on
+        cache_key = (self.data_version, patient_id, loinc_num, valid_from, valid_to, pov_datetime, historic)
+        cached_rows = self.query_cache.get(cache_key)
+        if cached_rows is not None:
+            return cached_rows.copy()
+        req_rows = self.query_patient_data(patient_id, loinc_num, valid_from, valid_to, pov_datetime, historic)
+        self.query_cache.put(cache_key, req_rows)
+        return req_rows.copy()
+
+    def query_patient_data(self, patient_id, loinc_num, valid_from, valid_to, pov_datetime, historic):
+        """
+        Runs a normalized retrieval query on the medical data
+        :param patient_id: str, id of the patient
+        :param loinc_num: str, loinc number of the test
+        :param valid_from: datetime, earliest valid start time to retrieve
+        :param valid_to: datetime, latest valid start time to retrieve
+        :param pov_datetime: datetime, latest transaction time to retrieve, None for historic queries
+        :param historic: bool, if True retrieves all the matching entries, including deleted entries (entries set aside
+                         for invalid values are not part of the medical data, see set_aside_invalid_rows)
+        :return: DataFrame of the matching entries, most recent transaction first
+        """
+        # Uses the (patient, test) index to create a temporal view of the patients medical data
+        data_state = self.data_state
+        labels = data_state.medical_data_index.lookup(patient_id, loinc_num, valid_from, valid_to, pov=pov_datetime)
+        req_rows = data_state.patients_medical_data.loc[labels]
+        if not historic:
             # Removes deleted entries from non - historical retrieval
-            temporal_view = temporal_view[~temporal_view['Deleted'].astype('bool')]
-        patient_target_filtered_view = temporal_view[
-            (temporal_view['Patient ID'] == patient_id) & (temporal_view['Test Name'] == loinc_num)]
-
-        ## Returns only relevant scores
-        if target_hour is not None:
-            req_rows = patient_target_filtered_view[patient_target_filtered_view['Valid Start Time'] == target_datetime]
-        else:
-            if not historic:
-                req_rows = patient_target_filtered_view[
-                    (patient_target_filtered_view['Valid Start Time'] >= target_datetime) &
-                    (patient_target_filtered_view['Valid Start Time'] <= self.standartisize_datetime(target_date))]
-            else:
-                req_rows = patient_target_filtered_view
+            req_rows = req_rows[~req_rows['Deleted'].astype('bool')]
 
         req_rows_sorted = req_rows.sort_values(by='Transaction Time', ascending=False)
         if historic:
@@ -214,28 +838,199 @@ class DBConnector:
         # Data exists
         index_to_update = logs.index[0]
         if mode == 'update':
-            update_datetime = self.standartisize_datetime(update_date, update_time)
-            # create a new row and Update values and transaction time
-            new_row = self.patients_medical_data.iloc[index_to_update].copy()
-            new_row['Value'] = update_val
-            new_row['Transaction Time'] = update_datetime
-
-            # insert new row
-            self.patients_medical_data = pd.concat([self.patients_medical_data, pd.DataFrame([new_row])],
-                                                   ignore_index=True)
-            changed_row = self.patients_medical_data.iloc[-1].copy()
-        elif mode == 'delete':
-            # Changed the required row to be Deleted
-            self.patients_medical_data.loc[index_to_update, 'Deleted'] = True
-            changed_row = self.patients_medical_data.iloc[index_to_update].copy()
-
-        # Save results
-        self.save_patients_medical_data()
+            self.validate_test_values(logs['Test Name'].iloc[:1], pd.Series([update_val]))
+        with self._write_lock:
+            if mode == 'update':
+                update_datetime = self.standartisize_datetime(update_date, update_time)
+                # create a new row and Update values and transaction time
+                new_row = self.patients_medical_data.iloc[index_to_update].copy()
+                new_row['Value'] = update_val
+                new_row['Transaction Time'] = update_datetime
+                new_label = len(self.patients_medical_data)
+                self._journal_changes([{'op': 'insert', 'row': new_label, 'data': new_row.to_dict()}])
+
+                # insert new row
+                self.append_medical_rows(pd.DataFrame([new_row]))
+                changed_row = self.patients_medical_data.iloc[-1].copy()
+            elif mode == 'delete':
+                self._journal_changes([{'op': 'delete', 'row': int(index_to_update)}])
+                # Changed the required row to be Deleted
+                self.patients_medical_data.loc[index_to_update, 'Deleted'] = True
+                changed_row = self.patients_medical_data.iloc[index_to_update].copy()
+            self.bump_data_version()
 
         # Retrieve the changed row with the corresponding index
 
         return changed_row
 
+    def get_medical_data_rows(self, offset=0, limit=None, patient_ids=None):
+        """
+        Reads a page of the medical data, in the order the rows were recorded
+        :param offset: int, number of rows to skip
+        :param limit: int, maximal number of rows to return, None for all the rows after the offset
+        :param patient_ids: list of patient ids to return the rows of, None for all the patients
+        :return: DataFrame of the rows, including deleted rows
+        """
+        medical_data = self.patients_medical_data
+        if patient_ids is not None:
+            medical_data = medical_data[medical_data['Patient ID'].isin(list(patient_ids))]
+        return medical_data.iloc[offset:None if limit is None else offset + limit]
+
+    def get_patients_logs(self, patient_ids):
+        """
+        returns all the logs of a group of patients in the medical db, including deleted logs
+        :param patient_ids: list of patient ids
+        :return: DataFrame of the patients logs
+        """
+        return self.get_medical_data_rows(patient_ids=patient_ids)
+
+    def resolve_corrections(self, corrections):
+        """
+        Matches a batch of corrections to the measurements they correct, with a single join against the current view
+        of the data - the most recent, not deleted, version of every measurement.
+        :param corrections: DataFrame or iterable of dictionaries with 'Patient ID' (name or id), 'Test Name' (test
+                            name or loinc num), 'Measurement Time' and 'Action' ('update' or 'delete'), and for
+                            updates 'Value' and optionally 'Update Time' (the transaction time, defaults to now)
+        :return: report DataFrame with a row per correction, holding the label of the corrected measurement in 'Target'
+                 (-1 if there is none) and the 'Status' of the correction. If any correction is invalid, the corrections
+                 that could be applied have the status 'batch rejected', so none is applied
+        """
+        report = pd.DataFrame(corrections).reset_index(drop=True)
+        missing_columns = {'Patient ID', 'Test Name', 'Measurement Time', 'Action'} - set(report.columns)
+        if missing_columns:
+            raise ValueError(f'Corrections are missing the columns {sorted(missing_columns)}')
+        if 'Value' not in report.columns:
+            report['Value'] = np.nan
+        now = datetime.now(self.local_tz).replace(tzinfo=None, second=0, microsecond=0)
+        if 'Update Time' not in report.columns:
+            report['Update Time'] = now
+        for col in ['Measurement Time', 'Update Time']:
+            if not pd.api.types.is_datetime64_any_dtype(report[col]):
+                report[col] = _parse_input_times(report[col])
+        report['Update Time'] = report['Update Time'].fillna(pd.Timestamp(now))
+        report['Patient ID'] = report['Patient ID'].map(self.name2id_map).fillna(report['Patient ID'])
+        report['Test Name'] = report['Test Name'].map(self.test2loincmap).fillna(report['Test Name'])
+
+        report['Status'] = 'no matching measurement'
+        report.loc[~report['Action'].isin(['update', 'delete']), 'Status'] = 'unknown action'
+        invalid_values = find_invalid_values(report['Test Name'], report['Value'], self.numeric_tests)
+        report.loc[(report['Action'] == 'update') & invalid_values, 'Status'] = 'invalid value'
+        report.loc[report['Measurement Time'].isna(), 'Status'] = 'invalid measurement time'
+        report.loc[~report['Test Name'].isin(list(self.test2loincmap.values())), 'Status'] = 'unknown test'
+        report.loc[~report['Patient ID'].isin(list(self.id2name_map)), 'Status'] = 'unknown patient'
+
+        # The current view - measurements that are not deleted, and were recorded up to now
+        logs = self.get_patients_logs(report['Patient ID'].unique())
+        view = logs[~logs['Deleted'] & (logs['Transaction Time'] <= now)]
+        view = view[['Patient ID', 'Test Name', 'Valid Start Time', 'Transaction Time']].rename_axis('Target')
+        matches = (report[report['Status'] == 'no matching measurement'].reset_index()
+                   .merge(view.reset_index(), left_on=['Patient ID', 'Test Name', 'Measurement Time'],
+                          right_on=['Patient ID', 'Test Name', 'Valid Start Time'])
+                   .sort_values(['Transaction Time', 'Target'])
+                   .drop_duplicates('index', keep='last'))  # The most recent version of every measurement
+        report['Target'] = -1
+        report.loc[matches['index'], 'Target'] = matches['Target'].to_numpy()
+        report.loc[report['Target'] != -1, 'Status'] = 'applied'
+        if not report['Status'].isin(['applied', 'no matching measurement']).all():  # The batch is all or nothing
+            report.loc[report['Status'] == 'applied', 'Status'] = 'batch rejected'
+        return report
+
+    def correct_patients_data(self, corrections):
+        """
+        Applies a batch of corrections - new versions of measurements and deletions, atomically and with a single
+        write. All the corrections are matched against the data as it was before the batch. A batch holding an invalid
+        correction is not applied at all.
+        :param corrections: DataFrame or iterable of dictionaries, see resolve_corrections
+        :return: report DataFrame with a row per correction - its 'Status' ('applied', 'no matching measurement',
+                 'batch rejected' or the reason it is invalid), the label of the corrected measurement in 'Target' and of the new version
+                 in 'New Row' (-1 if there is none)
+        """
+        with self._write_lock:
+            report = self.resolve_corrections(corrections)
+            applied = report['Status'] == 'applied'
+            updates = report[applied & (report['Action'] == 'update')]
+            deletes = report[applied & (report['Action'] == 'delete')]
+
+            # New versions are copies of the corrected measurements, with the new value and transaction time
+            first_label = len(self.patients_medical_data)
+            new_rows = self.patients_medical_data.loc[updates['Target']].reset_index(drop=True)
+            new_rows['Value'] = updates['Value'].to_numpy()
+            new_rows['Transaction Time'] = updates['Update Time'].to_numpy()
+            journal_rows = new_rows.copy()
+            for col in ['Valid Start Time', 'Valid End Time', 'Transaction Time']:
+                journal_rows[col] = np.datetime_as_string(journal_rows[col].to_numpy(dtype='datetime64[s]'))
+            records = [{'op': 'insert', 'row': first_label + i, 'data': data}
+                       for i, data in enumerate(journal_rows.to_dict('records'))]
+            records += [{'op': 'delete', 'row': int(label)} for label in deletes['Target']]
+            if records:
+                self._journal_changes([{'op': 'batch', 'records': records}])
+
+            self.append_medical_rows(new_rows)
+            self.patients_medical_data.loc[deletes['Target'].to_numpy(), 'Deleted'] = True
+            self.bump_data_version()
+
+        report['New Row'] = -1
+        report.loc[updates.index, 'New Row'] = np.arange(first_label, first_label + len(updates))
+        return report
+
+    def prepare_new_medical_rows(self, records, transaction_time=None):
+        """
+        Validates and normalizes new measurements, in a vectorized way over the whole batch.
+        Patients may be given by name or id, and tests by name or loinc num.
+        :param records: DataFrame or iterable of dictionaries with 'Patient ID', 'Test Name', 'Value' and
+                        'Valid Start Time', and optionally 'Units' and 'Valid End Time'
+        :param transaction_time: datetime of the transaction, defaults to now
+        :return: DataFrame with the medical data columns
+        """
+        new_rows = pd.DataFrame(records).reset_index(drop=True)
+        missing_columns = {'Patient ID', 'Test Name', 'Value', 'Valid Start Time'} - set(new_rows.columns)
+        if missing_columns:
+            raise ValueError(f'Measurements are missing the columns {sorted(missing_columns)}')
+
+        # Map names to ids, and check all the ids are known to the system
+        new_rows['Patient ID'] = new_rows['Patient ID'].map(self.name2id_map).fillna(new_rows['Patient ID'])
+        new_rows['Test Name'] = new_rows['Test Name'].map(self.test2loincmap).fillna(new_rows['Test Name'])
+        for col in ['Valid Start Time', 'Valid End Time']:
+            if col in new_rows.columns and not pd.api.types.is_datetime64_any_dtype(new_rows[col]):
+                new_rows[col] = _parse_input_times(new_rows[col])
+        invalid_rows = (~new_rows['Patient ID'].isin(list(self.id2name_map)) |
+                        ~new_rows['Test Name'].isin(list(self.test2loincmap.values())) |
+                        new_rows['Valid Start Time'].isna())
+        if invalid_rows.any():
+            raise ValueError(f'{invalid_rows.sum()} measurements have an unknown patient, unknown test or no valid '
+                             f'start time, at positions {np.flatnonzero(invalid_rows)[:10].tolist()}')
+        self.validate_test_values(new_rows['Test Name'], new_rows['Value'])
+
+        if 'Units' not in new_rows.columns:
+            new_rows['Units'] = np.nan
+        test_units = self.loinc_data.set_index('id')['units']
+        new_rows['Units'] = new_rows['Units'].fillna(new_rows['Test Name'].map(test_units))
+        if 'Valid End Time' not in new_rows.columns:
+            new_rows['Valid End Time'] = new_rows['Valid Start Time']
+        new_rows['Valid End Time'] = new_rows['Valid End Time'].fillna(new_rows['Valid Start Time'])
+        if transaction_time is None:
+            transaction_time = datetime.now(self.local_tz).replace(tzinfo=None, second=0, microsecond=0)
+        new_rows['Transaction Time'] = pd.Timestamp(transaction_time)
+        new_rows['Deleted'] = False
+        return new_rows[MEDICAL_DATA_COLUMNS]
+
+    def insert_patients_data(self, records, transaction_time=None):
+        """
+        Inserts a batch of new measurements. The whole batch is validated first, and persisted in a single write.
+        :param records: DataFrame or iterable of dictionaries, see prepare_new_medical_rows
+        :param transaction_time: datetime of the transaction, defaults to now
+        :return: DataFrame of the inserted rows, labeled by their labels in the medical data
+        """
+        new_rows = self.prepare_new_medical_rows(records, transaction_time)
+        journal_rows = new_rows.copy()
+        for col in ['Valid Start Time', 'Valid End Time', 'Transaction Time']:  # Formatted once for the whole batch
+            journal_rows[col] = np.datetime_as_string(journal_rows[col].to_numpy(dtype='datetime64[s]'))
+        with self._write_lock:
+            first_label = len(self.patients_medical_data)
+            self._journal_changes([{'op': 'insert', 'row': first_label + i, 'data': data}
+                                   for i, data in enumerate(journal_rows.to_dict('records'))])
+            return self.append_medical_rows(new_rows)
+
     def get_patients_valid_tests_for_timeframe(self, patient_name, target_date, target_time , use_pov = True):
         """
         retrieves all relevant logs for the patients for a specific time points, returns
@@ -245,44 +1040,58 @@ class DBConnector:
         :return:
         """
 
-        def filter_by_timedelta(row):
-            """
-            Returns True if an entry is valid for current time , else False
-            :param row: pandas series representing a test entry from the db
-            :return:
-            """
-            if row['Test Name'].strip() not in self.test2loincmap.values():  # Filter out tests not known to system
-                return False
-            loinc_row = self.loinc_data[self.loinc_data['id'].str.strip() == row['Test Name'].strip()]
-
-            good_after_delta = loinc_row['good_after'].values[0]
-            good_before_delta = loinc_row['good_before'].values[0]
-
-            return ((row['Valid Start Time'] + good_after_delta) >=
-                    target_datetime >=
-                    (row['Valid Start Time'] - good_before_delta) < target_datetime)
-
         patient_id = self.standartisize_patient(patient_name)
         target_datetime = self.standartisize_datetime(target_date, target_time)
 
-        relevant_medical_data = self.patients_medical_data[~self.patients_medical_data['Deleted']
-                                                           & (self.patients_medical_data['Patient ID'] == patient_id)]
+        # An entry is valid if: valid start - good before < target time <= valid start + good after
+        # Found by binary search in the index, tests not known to system have no window, and are filtered out
+        data_state = self.data_state
+        valid_labels = data_state.medical_data_index.lookup_valid_at(patient_id, data_state.test_windows,
+                                                                     target_datetime)
+        relevant_medical_data = data_state.patients_medical_data.loc[valid_labels]
+        relevant_medical_data = relevant_medical_data[~relevant_medical_data['Deleted']]
 
-        relevant_medical_data = relevant_medical_data[
-            relevant_medical_data.apply(filter_by_timedelta, axis=1)]
-
-        if use_pov:  # Use target time to only select past records
+        if use_pov:  # Use target time to only select past records, in their latest version known at that time
             relevant_medical_data = relevant_medical_data[relevant_medical_data['Transaction Time'] <= target_datetime]
-
+            relevant_medical_data = (relevant_medical_data.sort_values('Transaction Time', kind='stable')
+                                     .drop_duplicates(['Test Name', 'Valid Start Time'], keep='last').sort_index())
 
         # Pick only the rows with the most updated test values
-        recent_entries_per_exam_idx = relevant_medical_data.groupby('Test Name')['Valid Start Time'].idxmax()
+        recent_entries_per_exam_idx = relevant_medical_data.groupby('Test Name', observed=True)['Valid Start Time'].idxmax()
         # Filter the DataFrame to keep only those rows
         recent_entries_per_exam_df = relevant_medical_data.loc[recent_entries_per_exam_idx]
 
 
         return recent_entries_per_exam_df
 
+    def get_valid_tests_snapshot(self, target_date, target_time, use_pov=True):
+        """
+        retrieves the most recent valid log of every test, for all the patients at once, for a specific time point
+        :param target_date: str, date format (DD.MM.YYYY)
+        :param target_time: str, hour format HH:MM
+        :param use_pov: boolean, if True only logs recorded up to the target time are used
+        :return: DataFrame with a single row per (patient, test)
+        """
+        target_datetime = self.standartisize_datetime(target_date, target_time)
+
+        data_state = self.data_state
+        medical_data, validity_windows = data_state.patients_medical_data, data_state.validity_windows
+        deleted = medical_data['Deleted'].to_numpy()
+        valid_rows = ((validity_windows['Window Start'] < target_datetime) &
+                      (target_datetime <= validity_windows['Window End'])).to_numpy()
+        if use_pov:  # Only the versions known at the target time, starting from the nearest checkpoint
+            known_rows = np.zeros(len(valid_rows), dtype=bool)
+            known_rows[self.get_as_of_snapshots(data_state).lookup(target_datetime, deleted)] = True
+            valid_rows &= known_rows
+        else:
+            valid_rows &= ~deleted
+        relevant_medical_data = medical_data[valid_rows]
+
+        # Pick only the rows with the most updated test values of each patient
+        recent_entries_idx = relevant_medical_data.groupby(['Patient ID', 'Test Name'],
+                                                           observed=True)['Valid Start Time'].idxmax()
+        return relevant_medical_data.loc[recent_entries_idx]
+
     def get_patients_names(self):
         return list(self.name2id_map.keys())
 
@@ -298,56 +1107,70 @@ class DBConnector:
     def get_patients_dict(self):
         return self.patients_dict.copy()
 
+    def get_patient_logs(self, patient):
+        """
+        returns all the logs of the patient in the medical db, including deleted logs
+        :param patient: str, patient name or id
+        :return: DataFrame of the patient logs
+        """
+        patient_id = self.standartisize_patient(patient)
+        medical_data = self.patients_medical_data
+        return medical_data[medical_data['Patient ID'] == patient_id]
+
+    def get_patient_logs_in_window(self, patient_id, window_start, window_end):
+        """
+        Returns the logs of a patient whose validity windows overlap a time range, including deleted logs
+        :param patient_id: str, id of the patient
+        :param window_start: datetime64, start of the time range
+        :param window_end: datetime64, end of the time range
+        :return: DataFrame of the logs, labeled by their row labels
+        """
+        data_state = self.data_state
+        starts, ends, labels, unknown_tests = data_state.medical_data_index.get_patient_windows(patient_id,
+                                                                                                data_state.test_windows)
+        overlapping = (starts <= window_end) & (ends >= window_start)
+        return data_state.patients_medical_data.loc[np.sort(labels[overlapping])]
+
     def get_patient_earliest_entry(self , patient):
         """
         returns a timedate format with the patients first entry in the db
         :param patient: str, patient name or id
         :return: timedate , representing the date of the first entry of the patient in the medical db
         """
-        patient_id = self.standartisize_patient(patient)
-        patient_logs = self.patients_medical_data[self.patients_medical_data['Patient ID'] == patient_id]
+        patient_logs = self.get_patient_logs(patient)
         earliest_entry = patient_logs.sort_values(by='Valid Start Time', ascending=True).head(1)
         timestamp = pd.Timestamp(earliest_entry['Valid Start Time'].values[0])
         return timestamp.to_pydatetime()
 
-    def get_patient_intervals(self, patient , unmerged = False):
-
-        patient_id = self.standartisize_patient(patient)
-        patient_logs = self.patients_medical_data[self.patients_medical_data['Patient ID'] == patient_id]
-        tests_intervals = []
-        for _, row in patient_logs.iterrows():
-            if row['Test Name'].strip() not in self.test2loincmap.values():  # Filter out tests not known to system
-                print('skipped ' , row['Test Name'].strip())
-                continue
-            loinc_row = self.loinc_data[self.loinc_data['id'].str.strip() == row['Test Name'].strip()]
-
-            good_after_delta = loinc_row['good_after'].values[0]
-            good_before_delta = loinc_row['good_before'].values[0]
-            tests_intervals.append([(row['Valid Start Time'] -good_before_delta).to_pydatetime() , (row['Valid Start Time']+ good_after_delta).to_pydatetime()])
-
-        if len(tests_intervals) == 0 :
-            return tests_intervals
-
-        sorted_intervals = sorted(tests_intervals, key=lambda x: x[0])
-
-        if unmerged :
-            return sorted_intervals
-        merged_intervals = []
-
-        current_start, current_end = sorted_intervals[0]
+    def get_patient_windows(self, patient_id):
+        """
+        Returns the validity windows of all the logs of a patient, including deleted logs
+        :param patient_id: str, id of the patient
+        :return: tuple of (window starts, window ends) datetime64 arrays, sorted by window start
+        """
+        starts, ends, labels, unknown_tests = self.medical_data_index.get_patient_windows(patient_id, self.test_windows)
+        for test_name in unknown_tests:  # Filter out tests not known to system
+            print('skipped ', test_name.strip())
+        return starts, ends
 
-        for start, end in sorted_intervals[1:]:
-            # If the current interval overlaps with the next one, merge them
-            if start <= current_end:
-                current_end = max(current_end, end)
-            else:
-                # No overlap, add the current interval and start a new one
-                merged_intervals.append([current_start, current_end])
-                current_start, current_end = start, end
+    def get_patient_intervals(self, patient , unmerged = False):
 
-        # Add the last interval
-        merged_intervals.append([current_start, current_end])
-        return merged_intervals
+        starts, ends = self.get_patient_windows(self.standartisize_patient(patient))
+        if len(starts) == 0:
+            return []
+        if unmerged:
+            return [[start, end] for start, end in zip(pd.to_datetime(starts).to_pydatetime(),
+                                                       pd.to_datetime(ends).to_pydatetime())]
+
+        # Windows are merged while they overlap - a window starting after the end of all the windows before it starts
+        # a new interval, which ends at the latest end of its windows
+        latest_ends = np.maximum.accumulate(ends)
+        new_interval = np.ones(len(starts), dtype=bool)
+        new_interval[1:] = starts[1:] > latest_ends[:-1]
+        interval_starts = starts[new_interval]
+        interval_ends = latest_ends[np.append(np.flatnonzero(new_interval)[1:] - 1, len(starts) - 1)]
+        return [[start, end] for start, end in zip(pd.to_datetime(interval_starts).to_pydatetime(),
+                                                   pd.to_datetime(interval_ends).to_pydatetime())]
 
     def get_goodbefore_goodafter_df(self):
 
@@ -0,0 +1,77 @@
+import argparse
+import os
+from itertools import islice
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from DssEngine import DSSEngine, STATE_NAMES
+
+INTERVAL_COLUMNS = ['Patient ID', 'State', 'State Value', 'Start Time', 'End Time']
+INTERVAL_SCHEMA = pa.schema([('Patient ID', pa.string()), ('State', pa.string()), ('State Value', pa.string()),
+                             ('Start Time', pa.timestamp('ns')), ('End Time', pa.timestamp('ns'))])
+
+
+def batch_records(records, batch_size):
+    """
+    Splits a stream of interval records to DataFrames of at most batch_size records
+    :param records: iterable of (patient id, state, state value, start, end) tuples
+    :param batch_size: int
+    :return: generator of DataFrames
+    """
+    records = iter(records)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            return
+        yield pd.DataFrame(batch, columns=INTERVAL_COLUMNS)
+
+
+def export_state_intervals(dss, output_path, file_format='csv', batch_size=10000, patients=None, states=STATE_NAMES):
+    """
+    Writes the state intervals of a cohort to a csv or parquet file, in batches so memory stays bounded
+    :param dss: DSSEngine
+    :param output_path: str, path of the output file
+    :param file_format: str, 'csv' or 'parquet'
+    :param batch_size: int, number of records written at a time
+    :param patients: list of patient names or ids, None for all the patients in the db
+    :param states: list of state names
+    :return: int, number of records written
+    """
+    if file_format not in ('csv', 'parquet'):
+        raise ValueError(f'Unknown export format {file_format}')
+    records_count = 0
+    batches = batch_records(dss.iter_state_interval_records(patients, states), batch_size)
+
+    # Write to a temporary file first, so readers never see a half written export
+    if file_format == 'csv':
+        pd.DataFrame(columns=INTERVAL_COLUMNS).to_csv(output_path + '.tmp', index=False)
+        for batch in batches:
+            batch.to_csv(output_path + '.tmp', mode='a', header=False, index=False)
+            records_count += len(batch)
+    else:
+        with pq.ParquetWriter(output_path + '.tmp', INTERVAL_SCHEMA) as writer:
+            for batch in batches:
+                writer.write_table(pa.Table.from_pandas(batch, schema=INTERVAL_SCHEMA, preserve_index=False))
+                records_count += len(batch)
+    os.replace(output_path + '.tmp', output_path)
+    return records_count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exports the state intervals of all the patients in the db')
+    parser.add_argument('output_path')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default=None,
+                        help='output format, by default taken from the output file extension')
+    parser.add_argument('--db-folder', default='.')
+    parser.add_argument('--ontology-folder', default='.')
+    parser.add_argument('--storage', choices=['csv', 'arrow', 'sqlite'], default='csv')
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--states', nargs='+', default=STATE_NAMES, choices=STATE_NAMES)
+    args = parser.parse_args()
+
+    file_format = args.format or ('parquet' if args.output_path.endswith('.parquet') else 'csv')
+    dss = DSSEngine(args.db_folder, args.ontology_folder, storage=args.storage)
+    records_count = export_state_intervals(dss, args.output_path, file_format, args.batch_size, states=args.states)
+    print(f'Exported {records_count} state intervals to {args.output_path}')
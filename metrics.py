@@ -0,0 +1,220 @@
+import bisect
+import contextlib
+import functools
+import inspect
+import os
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+METHOD_LATENCY = 'cdss_method_seconds'
+INFERENCE_PHASE_LATENCY = 'cdss_inference_phase_seconds'
+METRIC_HELP = {METHOD_LATENCY: 'Latency of the public methods of the db connectors and the DSS engine',
+               INFERENCE_PHASE_LATENCY: 'Latency of the phases of the states inference'}
+
+# Returned instead of a timer when metrics are disabled
+_NULL_TIMER = contextlib.nullcontext()
+# The (object, method name) pairs timed by every thread at the moment, an override calling the method it overrides is
+# recorded once
+_timed_calls = threading.local()
+
+
+class LatencyHistogram:
+    """
+    Counts observed latencies in fixed buckets, with their count and sum - enough to estimate quantiles and averages
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)  # The last bucket holds latencies above all the bounds
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.bucket_counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def cumulative_counts(self):
+        """
+        :return: list of (upper bound, number of observations up to the bound), ending with (inf, count)
+        """
+        counts, total = [], 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), self.bucket_counts):
+            total += bucket_count
+            counts.append((bound, total))
+        return counts
+
+
+class _Timer:
+    def __init__(self, registry, metric, labels):
+        self.registry, self.metric, self.labels = registry, metric, labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.registry.observe(self.metric, time.perf_counter() - self.start, self.labels)
+
+
+class PhaseLaps:
+    """
+    Times the consecutive phases of a computation - every lap records the time since the previous lap
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.last = time.perf_counter()
+
+    def lap(self, phase):
+        """
+        :param phase: str, name of the phase that just ended
+        """
+        now = time.perf_counter()
+        self.registry.observe(INFERENCE_PHASE_LATENCY, now - self.last, (('phase', phase),))
+        self.last = now
+
+
+class MetricsRegistry:
+    """
+    Latency histograms of the instrumented code, keyed by metric name and labels.
+    Instrumentation is installed only while the registry is enabled - disabled, the instrumented classes run their
+    original methods and the inference phase timers are not created, so metrics cost close to nothing.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = False
+        self._histograms = {}
+        self._instrumented_classes = []
+        self._lock = threading.Lock()
+        if enabled:
+            self.enable()
+
+    def enable(self):
+        self.enabled = True
+        for cls in self._instrumented_classes:
+            _install_method_timers(cls, self)
+
+    def disable(self):
+        self.enabled = False
+        for cls in self._instrumented_classes:
+            _remove_method_timers(cls)
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def observe(self, metric, seconds, labels=()):
+        """
+        Records a single latency
+        :param metric: str, metric name
+        :param seconds: float, the observed latency
+        :param labels: tuple of (label name, label value) pairs
+        :return:
+        """
+        with self._lock:
+            histogram = self._histograms.get((metric, labels))
+            if histogram is None:
+                histogram = self._histograms[(metric, labels)] = LatencyHistogram()
+            histogram.observe(seconds)
+
+    def time_phase(self, phase):
+        """
+        :param phase: str, name of an inference phase
+        :return: context manager recording the latency of the phase, a no-op when the registry is disabled
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, INFERENCE_PHASE_LATENCY, (('phase', phase),))
+
+    def phase_laps(self):
+        """
+        :return: PhaseLaps timing the phases of a computation from now on, None when the registry is disabled
+        """
+        if not self.enabled:
+            return None
+        return PhaseLaps(self)
+
+    def snapshot(self):
+        """
+        :return: dictionary of metric name to a list of series, each with its labels, count, sum and cumulative bucket
+                 counts
+        """
+        with self._lock:
+            snapshot = {}
+            for (metric, labels), histogram in sorted(self._histograms.items()):
+                snapshot.setdefault(metric, []).append({'labels': dict(labels),
+                                                        'count': histogram.count,
+                                                        'sum': histogram.sum,
+                                                        'buckets': histogram.cumulative_counts()})
+            return snapshot
+
+    def to_prometheus(self):
+        """
+        :return: str, the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for metric, series in self.snapshot().items():
+            lines.append(f'# HELP {metric} {METRIC_HELP.get(metric, metric)}')
+            lines.append(f'# TYPE {metric} histogram')
+            for serie in series:
+                labels = ','.join(f'{name}="{value}"' for name, value in serie['labels'].items())
+                for bound, count in serie['buckets']:
+                    bound = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{metric}_bucket{{{labels}{"," if labels else ""}le="{bound}"}} {count}')
+                lines.append(f'{metric}_sum{{{labels}}} {serie["sum"]}')
+                lines.append(f'{metric}_count{{{labels}}} {serie["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+def _install_method_timers(cls, registry):
+    for name, attribute in list(vars(cls).items()):
+        is_static = isinstance(attribute, staticmethod)
+        method = attribute.__func__ if is_static else attribute
+        if name.startswith('_') or not inspect.isfunction(method) or hasattr(method, '_metrics_original'):
+            continue
+
+        def timed(*args, _method=method, _name=name, _is_static=is_static, **kwargs):
+            # Methods are recorded under the class of the object they are called on, static methods under their class
+            component = cls.__name__ if _is_static or not args else type(args[0]).__name__
+            call = (component if _is_static or not args else id(args[0]), _name)
+            active_calls = _timed_calls.__dict__.setdefault('calls', set())
+            if call in active_calls:
+                return _method(*args, **kwargs)
+            active_calls.add(call)
+            start = time.perf_counter()
+            try:
+                return _method(*args, **kwargs)
+            finally:
+                active_calls.discard(call)
+                labels = (('component', component), ('method', _name))
+                registry.observe(METHOD_LATENCY, time.perf_counter() - start, labels)
+        timed = functools.wraps(method)(timed)
+        timed._metrics_original = method
+        setattr(cls, name, staticmethod(timed) if is_static else timed)
+
+
+def _remove_method_timers(cls):
+    for name, attribute in list(vars(cls).items()):
+        method = attribute.__func__ if isinstance(attribute, staticmethod) else attribute
+        original = getattr(method, '_metrics_original', None)
+        if original is not None:
+            setattr(cls, name, staticmethod(original) if isinstance(attribute, staticmethod) else original)
+
+
+# Enabled by setting the CDSS_METRICS environment variable, or by calling METRICS.enable()
+METRICS = MetricsRegistry(enabled=os.environ.get('CDSS_METRICS', '') not in ('', '0'))
+
+
+def instrument_public_methods(cls):
+    """
+    Class decorator recording the latency and the number of calls of every public method of the class, under the
+    component label of the class of the object they are called on - inherited methods under the subclass.
+    """
+    METRICS._instrumented_classes.append(cls)
+    if METRICS.enabled:
+        _install_method_timers(cls, METRICS)
+    return cls
@@ -0,0 +1,64 @@
+import threading
+from collections import OrderedDict
+
+
+class QueryCache:
+    """
+    Bounded LRU cache of query results.
+    Keys should contain the data version the result was computed on, so results of older versions are never served.
+    """
+
+    def __init__(self, max_size=1024):
+        """
+        :param max_size: int, maximal number of cached results, 0 disables the cache
+        """
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        :param key: hashable normalized query
+        :return: the cached result, or None on a miss
+        """
+        with self._lock:
+            result = self._entries.get(key)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return result
+
+    def put(self, key, result):
+        """
+        Caches a result, evicting the least recently used results when the cache is full
+        """
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        :return: dictionary of the cache counters
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self._entries),
+                    'max_size': self.max_size,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
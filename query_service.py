@@ -0,0 +1,191 @@
+import argparse
+import asyncio
+import json
+from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import tornado.web
+
+from DssEngine import DSSEngine
+from metrics import METRICS
+
+
+def _to_json_value(value):
+    """
+    json.dumps fallback for the values returned by the engine
+    """
+    if isinstance(value, pd.DataFrame):
+        return json.loads(value.to_json(orient='records', date_format='iso'))
+    if isinstance(value, pd.Series):
+        return _to_json_value(value.to_frame().T)[0]
+    if isinstance(value, datetime):  # Also covers pandas Timestamps
+        return value.isoformat()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+class RequestCoalescer:
+    """
+    Runs blocking engine calls in an executor, and lets identical calls that are in flight at the same time share a
+    single computation.
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.in_flight = {}
+        self.computations = 0
+        self.coalesced = 0
+
+    async def run(self, key, func, *args):
+        """
+        :param key: hashable description of the call, calls with equal keys are computed once
+        :param func: blocking function
+        :return: the result of func(*args)
+        """
+        future = self.in_flight.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+            self.in_flight[key] = future
+            future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+            self.computations += 1
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(future)  # A cancelled waiter does not cancel the shared computation
+
+
+class DSSHandler(tornado.web.RequestHandler, metaclass=ABCMeta):
+    """
+    Base handler of the query endpoints - every endpoint maps its query arguments to a single engine call
+    """
+    # Names of the required and optional query arguments of the endpoint
+    required_arguments = ()
+    optional_arguments = ()
+
+    def initialize(self, dss, coalescer):
+        self.dss = dss
+        self.coalescer = coalescer
+
+    @abstractmethod
+    def compute(self, **arguments):
+        """
+        Runs the engine call of the endpoint, in an executor thread
+        :param arguments: the query arguments, by name - None for missing optional arguments
+        :return: JSON serializable result, see _to_json_value
+        """
+
+    async def get(self):
+        arguments = {}
+        for name in self.required_arguments:
+            arguments[name] = self.get_query_argument(name)  # Responds 400 if missing
+        for name in self.optional_arguments:
+            arguments[name] = self.get_query_argument(name, None)
+        key = (type(self).__name__,) + tuple(sorted(arguments.items()))
+        try:
+            result = await self.coalescer.run(key, lambda: self.compute(**arguments))
+        except (KeyError, ValueError) as e:
+            raise tornado.web.HTTPError(400, reason=str(e.args[0]) if e.args else type(e).__name__)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(result, default=_to_json_value))
+
+
+class RetrieveHandler(DSSHandler):
+    required_arguments = ('target', 'patient', 'date', 'pov_date')
+    optional_arguments = ('hour', 'pov_hour')
+
+    def compute(self, target, patient, date, pov_date, hour, pov_hour):
+        return self.dss.retrival_query(target, patient, date, pov_date, hour=hour, pov_hour=pov_hour)
+
+
+class HistoryHandler(DSSHandler):
+    required_arguments = ('target', 'patient', 'date', 'prev_date')
+    optional_arguments = ('hour', 'prev_hour')
+
+    def compute(self, target, patient, date, prev_date, hour, prev_hour):
+        return self.dss.retrival_historic_query(target, patient, date, prev_date, hour=hour, prev_hour=prev_hour)
+
+
+class StatesHandler(DSSHandler):
+    required_arguments = ('time',)  # DD.MM.YYYY HH:MM
+    optional_arguments = ('patient',)
+
+    def compute(self, time, patient):
+        return self.dss.infer_patients_states_for_timepoint(time, single_patient_id=patient)
+
+
+class IntervalsHandler(DSSHandler):
+    required_arguments = ('patient', 'state')
+
+    def compute(self, patient, state):
+        intervals = self.dss.retrieve_state_intervals(patient, state)
+        if intervals is None:
+            raise ValueError('Patient Name Unknown to System')
+        return intervals
+
+
+class PatientsHandler(DSSHandler):
+    def compute(self):
+        return self.dss.db_con.get_patients_dict()
+
+
+class TestsHandler(DSSHandler):
+    def compute(self):
+        return self.dss.db_con.test2loincmap
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """
+    Latency metrics of the engine in the Prometheus text format - empty unless metrics are enabled
+    """
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(METRICS.to_prometheus())
+
+
+def make_app(dss, executor=None):
+    """
+    Creates the query service application
+    :param dss: DSSEngine answering the queries
+    :param executor: executor running the engine calls, defaults to a thread pool.
+                     Engines in the 'ontology' inference mode share individuals, and need a single worker.
+    :return: tornado Application
+    """
+    coalescer = RequestCoalescer(executor or ThreadPoolExecutor())
+    handler_arguments = {'dss': dss, 'coalescer': coalescer}
+    app = tornado.web.Application([
+        (r'/retrieve', RetrieveHandler, handler_arguments),
+        (r'/history', HistoryHandler, handler_arguments),
+        (r'/states', StatesHandler, handler_arguments),
+        (r'/intervals', IntervalsHandler, handler_arguments),
+        (r'/patients', PatientsHandler, handler_arguments),
+        (r'/tests', TestsHandler, handler_arguments),
+        (r'/metrics', MetricsHandler),
+    ])
+    app.coalescer = coalescer
+    return app
+
+
+async def main(args):
+    if args.metrics:
+        METRICS.enable()
+    dss = DSSEngine(args.db_folder, args.ontology_folder, storage=args.storage)
+    app = make_app(dss, ThreadPoolExecutor(max_workers=args.workers))
+    app.listen(args.port, address=args.address)
+    print(f'Serving on http://{args.address}:{args.port}')
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='JSON query service of the DSS engine')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--db-folder', default='.')
+    parser.add_argument('--ontology-folder', default='.')
+    parser.add_argument('--storage', choices=['csv', 'arrow', 'sqlite'], default='csv')
+    parser.add_argument('--workers', type=int, default=4, help='number of threads running engine calls')
+    parser.add_argument('--metrics', action='store_true', help='record latency metrics, served on /metrics')
+    asyncio.run(main(parser.parse_args()))
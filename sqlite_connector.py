@@ -0,0 +1,325 @@
+import os
+import sqlite3
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from change_journal import apply_journal_records
+from compact_table import is_numeric_test
+from dbconnector import DBConnector, LOINC_DATA_FILE, MEDICAL_DATA_COLUMNS, MEDICAL_DATA_FILE
+from metrics import instrument_public_methods
+
+TIME_COLUMNS = ['Valid Start Time', 'Valid End Time', 'Transaction Time']
+SQL_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def _to_sql_time(value):
+    return pd.Timestamp(value).strftime(SQL_TIME_FORMAT)
+
+
+def _to_sql_rows(medical_data):
+    """
+    Converts medical data to the values stored in the observations table
+    """
+    rows = medical_data[MEDICAL_DATA_COLUMNS].copy()
+    for col in TIME_COLUMNS:  # Same text as SQL_TIME_FORMAT, formatted with numpy as it is much faster
+        sql_times = np.char.replace(np.datetime_as_string(rows[col].to_numpy(dtype='datetime64[s]')), 'T', ' ')
+        rows[col] = np.where(rows[col].isna(), None, sql_times)
+    rows['Deleted'] = rows['Deleted'].astype(int)
+    return rows.astype(object).where(rows.notna(), None)
+
+
+@instrument_public_methods
+class SQLiteDBConnector(DBConnector):
+    """
+    DBConnector that keeps the patients medical data in a local SQLite database instead of an in-memory DataFrame.
+    Queries are answered by indexed SQL, and updates are committed as SQLite transactions.
+    The database is created from the csv files (and their journal) on first use.
+    """
+
+    def __init__(self, db_folder='', db_file='patient_data.sqlite', query_cache_size=1024):
+        """
+        :param db_folder: str, folder of the db files
+        :param db_file: str, name of the SQLite database file in the db folder
+        :param query_cache_size: int, maximal number of cached retrieval results, 0 disables the cache
+        """
+        self.db_file = db_file
+        # The personal data and loinc catalog, and the initial medical data, are stored in the csv files
+        super().__init__(db_folder, storage='csv', query_cache_size=query_cache_size)
+
+    def open_medical_data(self):
+        """
+        Opens the database, and creates it from the medical data files if it does not exist
+        :return:
+        """
+        db_path = os.path.join(self.db_folder_path, self.db_file)
+        create_db = not os.path.exists(db_path)
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        if create_db:
+            self.create_database()
+        with self.connection:  # Index for the whole ward queries
+            self.connection.execute('''CREATE INDEX IF NOT EXISTS observations_test_valid_time
+                                       ON observations ("Test Name", "Valid Start Time")''')
+        self.refresh_validity_windows()
+
+    def create_database(self):
+        """
+        Creates the observations table and its indexes, and fills it with the current medical data files
+        :return:
+        """
+        medical_data = apply_journal_records(self.load_patients_medical_data(), self.read_journal())
+        with self.connection:
+            self.connection.execute('''
+                CREATE TABLE observations (
+                    row_id INTEGER PRIMARY KEY,
+                    "Patient ID" TEXT NOT NULL,
+                    "Test Name" TEXT NOT NULL,
+                    "Value",
+                    "Units" TEXT,
+                    "Valid Start Time" TEXT NOT NULL,
+                    "Valid End Time" TEXT,
+                    "Transaction Time" TEXT NOT NULL,
+                    "Deleted" INTEGER NOT NULL DEFAULT 0)''')
+            self.connection.execute('''CREATE INDEX observations_patient_test_valid_time
+                                       ON observations ("Patient ID", "Test Name", "Valid Start Time")''')
+            self.connection.execute('''CREATE INDEX observations_patient_transaction_time
+                                       ON observations ("Patient ID", "Transaction Time")''')
+            self.connection.execute('''CREATE TABLE test_windows (
+                                           test_name TEXT PRIMARY KEY,
+                                           good_before_seconds INTEGER NOT NULL,
+                                           good_after_seconds INTEGER NOT NULL)''')
+
+            rows = _to_sql_rows(medical_data)
+            self.connection.executemany(
+                'INSERT INTO observations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                ((label, *values) for label, values in zip(rows.index, rows.itertuples(index=False))))
+
+    def refresh_validity_windows(self):
+        """
+        Copies the good before / good after windows of the loinc catalog to the database
+        :return:
+        """
+        windows = [(test_id.strip(), int(good_before.total_seconds()), int(good_after.total_seconds()))
+                   for test_id, good_before, good_after in
+                   zip(self.loinc_data['id'], self.loinc_data['good_before'], self.loinc_data['good_after'])]
+        with self.connection:
+            self.connection.execute('DELETE FROM test_windows')
+            self.connection.executemany('INSERT INTO test_windows VALUES (?, ?, ?)', windows)
+
+    def reload_data_source(self, file_name):
+        with self._write_lock:
+            reloaded = super().reload_data_source(file_name)
+            if reloaded and file_name == LOINC_DATA_FILE:
+                self.refresh_validity_windows()  # The windows of the new catalog, in the database
+        return reloaded
+
+    def get_test_values(self, medical_data):
+        numbers = pd.to_numeric(medical_data['Value'], errors='coerce').to_numpy(dtype=np.float64)
+        is_numeric = is_numeric_test(medical_data['Test Name'], self.numeric_tests)
+        return np.where(is_numeric, numbers, medical_data['Value'].to_numpy(dtype=object)).tolist()
+
+    def save_patients_medical_data(self, patients_data_path=MEDICAL_DATA_FILE, medical_data=None, before_replace=None):
+        """
+        Exports the medical data in the database to the csv file
+        """
+        if medical_data is None:
+            medical_data = self.get_medical_data_rows()
+        super().save_patients_medical_data(patients_data_path, medical_data, before_replace)
+
+    def get_data_source_paths(self):
+        # The medical data lives in the database, the csv file is only its export
+        data_source_paths = super().get_data_source_paths()
+        return {path: file_name for path, file_name in data_source_paths.items() if file_name != MEDICAL_DATA_FILE}
+
+    def ingest_appended_medical_data(self):
+        raise ValueError('The medical data of the SQLite storage is not read from the csv file')
+
+    def compact_journal(self):
+        # Changes are committed directly to the database, there is no journal to compact
+        return
+
+    def get_memory_usage(self):
+        # The medical data is not held in memory, its size is the size of the database
+        with self._write_lock:
+            rows = self.connection.execute('SELECT COUNT(*) FROM observations').fetchone()[0]
+            page_count = self.connection.execute('PRAGMA page_count').fetchone()[0]
+            page_size = self.connection.execute('PRAGMA page_size').fetchone()[0]
+        total = page_count * page_size
+        return {'database': total, 'rows': rows, 'total': total, 'bytes per row': total / rows if rows else 0.0}
+
+    def _query_frame(self, sql, params=()):
+        """
+        Runs a query on the observations table, and returns the rows in the same format as the csv loaders
+        :param sql: str, query selecting row_id and the medical data columns
+        :param params: query parameters
+        :return: DataFrame indexed by the row ids
+        """
+        with self._write_lock:
+            rows = self.connection.execute(sql, params).fetchall()
+        frame = pd.DataFrame(rows, columns=['row_id'] + MEDICAL_DATA_COLUMNS).set_index('row_id')
+        frame.index.name = None
+        for col in TIME_COLUMNS:
+            frame[col] = pd.to_datetime(frame[col], format=SQL_TIME_FORMAT)
+        frame['Deleted'] = frame['Deleted'].astype(bool)
+        for col in ['Value', 'Units']:
+            frame[col] = frame[col].where(frame[col].notna(), np.nan)
+        return frame
+
+    def get_medical_data_rows(self, offset=0, limit=None, patient_ids=None):
+        params = []
+        sql = 'SELECT * FROM observations'
+        if patient_ids is not None:
+            patient_ids = list(patient_ids)
+            sql += f' WHERE "Patient ID" IN ({", ".join("?" * len(patient_ids))})'
+            params += patient_ids
+        sql += ' ORDER BY row_id LIMIT ? OFFSET ?'
+        params += [-1 if limit is None else limit, offset]  # A negative limit returns all the rows
+        return self._query_frame(sql, params)
+
+    def query_patient_data(self, patient_id, loinc_num, valid_from, valid_to, pov_datetime, historic):
+        conditions = ['"Patient ID" = ?', '"Test Name" = ?', '"Valid Start Time" BETWEEN ? AND ?']
+        params = [patient_id, loinc_num, _to_sql_time(valid_from), _to_sql_time(valid_to)]
+        if not historic:
+            # Removes deleted and later recorded entries from non - historical retrieval
+            conditions += ['"Transaction Time" <= ?', 'NOT "Deleted"']
+            params.append(_to_sql_time(pov_datetime))
+        sql = f'SELECT * FROM observations WHERE {" AND ".join(conditions)} ORDER BY "Transaction Time" DESC, row_id DESC'
+        if not historic:
+            sql += ' LIMIT 1'
+        return self._query_frame(sql, params)
+
+    def update_patient_data(self, patient_name, update_date, update_time, update_val,
+                            target_key, target_date, target_time, mode='update'):
+        current_date = datetime.now(self.local_tz).strftime("%d.%m.%Y")
+        current_time = datetime.now(self.local_tz).strftime("%H:%M")
+        logs = self.retrieve_patient_data(patient_name=patient_name,
+                                          target_key=target_key,
+                                          target_date=target_date,
+                                          target_hour=target_time,
+                                          pov_date=current_date,
+                                          pov_hour=current_time)
+
+        # Raise exception if no data exists for the parameters
+        if len(logs) == 0:
+            raise ValueError('No data exists for required test, patient and date')
+
+        row_id = int(logs.index[0])
+        if mode == 'update':
+            self.validate_test_values(logs['Test Name'].iloc[:1], pd.Series([update_val]))
+        with self._write_lock, self.connection:  # Commits the change as a single transaction
+            if mode == 'update':
+                update_datetime = self.standartisize_datetime(update_date, update_time)
+                cursor = self.connection.execute('''
+                    INSERT INTO observations ("Patient ID", "Test Name", "Value", "Units", "Valid Start Time",
+                                              "Valid End Time", "Transaction Time", "Deleted")
+                    SELECT "Patient ID", "Test Name", ?, "Units", "Valid Start Time", "Valid End Time", ?, "Deleted"
+                    FROM observations WHERE row_id = ?''', (update_val, _to_sql_time(update_datetime), row_id))
+                row_id = cursor.lastrowid
+            elif mode == 'delete':
+                self.connection.execute('UPDATE observations SET "Deleted" = 1 WHERE row_id = ?', (row_id,))
+            self.bump_data_version()
+
+        return self._query_frame('SELECT * FROM observations WHERE row_id = ?', (row_id,)).iloc[0]
+
+    def insert_patients_data(self, records, transaction_time=None):
+        new_rows = _to_sql_rows(self.prepare_new_medical_rows(records, transaction_time))
+        with self._write_lock, self.connection:  # Commits the batch as a single transaction
+            first_row_id = self.connection.execute('SELECT COALESCE(MAX(row_id), -1) + 1 FROM observations').fetchone()[0]
+            self.connection.executemany(
+                'INSERT INTO observations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                ((first_row_id + i, *values) for i, values in enumerate(new_rows.itertuples(index=False))))
+            self.bump_data_version()
+        return self._query_frame('SELECT * FROM observations WHERE row_id >= ? ORDER BY row_id', (first_row_id,))
+
+    def correct_patients_data(self, corrections):
+        with self._write_lock, self.connection:  # Commits the batch as a single transaction
+            report = self.resolve_corrections(corrections)
+            applied = report['Status'] == 'applied'
+            updates = report[applied & (report['Action'] == 'update')]
+            deletes = report[applied & (report['Action'] == 'delete')]
+
+            first_row_id = self.connection.execute('SELECT COALESCE(MAX(row_id), -1) + 1 FROM observations').fetchone()[0]
+            update_times = [_to_sql_time(update_time) for update_time in updates['Update Time']]
+            self.connection.executemany('''
+                INSERT INTO observations (row_id, "Patient ID", "Test Name", "Value", "Units", "Valid Start Time",
+                                          "Valid End Time", "Transaction Time", "Deleted")
+                SELECT ?, "Patient ID", "Test Name", ?, "Units", "Valid Start Time", "Valid End Time", ?, "Deleted"
+                FROM observations WHERE row_id = ?''',
+                [(first_row_id + i, None if pd.isna(value) else value, update_time, int(target))
+                 for i, (value, update_time, target) in enumerate(zip(updates['Value'], update_times, updates['Target']))])
+            self.connection.executemany('UPDATE observations SET "Deleted" = 1 WHERE row_id = ?',
+                                        [(int(target),) for target in deletes['Target']])
+            self.bump_data_version()
+
+        report['New Row'] = -1
+        report.loc[updates.index, 'New Row'] = np.arange(first_row_id, first_row_id + len(updates))
+        return report
+
+    def _query_valid_tests(self, target_date, target_time, use_pov, patient_id=None):
+        """
+        Runs the query of the most recent valid log of every test at a time point, for a single patient or for all
+        """
+        target_datetime = _to_sql_time(self.standartisize_datetime(target_date, target_time))
+
+        # A test is valid when: valid start - good before < target time <= valid start + good after
+        patient_condition = 'AND o."Patient ID" = :patient_id' if patient_id is not None else ''
+        pov_condition = 'AND o."Transaction Time" <= :target' if use_pov else ''
+        # With a point of view, a measurement is read in its latest version known at the target time
+        version_order = 'o."Transaction Time" DESC, o.row_id DESC' if use_pov else 'o.row_id'
+        sql = f'''
+            SELECT row_id, "Patient ID", "Test Name", "Value", "Units", "Valid Start Time", "Valid End Time",
+                   "Transaction Time", "Deleted"
+            FROM (
+                SELECT o.*, ROW_NUMBER() OVER (PARTITION BY o."Patient ID", o."Test Name"
+                                               ORDER BY o."Valid Start Time" DESC, {version_order}) AS recency
+                FROM test_windows w CROSS JOIN observations o
+                WHERE o."Test Name" = w.test_name AND NOT o."Deleted"
+                      AND o."Valid Start Time" >= datetime(:target, '-' || w.good_after_seconds || ' seconds')
+                      AND o."Valid Start Time" < datetime(:target, '+' || w.good_before_seconds || ' seconds')
+                      {patient_condition} {pov_condition})
+            WHERE recency = 1
+            ORDER BY "Patient ID", "Test Name"'''
+        return self._query_frame(sql, {'patient_id': patient_id, 'target': target_datetime})
+
+    def get_patients_valid_tests_for_timeframe(self, patient_name, target_date, target_time, use_pov=True):
+        patient_id = self.standartisize_patient(patient_name)
+        return self._query_valid_tests(target_date, target_time, use_pov, patient_id)
+
+    def get_valid_tests_snapshot(self, target_date, target_time, use_pov=True):
+        return self._query_valid_tests(target_date, target_time, use_pov)
+
+    def get_patient_windows(self, patient_id):
+        patient_logs = self.get_patient_logs(patient_id)
+        windows = self.get_validity_windows(patient_logs)
+        known_tests = windows['Window Start'].notna().to_numpy()
+        for test_name in patient_logs['Test Name'][~known_tests]:  # Filter out tests not known to system
+            print('skipped ', test_name.strip())
+        starts = windows['Window Start'].to_numpy(dtype='datetime64[ns]')[known_tests]
+        ends = windows['Window End'].to_numpy(dtype='datetime64[ns]')[known_tests]
+        order = np.lexsort((windows.index.to_numpy()[known_tests], starts))
+        return starts[order], ends[order]
+
+    def get_patient_logs_in_window(self, patient_id, window_start, window_end):
+        patient_logs = self.get_patient_logs(patient_id)
+        windows = self.get_validity_windows(patient_logs)
+        overlapping = (windows['Window Start'] <= window_end) & (windows['Window End'] >= window_start)
+        return patient_logs[overlapping]
+
+    def get_data_as_of(self, pov_datetime):
+        sql = '''
+            SELECT row_id, "Patient ID", "Test Name", "Value", "Units", "Valid Start Time", "Valid End Time",
+                   "Transaction Time", "Deleted"
+            FROM (
+                SELECT *, ROW_NUMBER() OVER (PARTITION BY "Patient ID", "Test Name", "Valid Start Time"
+                                             ORDER BY "Transaction Time" DESC, row_id DESC) AS recency
+                FROM observations
+                WHERE NOT "Deleted" AND "Transaction Time" <= ?)
+            WHERE recency = 1
+            ORDER BY row_id'''
+        return self._query_frame(sql, (_to_sql_time(pov_datetime),))
+
+    def get_patient_logs(self, patient):
+        patient_id = self.standartisize_patient(patient)
+        return self._query_frame('SELECT * FROM observations WHERE "Patient ID" = ? ORDER BY row_id', (patient_id,))
@@ -0,0 +1,112 @@
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+# Fingerprints are sums of 64 bit hashes, kept modulo 2 ** 64
+FINGERPRINT_MODULUS = 2 ** 64
+
+
+def hash_patient_logs(patient_logs, windows):
+    """
+    Hashes logs together with their validity windows - the sum of the hashes of the single logs
+    :param patient_logs: DataFrame of logs, labeled by their row labels
+    :param windows: DataFrame of the validity windows of the logs
+    :return: int
+    """
+    hashed = pd.util.hash_pandas_object(pd.concat([patient_logs, windows], axis=1), index=True)
+    return int(hashed.to_numpy().sum(dtype=np.uint64))
+
+
+def fingerprint_patient_logs(patient_logs, windows, patient_record):
+    """
+    Hashes the logs of a patient together with their validity windows and the patient's personal data (the rules read
+    the gender), so a stored timeline can be checked against the data it was computed from.
+    The logs are hashed one by one, so the fingerprint of changed logs is updated with replace_fingerprint_logs.
+    :param patient_logs: DataFrame of all the logs of the patient, including deleted logs
+    :param windows: DataFrame of the validity windows of the logs
+    :param patient_record: dictionary of the patient personal data (name, age and gender)
+    :return: int
+    """
+    record_hash = pd.util.hash_pandas_object(pd.Series(patient_record, dtype=object).astype(str), index=True)
+    return (hash_patient_logs(patient_logs, windows) +
+            int(record_hash.to_numpy().sum(dtype=np.uint64))) % FINGERPRINT_MODULUS
+
+
+def replace_fingerprint_logs(fingerprint, old_logs, old_windows, new_logs, new_windows):
+    """
+    Updates a fingerprint for changed logs, without hashing the logs that did not change
+    :param fingerprint: int, fingerprint of the logs before the change
+    :param old_logs: DataFrame of the changed logs as they were before the change (empty for new logs)
+    :param old_windows: DataFrame of the validity windows of old_logs
+    :param new_logs: DataFrame of the changed logs as they are after the change
+    :param new_windows: DataFrame of the validity windows of new_logs
+    :return: int
+    """
+    return (fingerprint - hash_patient_logs(old_logs, old_windows) +
+            hash_patient_logs(new_logs, new_windows)) % FINGERPRINT_MODULUS
+
+
+class StateTimelineStore:
+    """
+    Persisted store of the state samples of every patient - the states inferred at each time point where a validity
+    window of one of the patient's tests starts or ends. The state intervals are built from the samples, so a change
+    to a single observation only requires recomputing the samples inside its validity window.
+    Every patient is kept in its own file, written atomically.
+    """
+
+    def __init__(self, store_folder):
+        """
+        :param store_folder: str, folder of the timeline files, created if missing
+        """
+        self.store_folder = store_folder
+        os.makedirs(store_folder, exist_ok=True)
+
+    def _patient_path(self, patient_id):
+        return os.path.join(self.store_folder, f'{patient_id}.pkl')
+
+    def load(self, patient_id, fingerprint=None):
+        """
+        Loads the stored timeline of a patient
+        :param patient_id: str, id of the patient
+        :param fingerprint: int, if given - the timeline is returned only if it was computed from matching logs
+        :return: tuple of (timepoints array, list of states dictionaries, fingerprint), or None
+        """
+        try:
+            with open(self._patient_path(patient_id), 'rb') as timeline_file:
+                timeline = pickle.load(timeline_file)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        if fingerprint is not None and timeline[2] != fingerprint:
+            return None
+        return timeline
+
+    def save(self, patient_id, timepoints, samples, fingerprint):
+        """
+        Stores the timeline of a patient
+        :param patient_id: str, id of the patient
+        :param timepoints: sorted datetime64 array of the sampled time points
+        :param samples: list of the states dictionaries inferred at each time point
+        :param fingerprint: int, fingerprint of the logs the samples were computed from
+        :return:
+        """
+        path = self._patient_path(patient_id)
+        with open(path + '.tmp', 'wb') as timeline_file:
+            pickle.dump((timepoints, samples, fingerprint), timeline_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+    def invalidate(self, patient_id=None):
+        """
+        Removes the stored timeline of a patient, or of all patients
+        :param patient_id: str, id of the patient, None for all patients
+        :return:
+        """
+        if patient_id is None:
+            file_names = [file_name for file_name in os.listdir(self.store_folder) if file_name.endswith('.pkl')]
+        else:
+            file_names = [f'{patient_id}.pkl']
+        for file_name in file_names:
+            path = os.path.join(self.store_folder, file_name)
+            if os.path.exists(path):
+                os.remove(path)
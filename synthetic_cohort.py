@@ -0,0 +1,193 @@
+import argparse
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from dbconnector import LOINC_DATA_FILE, MEDICAL_DATA_COLUMNS, MEDICAL_DATA_FILE, PERSONAL_DATA_FILE
+
+# Values of every test known to the system - numeric tests are drawn from a clipped normal distribution
+# (mean, std, min, max, decimals), coded tests from their categories
+TEST_VALUE_DISTRIBUTIONS = {
+    '718-7': {'units': 'g/dL', 'numeric': (12.5, 2.5, 6.0, 18.0, 1)},
+    '53286-1': {'units': 'cells/µL', 'numeric': (8000, 3000, 1000, 20000, 0)},
+    '386661006': {'units': '°C', 'numeric': (37.6, 0.9, 35.5, 41.5, 1)},
+    '43724002': {'units': None, 'categories': ['Shaking', 'Rigor']},
+    '243865006': {'units': None, 'categories': ['Edema', 'Bronchospasm', 'Severe Bronchospasm',
+                                                'Anaphylactic Shock']},
+    '185823004': {'units': None, 'categories': ['Erythema', 'Desquamation', 'Exfoliation', 'Vesiculation']},
+}
+
+MALE_FIRST_NAMES = ['James', 'Michael', 'David', 'Daniel', 'Robert', 'William', 'Noah', 'Liam', 'Ethan', 'Benjamin',
+                    'Samuel', 'Joseph', 'Adam', 'Thomas', 'Jacob', 'Nathan', 'Oliver', 'Henry', 'Ari', 'Yosef']
+FEMALE_FIRST_NAMES = ['Emily', 'Sophia', 'Olivia', 'Emma', 'Ava', 'Mia', 'Isabella', 'Charlotte', 'Abigail', 'Sarah',
+                      'Rachel', 'Leah', 'Hannah', 'Maya', 'Noa', 'Tamar', 'Grace', 'Chloe', 'Ella', 'Lily']
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez', 'Martinez',
+              'Wilson', 'Anderson', 'Taylor', 'Thomas', 'Moore', 'Jackson', 'Martin', 'Lee', 'Thompson', 'White',
+              'Harris', 'Clark', 'Lewis', 'Walker', 'Hall', 'Allen', 'Young', 'King', 'Wright', 'Scott',
+              'Cohen', 'Levi', 'Mizrahi', 'Peretz', 'Biton', 'Friedman', 'Katz', 'Shapiro', 'Azulay', 'Dahan']
+
+# First measurement time of the cohort, and the span over which patients are admitted
+COHORT_START = np.datetime64('2023-01-01T00:00')
+ADMISSION_SPAN_DAYS = 365
+# Average number of measurements of a patient per day of stay
+MEASUREMENTS_PER_DAY = 6
+
+
+def generate_patients(n_patients, rng):
+    """
+    Generates the patients personal data, with unique full names
+    :param n_patients: int, number of patients
+    :param rng: numpy Generator
+    :return: DataFrame with the columns of patients.csv
+    """
+    id_width = max(3, len(str(n_patients)))
+    genders = rng.choice(['Male', 'Female'], size=n_patients)
+    first_names = np.where(genders == 'Male',
+                           rng.choice(MALE_FIRST_NAMES, size=n_patients),
+                           rng.choice(FEMALE_FIRST_NAMES, size=n_patients))
+    patients = pd.DataFrame({'ID': [f'P{i:0{id_width}d}' for i in range(1, n_patients + 1)],
+                             'First Name': first_names,
+                             'Last Name': rng.choice(LAST_NAMES, size=n_patients),
+                             'Age': rng.integers(18, 95, size=n_patients),
+                             'Gender': genders})
+    # Names are the keys of the patients in the engine, repeated names get a numbered last name
+    repeat = patients.groupby(['First Name', 'Last Name']).cumcount()
+    patients.loc[repeat > 0, 'Last Name'] += '-' + (repeat[repeat > 0] + 1).astype(str)
+    return patients
+
+
+def draw_test_values(test_names, rng):
+    """
+    Draws a value for every measurement, from the distribution of its test
+    :param test_names: array of loinc nums
+    :param rng: numpy Generator
+    :return: tuple of (values object array, units object array)
+    """
+    values = np.empty(len(test_names), dtype=object)
+    units = np.empty(len(test_names), dtype=object)
+    for test_name, distribution in TEST_VALUE_DISTRIBUTIONS.items():
+        rows = np.flatnonzero(test_names == test_name)
+        if 'numeric' in distribution:
+            mean, std, low, high, decimals = distribution['numeric']
+            test_values = np.clip(rng.normal(mean, std, size=len(rows)), low, high).round(decimals)
+            values[rows] = test_values.astype(int) if decimals == 0 else test_values
+        else:
+            values[rows] = rng.choice(distribution['categories'], size=len(rows))
+        units[rows] = distribution['units']
+    return values, units
+
+
+def generate_medical_data(patient_ids, n_measurements, test_names, rng, update_fraction=0.1, delete_fraction=0.01):
+    """
+    Generates the measurements of a group of patients, with their update and delete history.
+    Every patient is admitted at a random time, and measured a few times a day for as long as its measurements last.
+    Updated measurements get a new version with a later transaction time, deleted versions are marked deleted.
+    :param patient_ids: array of patient ids
+    :param n_measurements: int array, number of measurements of every patient (not counting updates)
+    :param test_names: list of the loinc nums to measure
+    :param rng: numpy Generator
+    :param update_fraction: float, fraction of the measurements that are updated
+    :param delete_fraction: float, fraction of the rows that are deleted
+    :return: DataFrame with the medical data columns, sorted by patient and time
+    """
+    n_rows = int(n_measurements.sum())
+    patient_rows = np.repeat(np.arange(len(patient_ids)), n_measurements)
+    admissions = COHORT_START + (rng.integers(0, ADMISSION_SPAN_DAYS * 24 * 4, size=len(patient_ids)) * 15).astype(
+        'timedelta64[m]')
+    # Measurements are spread over the stay of every patient, on a quarter hour grid
+    stay_minutes = np.maximum(n_measurements * 24 * 60 // MEASUREMENTS_PER_DAY, 15)
+    offsets = (rng.random(n_rows) * stay_minutes[patient_rows] // 15 * 15).astype('timedelta64[m]')
+    valid_start = admissions[patient_rows] + offsets
+    tests = np.asarray(test_names, dtype=object)[rng.integers(0, len(test_names), size=n_rows)]
+    # A test is measured at most once at a time, so every update has a single measurement to correct
+    unique_rows = ~pd.DataFrame({'patient': patient_rows, 'test': tests, 'time': valid_start}).duplicated().to_numpy()
+    patient_rows, valid_start, tests = patient_rows[unique_rows], valid_start[unique_rows], tests[unique_rows]
+    n_rows = len(tests)
+    values, units = draw_test_values(tests, rng)
+    transaction = valid_start + rng.integers(5, 60, size=n_rows).astype('timedelta64[m]')
+
+    # New versions of updated measurements - same measurement time, a new value recorded up to 3 days later
+    updated = np.flatnonzero(rng.random(n_rows) < update_fraction)
+    update_values, _ = draw_test_values(tests[updated], rng)
+    update_transaction = transaction[updated] + rng.integers(60, 3 * 24 * 60, size=len(updated)).astype(
+        'timedelta64[m]')
+
+    rows = np.concatenate([np.arange(n_rows), updated])
+    medical_data = pd.DataFrame({'Patient ID': np.asarray(patient_ids, dtype=object)[patient_rows[rows]],
+                                 'Test Name': tests[rows],
+                                 'Value': np.concatenate([values, update_values]),
+                                 'Units': units[rows],
+                                 'Valid Start Time': valid_start[rows].astype('datetime64[ns]'),
+                                 'Valid End Time': valid_start[rows].astype('datetime64[ns]'),
+                                 'Transaction Time': np.concatenate([transaction, update_transaction]).astype(
+                                     'datetime64[ns]'),
+                                 'Deleted': rng.random(len(rows)) < delete_fraction})
+    medical_data['patient_order'] = patient_rows[rows]
+    medical_data = medical_data.sort_values(['patient_order', 'Valid Start Time', 'Transaction Time'], kind='stable')
+    return medical_data[MEDICAL_DATA_COLUMNS].reset_index(drop=True)
+
+
+def generate_cohort(output_folder, n_patients=1000, n_rows=100000, seed=0, update_fraction=0.1, delete_fraction=0.01,
+                    loinc_source=os.path.dirname(os.path.abspath(__file__)), chunk_patients=10000):
+    """
+    Writes a synthetic db folder - patients.csv, patient_data.csv and loinc_data.csv, in the format the db connector
+    saves them. Patients are generated in chunks and appended to the medical data file, so the memory used does not
+    grow with the size of the cohort.
+    :param output_folder: str, folder to write the files to, created if missing
+    :param n_patients: int, number of patients
+    :param n_rows: int, approximate number of rows of the medical data, including updated versions
+    :param seed: int, seed of the random generator - the same arguments always generate the same cohort
+    :param update_fraction: float, fraction of the measurements that are updated
+    :param delete_fraction: float, fraction of the rows that are deleted
+    :param loinc_source: str, folder of the loinc_data.csv to copy
+    :param chunk_patients: int, number of patients generated at once
+    :return: dictionary with the number of patients and rows written
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    loinc_path = os.path.join(output_folder, LOINC_DATA_FILE)
+    if os.path.abspath(os.path.join(loinc_source, LOINC_DATA_FILE)) != os.path.abspath(loinc_path):
+        shutil.copyfile(os.path.join(loinc_source, LOINC_DATA_FILE), loinc_path)
+    loinc_ids = pd.read_csv(loinc_path, dtype={'id': str})['id']
+    test_names = [test_name for test_name in loinc_ids if test_name in TEST_VALUE_DISTRIBUTIONS]
+    if not test_names:
+        raise ValueError(f'No test of {loinc_path} has a known value distribution')
+
+    patients = generate_patients(n_patients, rng)
+    patients.to_csv(os.path.join(output_folder, PERSONAL_DATA_FILE), index=False)
+
+    # Measurements are split between the patients at random, every patient gets at least one
+    n_measurements = 1 + rng.multinomial(max(int(n_rows / (1 + update_fraction)) - n_patients, 0),
+                                         np.full(n_patients, 1 / n_patients))
+    medical_data_path = os.path.join(output_folder, MEDICAL_DATA_FILE)
+    written_rows = 0
+    with open(medical_data_path + '.tmp', 'w', encoding='utf-8', newline='') as medical_data_file:
+        for start in range(0, n_patients, chunk_patients):
+            chunk = slice(start, start + chunk_patients)
+            medical_data = generate_medical_data(patients['ID'].to_numpy()[chunk], n_measurements[chunk], test_names,
+                                                 rng, update_fraction, delete_fraction)
+            # Written as saved by the db connector, times are formatted by numpy which is much faster than pandas
+            for col in ['Valid Start Time', 'Valid End Time', 'Transaction Time']:
+                medical_data[col] = np.char.replace(
+                    np.datetime_as_string(medical_data[col].to_numpy(dtype='datetime64[s]')), 'T', ' ')
+            medical_data['Deleted'] = medical_data['Deleted'].astype(int)
+            medical_data.to_csv(medical_data_file, index=False, header=start == 0)
+            written_rows += len(medical_data)
+    os.replace(medical_data_path + '.tmp', medical_data_path)
+    return {'patients': n_patients, 'rows': written_rows}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generates a synthetic cohort db folder')
+    parser.add_argument('output_folder')
+    parser.add_argument('--patients', type=int, default=1000)
+    parser.add_argument('--rows', type=int, default=100000, help='approximate number of medical data rows')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--update-fraction', type=float, default=0.1)
+    parser.add_argument('--delete-fraction', type=float, default=0.01)
+    args = parser.parse_args()
+    written = generate_cohort(args.output_folder, args.patients, args.rows, args.seed, args.update_fraction,
+                              args.delete_fraction)
+    print(f'Wrote {written["patients"]} patients and {written["rows"]} rows to {args.output_folder}')
@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from as_of_snapshots import AsOfSnapshots
+from bitemporal_index import BitemporalIndex
+
+CHECKPOINT_INTERVAL = 7
+
+
+@pytest.fixture(scope='module')
+def medical_data():
+    """
+    Measurements with many versions each - few valid start times, transaction times with ties, some rows deleted
+    """
+    rng = np.random.default_rng(24)
+    rows_count = 300
+    return pd.DataFrame({'Patient ID': rng.choice(['P001', 'P002', 'P003'], rows_count),
+                         'Test Name': rng.choice(['718-7', '386661006'], rows_count),
+                         'Valid Start Time': pd.Timestamp('2024-07-01 08:00') +
+                                             pd.to_timedelta(rng.integers(0, 5, rows_count), unit='D'),
+                         'Transaction Time': pd.Timestamp('2024-07-01 09:00') +
+                                             pd.to_timedelta(rng.integers(0, 120, rows_count) * 10, unit='m'),
+                         'Deleted': rng.random(rows_count) < 0.15})
+
+
+def _brute_force_as_of(medical_data, pov, with_deleted=True):
+    """
+    :return: sorted labels of the latest version of every measurement recorded up to pov - the latest version that is
+             not deleted, if with_deleted
+    """
+    known = medical_data[medical_data['Transaction Time'] <= pov]
+    if with_deleted:
+        known = known[~known['Deleted']]
+    latest = (known.assign(label=known.index).sort_values(['Transaction Time', 'label'])
+              .drop_duplicates(['Patient ID', 'Test Name', 'Valid Start Time'], keep='last'))
+    return np.sort(latest.index.to_numpy())
+
+
+def _povs(medical_data):
+    transaction = np.unique(medical_data['Transaction Time'].to_numpy())
+    return np.concatenate([[transaction[0] - np.timedelta64(1, 'h')],  # Before all the rows
+                           transaction,
+                           transaction[:-1] + (transaction[1:] - transaction[:-1]) // 2,  # Between recorded times
+                           [transaction[-1] + np.timedelta64(1, 'D')]])
+
+
+def _assert_matches_brute_force(snapshots, medical_data, deleted=None):
+    """
+    :param medical_data: DataFrame of the rows kept in the snapshots
+    :param deleted: bool array of the deleted flags by label, defaults to the flags of medical_data
+    """
+    if deleted is None:
+        deleted = medical_data['Deleted'].to_numpy()
+    for pov in _povs(medical_data):
+        assert np.array_equal(snapshots.lookup(pov, deleted), _brute_force_as_of(medical_data, pov)), pov
+        # With no deleted flags, the deleted versions themselves are the latest
+        assert np.array_equal(snapshots.lookup(pov), _brute_force_as_of(medical_data, pov, with_deleted=False)), pov
+
+
+def test_lookup_matches_brute_force_across_checkpoints(medical_data):
+    snapshots = AsOfSnapshots(medical_data, checkpoint_interval=CHECKPOINT_INTERVAL)
+    assert len(snapshots.checkpoint_ends) >= len(medical_data) // CHECKPOINT_INTERVAL // 2
+    assert snapshots.lookup(medical_data['Transaction Time'].min() - pd.Timedelta(minutes=1)).tolist() == []
+    _assert_matches_brute_force(snapshots, medical_data)
+
+
+def test_checkpoints_hold_all_the_rows_recorded_at_their_time(medical_data):
+    snapshots = AsOfSnapshots(medical_data, checkpoint_interval=CHECKPOINT_INTERVAL)
+    for end in snapshots.checkpoint_ends:
+        assert end == len(snapshots.transaction) or snapshots.transaction[end] > snapshots.transaction[end - 1]
+
+
+def test_added_rows_match_brute_force(medical_data):
+    # Rows are added in batches of transaction time, as they are recorded - updates of earlier measurements among them
+    transaction_times = np.sort(medical_data['Transaction Time'].unique())
+    first_rows = medical_data[medical_data['Transaction Time'] < transaction_times[40]]
+    snapshots = AsOfSnapshots(first_rows, checkpoint_interval=CHECKPOINT_INTERVAL)
+    index = BitemporalIndex(first_rows)
+    for batch_start, batch_end in zip(transaction_times[40::9], list(transaction_times[49::9]) + [None]):
+        in_batch = medical_data['Transaction Time'] >= batch_start
+        if batch_end is not None:
+            in_batch &= medical_data['Transaction Time'] < batch_end
+        new_rows = medical_data[in_batch]
+        index.add_rows(new_rows)
+        assert snapshots.add_rows(new_rows, index.previous_versions(new_rows))
+    assert len(snapshots.labels) == len(medical_data)
+    _assert_matches_brute_force(snapshots, medical_data)
+
+
+def test_rows_recorded_before_the_kept_rows_are_not_added(medical_data):
+    latest = medical_data['Transaction Time'].max()
+    snapshots = AsOfSnapshots(medical_data[medical_data['Transaction Time'] == latest], CHECKPOINT_INTERVAL)
+    earlier_rows = medical_data[medical_data['Transaction Time'] < latest].iloc[:3]
+    assert not snapshots.add_rows(earlier_rows, np.full(len(earlier_rows), -1))
+
+
+def test_rows_added_to_a_copy_leave_the_snapshots_unchanged(medical_data):
+    latest = medical_data['Transaction Time'].max()
+    first_rows, last_rows = (medical_data[medical_data['Transaction Time'] < latest],
+                             medical_data[medical_data['Transaction Time'] == latest])
+    snapshots = AsOfSnapshots(first_rows, checkpoint_interval=CHECKPOINT_INTERVAL)
+    index = BitemporalIndex(medical_data)
+
+    snapshots_copy = snapshots.copy()
+    assert snapshots_copy.add_rows(last_rows, index.previous_versions(last_rows))
+
+    _assert_matches_brute_force(snapshots, first_rows, medical_data['Deleted'].to_numpy())
+    _assert_matches_brute_force(snapshots_copy, medical_data)
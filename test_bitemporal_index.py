@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from bitemporal_index import BitemporalIndex
+
+PATIENTS = ['P001', 'P002', 'P003']
+TESTS = ['718-7', '386661006', '1234-5']
+# Windows of the tests known to system, '1234-5' has none
+TEST_WINDOWS = {'718-7': (np.timedelta64(3, 'h'), np.timedelta64(2, 'h')),
+                '386661006': (np.timedelta64(0, 'h'), np.timedelta64(1, 'D'))}
+
+
+@pytest.fixture(scope='module')
+def medical_data():
+    """
+    Measurements on an hourly grid, so validity windows start and end exactly at other measurement times
+    """
+    rng = np.random.default_rng(25)
+    rows_count = 400
+    valid_start = pd.Timestamp('2024-07-01 08:00') + pd.to_timedelta(rng.integers(0, 72, rows_count), unit='h')
+    return pd.DataFrame({'Patient ID': rng.choice(PATIENTS, rows_count),
+                         'Test Name': rng.choice(TESTS, rows_count),
+                         'Valid Start Time': valid_start,
+                         'Transaction Time': valid_start + pd.to_timedelta(rng.integers(0, 48, rows_count), unit='h'),
+                         'Deleted': rng.random(rows_count) < 0.1})
+
+
+def _time_points(medical_data):
+    times = np.unique(medical_data['Valid Start Time'].to_numpy())
+    return np.concatenate([times, times + np.timedelta64(30, 'm'), [times[0] - np.timedelta64(1, 'D')]])
+
+
+def _brute_force_lookup(medical_data, patient_id, test_name, valid_from, valid_to, pov=None):
+    selected = ((medical_data['Patient ID'] == patient_id) & (medical_data['Test Name'] == test_name) &
+                (medical_data['Valid Start Time'] >= valid_from) & (medical_data['Valid Start Time'] <= valid_to))
+    if pov is not None:
+        selected &= medical_data['Transaction Time'] <= pov
+    return np.sort(medical_data.index[selected].to_numpy())
+
+
+def _brute_force_valid_at(medical_data, patient_id, target_time):
+    """
+    A row is valid while: valid start - good before < target time <= valid start + good after
+    """
+    good_before = medical_data['Test Name'].map(lambda test_name: TEST_WINDOWS.get(test_name, (None, None))[0])
+    good_after = medical_data['Test Name'].map(lambda test_name: TEST_WINDOWS.get(test_name, (None, None))[1])
+    known_test = good_before.notna()
+    valid_start = medical_data['Valid Start Time']
+    selected = (known_test & (medical_data['Patient ID'] == patient_id) &
+                (valid_start - pd.to_timedelta(good_before.where(known_test, pd.Timedelta(0))) < target_time) &
+                (target_time <= valid_start + pd.to_timedelta(good_after.where(known_test, pd.Timedelta(0)))))
+    return np.sort(medical_data.index[selected].to_numpy())
+
+
+def _brute_force_previous_versions(medical_data, new_rows):
+    """
+    :return: the label of the latest version recorded before every new row, of its measurement
+    """
+    previous = []
+    for label, row in new_rows.iterrows():
+        versions = medical_data[(medical_data['Patient ID'] == row['Patient ID']) &
+                                (medical_data['Test Name'] == row['Test Name']) &
+                                (medical_data['Valid Start Time'] == row['Valid Start Time'])]
+        versions = versions.assign(label=versions.index).sort_values(['Transaction Time', 'label'])
+        position = versions.index.get_loc(label)
+        previous.append(versions.index[position - 1] if position > 0 else -1)
+    return np.array(previous)
+
+
+def _assert_matches_brute_force(index, medical_data):
+    times = _time_points(medical_data)
+    for patient_id in PATIENTS + ['P999']:
+        for target_time in times:
+            assert np.array_equal(index.lookup_valid_at(patient_id, TEST_WINDOWS, target_time),
+                                  _brute_force_valid_at(medical_data, patient_id, target_time)), \
+                (patient_id, target_time)
+        for test_name in TESTS:
+            for valid_from, valid_to, pov in zip(times[:40], times[20:60], [None, times[50]] * 20):
+                assert np.array_equal(index.lookup(patient_id, test_name, valid_from, valid_to, pov),
+                                      _brute_force_lookup(medical_data, patient_id, test_name, valid_from, valid_to,
+                                                          pov)), (patient_id, test_name, valid_from, valid_to, pov)
+
+
+def test_lookups_match_brute_force(medical_data):
+    _assert_matches_brute_force(BitemporalIndex(medical_data), medical_data)
+
+
+def test_added_rows_match_brute_force(medical_data):
+    index = BitemporalIndex(medical_data.iloc[:150])
+    for batch_start in range(150, len(medical_data), 50):
+        new_rows = medical_data.iloc[batch_start:batch_start + 50]
+        index.add_rows(new_rows)
+        # Added in label order - tied transaction times keep the earlier label first, as the brute force orders them
+        assert np.array_equal(index.previous_versions(new_rows),
+                              _brute_force_previous_versions(medical_data.iloc[:batch_start + 50], new_rows))
+    _assert_matches_brute_force(index, medical_data)
+
+
+def test_rows_added_to_a_copy_leave_the_index_unchanged(medical_data):
+    index = BitemporalIndex(medical_data.iloc[:200])
+    index_copy = index.copy()
+    index_copy.add_rows(medical_data.iloc[200:])
+
+    _assert_matches_brute_force(index, medical_data.iloc[:200])
+    _assert_matches_brute_force(index_copy, medical_data)
+
+
+@pytest.mark.parametrize('target_time, is_valid', [
+    ('2024-07-01 05:00', False),  # Valid start - good before is excluded
+    ('2024-07-01 05:01', True),
+    ('2024-07-01 10:00', True),  # Valid start + good after is included
+    ('2024-07-01 10:01', False),
+])
+def test_validity_window_edges(target_time, is_valid):
+    medical_data = pd.DataFrame({'Patient ID': ['P001'], 'Test Name': ['718-7'],
+                                 'Valid Start Time': pd.to_datetime(['2024-07-01 08:00']),
+                                 'Transaction Time': pd.to_datetime(['2024-07-01 09:00']), 'Deleted': [False]})
+    labels = BitemporalIndex(medical_data).lookup_valid_at('P001', TEST_WINDOWS, pd.Timestamp(target_time))
+    assert labels.tolist() == ([0] if is_valid else [])
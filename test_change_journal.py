@@ -0,0 +1,176 @@
+import os
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+from change_journal import ChangeJournal, apply_journal_records
+from compact_table import CATEGORICAL_MEDICAL_COLUMNS, compact_medical_data
+from dbconnector import DBConnector, MEDICAL_DATA_COLUMNS, MEDICAL_DATA_FILE
+
+
+def _insert_record(label, value='12.5', valid_start='2024-09-01T08:00:00'):
+    return {'op': 'insert', 'row': label,
+            'data': {'Patient ID': 'P001', 'Test Name': '718-7', 'Value': value, 'Units': 'g/dL',
+                     'Valid Start Time': valid_start, 'Valid End Time': valid_start,
+                     'Transaction Time': '2024-09-01T09:00:00', 'Deleted': False}}
+
+
+def _base_rows(values):
+    times = pd.to_datetime([f'2024-07-0{day + 1} 08:00' for day in range(len(values))])
+    return compact_medical_data(pd.DataFrame({'Patient ID': 'P002', 'Test Name': '718-7', 'Value': values,
+                                              'Units': 'g/dL', 'Valid Start Time': times, 'Valid End Time': times,
+                                              'Transaction Time': times, 'Deleted': False})[MEDICAL_DATA_COLUMNS])
+
+
+def _comparable(medical_data):
+    """
+    :return: the medical data with plain columns - categories depend on the order the values were added in
+    """
+    return medical_data.astype({col: object for col in CATEGORICAL_MEDICAL_COLUMNS})
+
+
+@pytest.fixture
+def journal(tmp_path):
+    return ChangeJournal(str(tmp_path / 'patient_data.journal'))
+
+
+def test_appended_records_are_read_back_in_order(journal):
+    records = [_insert_record(0), _insert_record(1, value='13')]
+    journal.append(records)
+    journal.append([{'op': 'delete', 'row': 0}])
+
+    assert journal.entries_count == 3
+    assert journal.read() == records + [{'op': 'delete', 'row': 0}]
+    assert ChangeJournal(journal.journal_path).read() == records + [{'op': 'delete', 'row': 0}]
+
+
+def test_partially_written_last_line_is_ignored(journal):
+    journal.append([_insert_record(0)])
+    with open(journal.journal_path, 'a', encoding='utf-8') as journal_file:
+        journal_file.write('{"op": "insert", "row": 1, "da')
+
+    assert journal.read() == [_insert_record(0)]
+    assert journal.entries_count == 1
+
+
+def test_rotated_records_are_read_until_the_compaction_finishes(journal):
+    assert not journal.rotate()  # Nothing to compact
+
+    journal.append([_insert_record(0)])
+    assert journal.rotate()
+    assert journal.entries_count == 0
+    journal.append([_insert_record(1)])
+    assert journal.read() == [_insert_record(0), _insert_record(1)]
+
+    # A compaction that did not finish is folded together with the records journaled since
+    assert journal.rotate()
+    assert not os.path.exists(journal.journal_path)
+    assert journal.read() == [_insert_record(0), _insert_record(1)]
+
+    journal.finish_compaction()
+    assert journal.read() == []
+    assert not journal.rotate()
+
+
+def test_compacted_record_skips_the_records_folded_into_the_base_file(journal, tmp_path):
+    base_file_path = str(tmp_path / MEDICAL_DATA_FILE)
+    with open(base_file_path, 'wb') as base_file:
+        base_file.write(b'old base file\n')
+    journal.append([_insert_record(0)])
+    journal.rotate()
+    with open(base_file_path + '.tmp', 'wb') as base_file:
+        base_file.write(b'new base file\n')
+    journal.mark_compacted(base_file_path + '.tmp')
+    journal.append([_insert_record(1)])
+
+    # Stopped before the new base file replaced the old one - the rotated records are still needed
+    assert journal.read(base_file_path) == [_insert_record(0), _insert_record(1)]
+
+    # Stopped after the replace - the rotated records are in the base file, rows appended to it since do not matter
+    os.replace(base_file_path + '.tmp', base_file_path)
+    with open(base_file_path, 'ab') as base_file:
+        base_file.write(b'appended row\n')
+    assert journal.read(base_file_path) == [_insert_record(1)]
+    assert journal.entries_count == 1
+
+
+def test_journaled_rows_keep_their_labels_on_replay():
+    # Label 3 was journaled when the base file held 3 rows, other writers appended 2 rows to the file since
+    base_rows = _base_rows(['10', '11', '12', '13', '14'])
+    records = [_insert_record(3, value='9'),
+               {'op': 'batch', 'records': [_insert_record(9, value='8'), {'op': 'delete', 'row': 3}]},
+               {'op': 'delete', 'row': 1},
+               _insert_record(3, value='7')]  # A label is inserted once
+
+    medical_data = apply_journal_records(base_rows, records)
+
+    assert medical_data['Value'].tolist() == ['10', '11', '12', '9', '13', '14', '8']
+    assert medical_data.index.tolist() == list(range(7))
+    assert medical_data['Deleted'].tolist() == [False, True, False, True, False, False, False]
+    assert medical_data.loc[3, 'Valid Start Time'] == datetime(2024, 9, 1, 8, 0)
+
+
+def test_compaction_folds_the_journal_into_the_base_file(connector, db_folder):
+    connector.insert_patients_data([{'Patient ID': 'P001', 'Test Name': '718-7', 'Value': 12.5,
+                                     'Valid Start Time': datetime(2024, 9, 1, 8, 0)}])
+    connector.correct_patients_data([{'Patient ID': 'P001', 'Test Name': '718-7', 'Action': 'delete',
+                                      'Measurement Time': '01.07.2024 08:00'}])
+    expected = _comparable(connector.patients_medical_data)
+
+    connector.compact_journal()
+
+    assert connector.read_journal() == []
+    assert not os.path.exists(connector.journal.journal_path)
+    assert not os.path.exists(connector.journal.compacting_path)
+    pd.testing.assert_frame_equal(_comparable(DBConnector(str(db_folder)).patients_medical_data), expected)
+
+
+def test_journal_is_compacted_in_the_background_past_the_threshold(db_folder):
+    connector = DBConnector(str(db_folder), journal_compaction_threshold=2)
+    for day in [1, 2]:
+        connector.insert_patients_data([{'Patient ID': 'P001', 'Test Name': '718-7', 'Value': 12.5,
+                                         'Valid Start Time': datetime(2024, 9, day, 8, 0)}])
+    connector._compaction_thread.join(timeout=30)
+
+    assert connector.read_journal() == []
+    pd.testing.assert_frame_equal(_comparable(DBConnector(str(db_folder)).patients_medical_data),
+                                  _comparable(connector.patients_medical_data))
+
+
+@pytest.mark.parametrize('stopped_after', ['rotate', 'replace'])
+def test_half_finished_compaction_is_recovered(connector, db_folder, stopped_after):
+    connector.insert_patients_data([{'Patient ID': 'P001', 'Test Name': '718-7', 'Value': 12.5,
+                                     'Valid Start Time': datetime(2024, 9, 1, 8, 0)}])
+    # The steps of compact_journal, up to a crash
+    connector.journal.rotate()
+    if stopped_after == 'replace':
+        connector.save_quarantined_medical_data()
+        connector.save_patients_medical_data(before_replace=connector.journal.mark_compacted)
+    expected = _comparable(connector.patients_medical_data)
+
+    recovered = DBConnector(str(db_folder))
+    pd.testing.assert_frame_equal(_comparable(recovered.patients_medical_data), expected)
+    recovered.insert_patients_data([{'Patient ID': 'P002', 'Test Name': '718-7', 'Value': 11.5,
+                                     'Valid Start Time': datetime(2024, 9, 1, 8, 0)}])
+    expected = _comparable(recovered.patients_medical_data)
+
+    recovered.compact_journal()
+    assert not os.path.exists(recovered.journal.compacting_path)
+    pd.testing.assert_frame_equal(_comparable(DBConnector(str(db_folder)).patients_medical_data), expected)
+
+
+def test_replay_keeps_the_labels_of_ingested_rows(connector, db_folder):
+    connector.insert_patients_data([{'Patient ID': 'P001', 'Test Name': '718-7', 'Value': 12.5,
+                                     'Valid Start Time': datetime(2024, 9, 1, 8, 0)}])
+    with open(os.path.join(db_folder, MEDICAL_DATA_FILE), 'a', encoding='utf-8') as data_file:
+        data_file.write('P002,718-7,11.5,g/dL,02/09/2024 8:00,02/09/2024 8:00,02/09/2024 9:00,FALSE\n')
+    ingested = connector.ingest_appended_medical_data()
+    connector.correct_patients_data([{'Patient ID': 'P002', 'Test Name': '718-7', 'Action': 'delete',
+                                      'Measurement Time': '02.09.2024 08:00'}])
+
+    reopened = DBConnector(str(db_folder))
+    pd.testing.assert_frame_equal(_comparable(reopened.patients_medical_data),
+                                  _comparable(connector.patients_medical_data))
+    assert reopened.patients_medical_data.loc[ingested.index[0], 'Patient ID'] == 'P002'
+    assert reopened.patients_medical_data.loc[ingested.index[0], 'Deleted']
@@ -0,0 +1,209 @@
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+
+from dbconnector import DBConnector, MEDICAL_DATA_FILE, QUARANTINE_DATA_FILE
+from sqlite_connector import SQLiteDBConnector
+
+# Lines of new rows, as other writers append them to the medical data file
+P001_LINE = 'P001,718-7,12.5,g/dL,01/09/2024 8:00,01/09/2024 8:00,01/09/2024 9:00,FALSE\r\n'
+P002_LINE = 'P002,718-7,11.5,g/dL,01/09/2024 8:00,01/09/2024 8:00,01/09/2024 9:00,FALSE\r\n'
+
+
+def test_appends_during_snapshot_queries_read_a_single_state(connector):
+    connector.get_valid_tests_snapshot('30.08.2024', '08:00')  # The as of snapshots exist, so appends extend them
+    errors = []
+
+    def append_measurements():
+        try:
+            for i in range(60):
+                connector.insert_patients_data([{'Patient ID': 'P001', 'Test Name': '718-7', 'Value': 12 + i % 3,
+                                                 'Valid Start Time': datetime(2024, 9, 1, 10, 0)}],
+                                               transaction_time=datetime(2024, 9, 1) + timedelta(minutes=i))
+        except Exception as e:
+            errors.append(e)
+
+    writer = threading.Thread(target=append_measurements, daemon=True)
+    writer.start()
+    while writer.is_alive():
+        for use_pov in (True, False):
+            snapshot = connector.get_valid_tests_snapshot('01.09.2024', '12:00', use_pov=use_pov)
+            assert not snapshot.duplicated(['Patient ID', 'Test Name']).any()
+        connector.get_patients_valid_tests_for_timeframe('P001', '01.09.2024', '12:00')
+    writer.join()
+
+    assert errors == []
+    snapshot = connector.get_valid_tests_snapshot('01.09.2024', '12:00')
+    hemoglobin = snapshot[(snapshot['Patient ID'] == 'P001') & (snapshot['Test Name'] == '718-7')]
+    assert hemoglobin['Transaction Time'].tolist() == [datetime(2024, 9, 1, 0, 59)]
+    assert hemoglobin.index.tolist() == [len(connector.patients_medical_data) - 1]
+
+
+def test_invalid_rows_are_set_aside_without_printing_patient_data(db_folder, capsys, caplog):
+    with caplog.at_level(logging.WARNING, logger='dbconnector'):
+        connector = DBConnector(str(db_folder))
+
+    assert capsys.readouterr().out == ''
+    messages = [record.getMessage() for record in caplog.records]
+    assert messages == ['Set aside 1 medical data entries with invalid values']
+    assert len(connector.quarantined_medical_data) == 1
+
+
+def test_set_aside_rows_are_not_retrieved_and_move_to_the_quarantine_file(connector, db_folder):
+    historic = connector.retrieve_patient_data('P015', '43724002', '31.08.2024', None, historic=True,
+                                               prev_date='30.08.2024')
+    assert historic['Valid Start Time'].tolist() == [datetime(2024, 8, 30, 8, 0)]
+
+    connector.insert_patients_data([{'Patient ID': 'P001', 'Test Name': '718-7', 'Value': 12.5,
+                                     'Valid Start Time': datetime(2024, 9, 1, 8, 0)}])
+    connector.compact_journal()  # Rewrites the base file, once there are journaled changes
+    quarantined = pd.read_csv(os.path.join(db_folder, QUARANTINE_DATA_FILE), dtype={'Test Name': str})
+    assert quarantined[['Patient ID', 'Test Name', 'Valid Start Time']].values.tolist() == [
+        ['P015', '43724002', '2024-08-31 08:00:00']]
+    assert quarantined['Value'].isna().all()
+    assert len(DBConnector(str(db_folder)).quarantined_medical_data) == 0  # Dropped from the rewritten base file
+
+
+def _append_to_medical_data_file(db_folder, text):
+    with open(os.path.join(db_folder, MEDICAL_DATA_FILE), 'a', encoding='utf-8', newline='') as data_file:
+        data_file.write(text)
+
+
+def test_appended_rows_are_ingested_with_the_next_labels(connector, db_folder):
+    rows_count = len(connector.patients_medical_data)
+    _append_to_medical_data_file(db_folder, P001_LINE + P002_LINE)
+
+    ingested = connector.ingest_appended_medical_data()
+
+    assert ingested.index.tolist() == [rows_count, rows_count + 1]
+    assert connector.patients_medical_data.loc[ingested.index, 'Patient ID'].tolist() == ['P001', 'P002']
+    assert connector.patients_medical_data.loc[rows_count, 'Valid Start Time'] == datetime(2024, 9, 1, 8, 0)
+    assert len(connector.ingest_appended_medical_data()) == 0  # Nothing new
+    assert not connector.reload_data_source(MEDICAL_DATA_FILE)
+
+
+def test_partially_written_last_line_is_ingested_once_complete(connector, db_folder):
+    rows_count = len(connector.patients_medical_data)
+    _append_to_medical_data_file(db_folder, P001_LINE + P002_LINE[:40])
+    assert connector.ingest_appended_medical_data().index.tolist() == [rows_count]
+
+    _append_to_medical_data_file(db_folder, P002_LINE[40:])
+    ingested = connector.ingest_appended_medical_data()
+    assert ingested.index.tolist() == [rows_count + 1]
+    assert connector.patients_medical_data.loc[rows_count + 1, 'Valid End Time'] == datetime(2024, 9, 1, 8, 0)
+
+
+@pytest.mark.parametrize('change', ['rewritten', 'truncated'])
+def test_changed_file_is_reloaded_as_a_whole(connector, db_folder, change):
+    file_path = os.path.join(db_folder, MEDICAL_DATA_FILE)
+    with open(file_path, 'rb') as data_file:
+        lines = data_file.read().splitlines(keepends=True)
+    if change == 'rewritten':  # The last row changed, and a row was appended
+        lines[-1] = lines[-1].replace(b'FALSE', b'TRUE')
+        lines.append(P001_LINE.encode())
+    else:
+        lines = lines[:-3]
+    with open(file_path, 'wb') as data_file:
+        data_file.write(b''.join(lines))
+
+    assert connector.ingest_appended_medical_data() is None
+    assert connector.reload_data_source(MEDICAL_DATA_FILE)
+    reloaded = DBConnector(str(db_folder)).patients_medical_data
+    assert len(connector.patients_medical_data) == len(reloaded) == (1333 if change == 'rewritten' else 1329)
+    assert connector.patients_medical_data['Deleted'].tolist() == reloaded['Deleted'].tolist()
+
+
+@pytest.mark.parametrize('connector_class', [DBConnector, SQLiteDBConnector])
+def test_correction_batch_with_an_invalid_item_is_not_applied(db_folder, connector_class):
+    connector = connector_class(str(db_folder))
+    rows_before = connector.get_medical_data_rows()
+    corrections = [{'Patient ID': 'P001', 'Test Name': '718-7', 'Measurement Time': '01.07.2024 08:00',
+                    'Action': 'update', 'Value': 8},
+                   {'Patient ID': 'P001', 'Test Name': '718-7', 'Measurement Time': '02.07.2024 08:00',
+                    'Action': 'delete'},
+                   {'Patient ID': 'P001', 'Test Name': '718-7', 'Measurement Time': '05.07.2024 08:00',
+                    'Action': 'update', 'Value': 'not a number'},
+                   {'Patient ID': 'P001', 'Test Name': '718-7', 'Measurement Time': '06.07.2024 09:00',
+                    'Action': 'delete'}]
+
+    report = connector.correct_patients_data(corrections)
+
+    assert report['Status'].tolist() == ['batch rejected', 'batch rejected', 'invalid value',
+                                         'no matching measurement']
+    assert report['New Row'].tolist() == [-1] * 4
+    pd.testing.assert_frame_equal(connector.get_medical_data_rows(), rows_before)
+    assert connector.read_journal() == []
+    assert not os.path.exists(connector.journal.journal_path)
+
+    report = connector.correct_patients_data(corrections[:2] + corrections[3:])
+    assert report['Status'].tolist() == ['applied', 'applied', 'no matching measurement']
+    assert len(connector.get_medical_data_rows()) == len(rows_before) + 1
+
+
+def test_inserted_measurements_are_journaled_indexed_and_windowed(connector, db_folder):
+    rows_count = len(connector.patients_medical_data)
+    transaction_time = datetime(2024, 9, 1, 9, 0)
+    inserted = connector.insert_patients_data(
+        [{'Patient ID': 'James Smith', 'Test Name': 'Hemoglobin [Mass/volume] in Blood', 'Value': 12.5,
+          'Valid Start Time': '01.09.2024 08:00'},
+         {'Patient ID': 'P002', 'Test Name': '43724002', 'Value': 'Rigor', 'Units': 'NaN',
+          'Valid Start Time': datetime(2024, 9, 1, 8, 30), 'Valid End Time': datetime(2024, 9, 1, 10, 0)}],
+        transaction_time)
+
+    assert inserted.index.tolist() == [rows_count, rows_count + 1]
+    assert inserted['Patient ID'].tolist() == ['P001', 'P002']
+    assert inserted['Test Name'].tolist() == ['718-7', '43724002']
+    assert inserted['Units'].tolist() == ['g/dL', 'NaN']  # The units of the test, when not given
+    assert inserted['Valid End Time'].tolist() == [datetime(2024, 9, 1, 8, 0), datetime(2024, 9, 1, 10, 0)]
+    assert inserted['Transaction Time'].tolist() == [transaction_time] * 2
+    assert not inserted['Deleted'].any()
+
+    records = connector.read_journal()
+    assert [(record['op'], record['row']) for record in records] == [('insert', rows_count), ('insert', rows_count + 1)]
+    assert records[0]['data']['Valid Start Time'] == '2024-09-01T08:00:00'
+
+    assert connector.validity_windows.loc[rows_count].tolist() == [datetime(2024, 9, 1, 5, 0),
+                                                                   datetime(2024, 9, 1, 11, 0)]
+    assert connector.numeric_values.loc[rows_count] == 12.5
+    valid_tests = connector.get_patients_valid_tests_for_timeframe('P001', '01.09.2024', '10:00')
+    assert valid_tests.index.tolist() == [rows_count]
+    assert connector.retrieve_patient_data('P002', '43724002', '01.09.2024', '01.09.2024', '08:30',
+                                           '09:00').index.tolist() == [rows_count + 1]
+    pd.testing.assert_frame_equal(DBConnector(str(db_folder)).patients_medical_data.loc[inserted.index]
+                                  .astype(object), connector.patients_medical_data.loc[inserted.index].astype(object))
+
+
+@pytest.mark.parametrize('measurement, error', [
+    ({'Patient ID': 'P001', 'Test Name': '718-7', 'Value': 'high'}, 'not a number'),
+    ({'Patient ID': 'P001', 'Test Name': '718-7', 'Value': None}, 'missing value'),
+    ({'Patient ID': 'P001', 'Test Name': '43724002', 'Value': None}, 'missing value'),
+    ({'Patient ID': 'P999', 'Test Name': '718-7', 'Value': 12.5}, 'unknown patient'),
+    ({'Patient ID': 'P001', 'Test Name': '1234-5', 'Value': 12.5}, 'unknown test'),
+    ({'Patient ID': 'P001', 'Test Name': '718-7', 'Value': 12.5, 'Valid Start Time': '2024-09-01 08:00'},
+     'no valid start time'),
+])
+def test_batch_with_an_invalid_measurement_is_not_inserted(connector, measurement, error):
+    rows_count = len(connector.patients_medical_data)
+    valid_measurement = {'Patient ID': 'P002', 'Test Name': '718-7', 'Value': 11.5,
+                         'Valid Start Time': '01.09.2024 08:00'}
+    with pytest.raises(ValueError, match=error):
+        connector.insert_patients_data([valid_measurement, dict({'Valid Start Time': '01.09.2024 08:00'},
+                                                                **measurement)])
+    assert len(connector.patients_medical_data) == rows_count
+    assert connector.read_journal() == []
+
+
+def test_appended_rows_with_invalid_values_are_quarantined(connector, db_folder):
+    rows_count = len(connector.patients_medical_data)
+    _append_to_medical_data_file(db_folder, P001_LINE.replace('12.5', 'high') + P002_LINE)
+
+    ingested = connector.ingest_appended_medical_data()
+
+    assert ingested.index.tolist() == [rows_count]
+    assert ingested['Patient ID'].tolist() == ['P002']
+    assert len(connector.quarantined_medical_data) == 2  # The entry set aside at load, and the appended one
+    assert connector.quarantined_medical_data[-1]['Value'].tolist() == ['high']
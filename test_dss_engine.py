@@ -0,0 +1,67 @@
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+from DssEngine import DSSEngine, STATE_NAMES
+from dbconnector import PERSONAL_DATA_FILE
+from state_timelines import fingerprint_patient_logs
+
+
+@pytest.fixture
+def dss(db_folder):
+    return DSSEngine(str(db_folder))
+
+
+def test_correction_replaces_the_corrected_value_in_the_state_intervals(dss):
+    first_window = [datetime(2024, 7, 1, 11, 0), datetime(2024, 7, 2, 5, 0)]
+    assert first_window in dss.retrieve_state_intervals('P001', 'Hemoglobin State')['Normal_Hemoglobin']
+
+    report = dss.correction_query([{'Patient ID': 'P001', 'Test Name': '718-7', 'Measurement Time': '01.07.2024 08:00',
+                                    'Action': 'update', 'Value': 8, 'Update Time': '01.07.2024 09:00'}])
+    assert report['Status'].tolist() == ['applied']
+
+    intervals = dss.retrieve_state_intervals('P001', 'Hemoglobin State')
+    assert first_window not in intervals['Normal_Hemoglobin']
+    assert first_window in intervals['Severe_Anemia']
+
+
+def test_patient_with_no_logs_has_no_state_values(db_folder):
+    with open(db_folder / PERSONAL_DATA_FILE, 'a', encoding='utf-8') as personal_data_file:
+        personal_data_file.write('P016,Olivia,Brown,29,Female\n')
+    dss = DSSEngine(str(db_folder))
+
+    assert dss.retrieve_state_timelines('P016') == {state: {} for state in STATE_NAMES}
+    assert dss.retrieve_state_intervals('Olivia Brown', 'Hemoglobin State') == {}
+    assert dss.retrieve_state_interval_records('P016') == []
+    assert dss.retrieve_state_intervals('P999', 'Hemoglobin State') is None
+
+
+def _stored_timeline(dss, patient_id):
+    """
+    :return: the stored timeline of a patient, None unless it matches the current logs of the patient
+    """
+    patient_logs, windows, timepoints = dss.get_state_timeline_inputs(patient_id)
+    return dss.timeline_store.load(patient_id, fingerprint_patient_logs(patient_logs, windows,
+                                                                        dss.db_con.get_patients_dict()[patient_id]))
+
+
+@pytest.mark.parametrize('changes', [
+    [('update', 5.0)],
+    [('update', 5.0), ('update', 10.0)],
+    [('delete', None)],
+])
+def test_spliced_timeline_matches_a_full_recompute(dss, changes):
+    before = dss.retrieve_state_timelines('P001')
+    for i, (mode, value) in enumerate(changes):
+        if mode == 'update':
+            changed_row = dss.update_query('P001', '718-7', '02.07.2024', '08:00', '20.12.2024', f'11:4{i}', value)
+        else:
+            changed_row = dss.delete_query('P001', '718-7', '02.07.2024', '08:00')
+        assert isinstance(changed_row, pd.Series)
+        assert _stored_timeline(dss, 'P001') is not None  # Spliced in, with the fingerprint of the changed logs
+
+    spliced = dss.retrieve_state_timelines('P001')
+    dss.timeline_store.invalidate('P001')
+    assert spliced == dss.retrieve_state_timelines('P001')
+    assert spliced != before
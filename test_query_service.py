@@ -0,0 +1,83 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from tornado.httpclient import AsyncHTTPClient
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from query_service import make_app
+
+
+class BlockingEngine:
+    """
+    Stand-in for DSSEngine, whose state inference blocks until released - so all the requests are in flight together
+    """
+
+    def __init__(self):
+        self.released = threading.Event()
+        self.state_calls = []
+
+    def infer_patients_states_for_timepoint(self, time, single_patient_id=None):
+        self.state_calls.append(time)
+        if not self.released.wait(timeout=10):
+            raise RuntimeError('The computation was never released')
+        if time == 'bad':
+            raise ValueError("time data 'bad' does not match format '%d.%m.%Y %H:%M'")
+        return {'P001': {'Name': 'James Smith', 'Time': time}}
+
+    def retrival_query(self, target, patient, date, pov_date, hour=None, pov_hour=None):
+        raise KeyError('Loinc num or Test name provided is not in the DB.')
+
+
+class QueryServiceTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.dss = BlockingEngine()
+        self.executor = ThreadPoolExecutor(max_workers=10)
+        return make_app(self.dss, self.executor)
+
+    def get_http_client(self):
+        return AsyncHTTPClient(force_instance=True, max_clients=30)
+
+    def tearDown(self):
+        self.dss.released.set()
+        super().tearDown()
+        self.executor.shutdown()
+
+    async def wait_for_requests(self, count):
+        coalescer = self._app.coalescer
+        while coalescer.computations + coalescer.coalesced < count:
+            await asyncio.sleep(0.01)
+
+    def fetch_url(self, path, **arguments):
+        return self.http_client.fetch(self.get_url(f'{path}?{urlencode(arguments)}'), raise_error=False)
+
+    @gen_test(timeout=20)
+    async def test_concurrent_identical_requests_share_computations(self):
+        times = [f'0{day}.07.2024 08:00' for day in range(1, 10)] + ['10.07.2024 08:00']
+        requests = [self.fetch_url('/states', time=time) for time in times * 3]
+        await self.wait_for_requests(30)
+        self.dss.released.set()
+        responses = await asyncio.gather(*requests)
+
+        self.assertEqual([response.code for response in responses], [200] * 30)
+        self.assertEqual(self._app.coalescer.computations, 10)
+        self.assertEqual(self._app.coalescer.coalesced, 20)
+        self.assertEqual(sorted(self.dss.state_calls), sorted(times))
+        self.assertIn(b'"Time": "01.07.2024 08:00"', responses[0].body)
+        self.assertEqual(self._app.coalescer.in_flight, {})
+
+    @gen_test(timeout=20)
+    async def test_invalid_requests_respond_400(self):
+        self.dss.released.set()
+        missing_argument = await self.http_client.fetch(self.get_url('/states'), raise_error=False)
+        self.assertEqual(missing_argument.code, 400)
+
+        bad_time = await self.fetch_url('/states', time='bad')
+        self.assertEqual(bad_time.code, 400)
+        self.assertEqual(bad_time.reason, "time data 'bad' does not match format '%d.%m.%Y %H:%M'")
+
+        unknown_test = await self.fetch_url('/retrieve', target='Unknown', patient='P001', date='01.07.2024',
+                                            pov_date='01.07.2024')
+        self.assertEqual(unknown_test.code, 400)
+        self.assertEqual(unknown_test.reason, 'Loinc num or Test name provided is not in the DB.')
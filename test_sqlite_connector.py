@@ -0,0 +1,115 @@
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+from dbconnector import DBConnector
+from sqlite_connector import SQLiteDBConnector
+
+PATIENT_IDS = ['P001', 'P002', 'P003']
+
+
+def _comparable(medical_data):
+    """
+    :return: the medical data with the values and units as text - the csv storage keeps them as categories, the
+             SQLite storage as the values stored in the database
+    """
+    comparable = medical_data.astype({'Patient ID': str, 'Test Name': str})
+    for col in ['Value', 'Units']:
+        comparable[col] = [None if pd.isna(value) else str(value) for value in medical_data[col]]
+    return comparable
+
+
+def _assert_same_rows(sqlite_rows, csv_rows):
+    pd.testing.assert_frame_equal(_comparable(sqlite_rows), _comparable(csv_rows), check_index_type=False)
+
+
+def _change_both(connectors):
+    """
+    Applies the same insert and correction batch to every connector
+    """
+    for connector in connectors:
+        connector.insert_patients_data(
+            [{'Patient ID': 'P001', 'Test Name': '718-7', 'Value': 12.5, 'Valid Start Time': '01.09.2024 08:00'},
+             {'Patient ID': 'P002', 'Test Name': '43724002', 'Value': 'Rigor',
+              'Valid Start Time': datetime(2024, 9, 1, 8, 30)}],
+            datetime(2024, 9, 1, 9, 0))
+        report = connector.correct_patients_data(
+            [{'Patient ID': 'P001', 'Test Name': '718-7', 'Measurement Time': '01.07.2024 08:00', 'Action': 'update',
+              'Value': 8, 'Update Time': '01.09.2024 10:00'},
+             {'Patient ID': 'P001', 'Test Name': '718-7', 'Measurement Time': '02.07.2024 08:00', 'Action': 'delete'}])
+        assert report['Status'].tolist() == ['applied', 'applied']
+
+
+@pytest.fixture
+def connectors(db_folder):
+    """
+    A SQLite connector and a csv connector, over the same data files
+    """
+    return SQLiteDBConnector(str(db_folder)), DBConnector(str(db_folder))
+
+
+def test_database_is_created_with_the_rows_of_the_csv_files(connectors):
+    sqlite_connector, csv_connector = connectors
+    _assert_same_rows(sqlite_connector.get_medical_data_rows(), csv_connector.get_medical_data_rows())
+
+
+def test_changes_are_kept_when_the_database_is_reopened(connectors, db_folder):
+    sqlite_connector, csv_connector = connectors
+    _change_both(connectors)
+    sqlite_connector.connection.close()
+
+    reopened = SQLiteDBConnector(str(db_folder))
+    _assert_same_rows(reopened.get_medical_data_rows(), csv_connector.get_medical_data_rows())
+    _assert_same_rows(reopened.get_medical_data_rows(), DBConnector(str(db_folder)).get_medical_data_rows())
+
+
+@pytest.mark.parametrize('patient_ids', [None, ['P002'], ['P001', 'P003'], ['P999']])
+@pytest.mark.parametrize('limit', [None, 1, 100, 5000])
+def test_pages_match_the_csv_storage(connectors, patient_ids, limit):
+    sqlite_connector, csv_connector = connectors
+    _change_both(connectors)
+    csv_rows = csv_connector.get_medical_data_rows(patient_ids=patient_ids)
+
+    pages = []
+    for offset in range(0, max(len(csv_rows), 1), limit or len(csv_rows) + 1):
+        page = sqlite_connector.get_medical_data_rows(offset, limit, patient_ids)
+        _assert_same_rows(page, csv_connector.get_medical_data_rows(offset, limit, patient_ids))
+        pages.append(page)
+    _assert_same_rows(pd.concat(pages), csv_rows)
+
+
+@pytest.mark.parametrize('target_key, target_date, target_hour, pov_date, pov_hour, historic', [
+    ('718-7', '01.07.2024', '08:00', '20.12.2024', '12:00', False),
+    ('718-7', '01.07.2024', '08:00', '01.07.2024', '12:00', False),  # Before the correction was recorded
+    ('718-7', '02.07.2024', '08:00', '20.12.2024', '12:00', False),  # Deleted
+    ('718-7', '01.07.2024', '08:00', '20.12.2024', '12:00', True),
+    ('718-7', '01.07.2024', None, '20.12.2024', '12:00', False),
+    ('Hemoglobin [Mass/volume] in Blood', '01.09.2024', '08:00', '20.12.2024', '12:00', False),
+])
+def test_retrieval_matches_the_csv_storage(connectors, target_key, target_date, target_hour, pov_date, pov_hour,
+                                           historic):
+    _change_both(connectors)
+    sqlite_rows, csv_rows = (connector.retrieve_patient_data('P001', target_key, target_date, pov_date,
+                                                             target_hour=target_hour, pov_hour=pov_hour,
+                                                             historic=historic) for connector in connectors)
+    _assert_same_rows(sqlite_rows, csv_rows)
+
+
+@pytest.mark.parametrize('target_date, target_time, use_pov', [
+    ('01.07.2024', '10:00', True),
+    ('02.07.2024', '09:00', True),
+    ('01.09.2024', '10:30', True),
+    ('01.09.2024', '10:30', False),
+])
+def test_valid_tests_match_the_csv_storage(connectors, target_date, target_time, use_pov):
+    _change_both(connectors)
+    for patient_id in PATIENT_IDS:
+        sqlite_rows, csv_rows = (connector.get_patients_valid_tests_for_timeframe(patient_id, target_date,
+                                                                                  target_time, use_pov)
+                                 for connector in connectors)
+        _assert_same_rows(sqlite_rows.sort_values('Test Name'), csv_rows.sort_values('Test Name'))
+    sqlite_rows, csv_rows = (connector.get_valid_tests_snapshot(target_date, target_time, use_pov)
+                             for connector in connectors)
+    _assert_same_rows(sqlite_rows.sort_values(['Patient ID', 'Test Name']),
+                      csv_rows.sort_values(['Patient ID', 'Test Name']))
@@ -0,0 +1,109 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from state_timelines import (StateTimelineStore, fingerprint_patient_logs, hash_patient_logs,
+                             replace_fingerprint_logs)
+
+PATIENT_RECORD = {'Name': 'James Smith', 'Gender': 'Male', 'Age': 45}
+
+
+@pytest.fixture
+def store(tmp_path):
+    return StateTimelineStore(str(tmp_path / 'state_timelines'))
+
+
+@pytest.fixture
+def patient_logs():
+    valid_start = pd.to_datetime(['2024-07-01 08:00', '2024-07-02 08:00', '2024-07-02 08:00'])
+    transaction = pd.to_datetime(['2024-07-01 08:26', '2024-07-02 08:45', '2024-07-03 10:00'])
+    logs = pd.DataFrame({'Patient ID': ['P001'] * 3, 'Test Name': ['718-7'] * 3, 'Value': ['14.1', '13', '9'],
+                         'Valid Start Time': valid_start, 'Transaction Time': transaction,
+                         'Deleted': [False, False, False]}, index=[1, 2, 40])
+    windows = pd.DataFrame({'Window Start': valid_start - pd.Timedelta(hours=3),
+                            'Window End': valid_start + pd.Timedelta(hours=3)}, index=logs.index)
+    return logs, windows
+
+
+def _timeline():
+    timepoints = np.array(['2024-07-01T05:00', '2024-07-01T11:00'], dtype='datetime64[ns]')
+    return timepoints, [{'Hemoglobin State': 'Normal_Hemoglobin'}, {}]
+
+
+def test_saved_timeline_loads_with_its_fingerprint(store):
+    timepoints, samples = _timeline()
+    store.save('P001', timepoints, samples, 7)
+
+    loaded_timepoints, loaded_samples, fingerprint = store.load('P001', 7)
+    assert np.array_equal(loaded_timepoints, timepoints)
+    assert loaded_samples == samples
+    assert fingerprint == 7
+    assert store.load('P001')[2] == 7
+
+
+def test_timeline_of_other_logs_is_not_loaded(store):
+    store.save('P001', *_timeline(), 7)
+    assert store.load('P001', 8) is None
+    assert store.load('P002') is None
+
+
+def test_invalidate_removes_a_patient_or_all(store):
+    for patient_id in ['P001', 'P002', 'P003']:
+        store.save(patient_id, *_timeline(), 7)
+
+    store.invalidate('P001')
+    store.invalidate('P004')  # Never stored
+    assert store.load('P001') is None
+    assert store.load('P002') is not None
+
+    store.invalidate()
+    assert store.load('P002') is None and store.load('P003') is None
+
+
+def test_unreadable_timeline_is_not_loaded(store):
+    with open(os.path.join(store.store_folder, 'P001.pkl'), 'wb') as timeline_file:
+        timeline_file.write(b'not a pickle')
+    assert store.load('P001') is None
+
+
+def test_fingerprint_changes_with_every_input(patient_logs):
+    logs, windows = patient_logs
+    fingerprint = fingerprint_patient_logs(logs, windows, PATIENT_RECORD)
+    assert fingerprint == fingerprint_patient_logs(logs.copy(), windows.copy(), dict(PATIENT_RECORD))
+
+    changed_value = logs.copy()
+    changed_value.loc[40, 'Value'] = '10'
+    deleted = logs.copy()
+    deleted.loc[2, 'Deleted'] = True
+    longer_windows = windows.copy()
+    longer_windows['Window End'] += pd.Timedelta(hours=1)
+    relabeled = logs.rename(index={40: 41})
+    assert len({fingerprint,
+                fingerprint_patient_logs(changed_value, windows, PATIENT_RECORD),
+                fingerprint_patient_logs(deleted, windows, PATIENT_RECORD),
+                fingerprint_patient_logs(logs, longer_windows, PATIENT_RECORD),
+                fingerprint_patient_logs(relabeled, windows.rename(index={40: 41}), PATIENT_RECORD),
+                fingerprint_patient_logs(logs, windows, dict(PATIENT_RECORD, Gender='Female'))}) == 6
+
+
+def test_replaced_logs_fingerprint_matches_a_full_fingerprint(patient_logs):
+    logs, windows = patient_logs
+    old_logs, old_windows = logs.iloc[:2], windows.iloc[:2]
+    fingerprint = fingerprint_patient_logs(old_logs, old_windows, PATIENT_RECORD)
+
+    # A new version is added
+    added = replace_fingerprint_logs(fingerprint, logs.iloc[:0], windows.iloc[:0], logs.loc[[40]], windows.loc[[40]])
+    assert added == fingerprint_patient_logs(logs, windows, PATIENT_RECORD)
+
+    # A log is deleted
+    deleted_logs = logs.copy()
+    deleted_logs.loc[2, 'Deleted'] = True
+    deleted = replace_fingerprint_logs(added, logs.loc[[2]], windows.loc[[2]], deleted_logs.loc[[2]], windows.loc[[2]])
+    assert deleted == fingerprint_patient_logs(deleted_logs, windows, PATIENT_RECORD)
+
+
+def test_hash_of_no_logs_is_zero(patient_logs):
+    logs, windows = patient_logs
+    assert hash_patient_logs(logs.iloc[:0], windows.iloc[:0]) == 0
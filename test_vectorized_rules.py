@@ -0,0 +1,141 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from build_ontology import (PatientRecord, SymptomRecord, load_ontology, determine_hemoglobin_state,
+                            determine_hematological_state, determine_systemic_toxicity, determine_treatment)
+from vectorized_rules import *
+
+# Grids of all the rule boundaries, with missing and unknown values
+GENDERS = ['Male', 'Female', 'Unknown', None]
+HEMOGLOBIN_LEVELS = [np.nan, 0, 7.9, 8, 8.5, 9, 9.9, 10, 10.5, 11, 11.9, 12, 12.5, 13, 13.9, 14, 15, 16, 20]
+WBC_LEVELS = [np.nan, 0, 3999, 4000, 7000, 9999, 10000, 20000]
+FEVERS = [np.nan, 35, 38.4, 38.5, 39.9, 40, 42]
+CHILLS_VALUES = [None, 'Rigor', 'Shaking', 'Mild']
+SKIN_LOOKS = [None, 'Exfoliation', 'Desquamation', 'Vesiculation', 'Erythema']
+ALLERGIC_STATES = [None, 'Anaphylactic Shock', 'Severe Bronchospasm', 'Bronchospasm', 'Edema']
+
+
+@pytest.fixture(scope='module')
+def onto():
+    return load_ontology()
+
+
+def _scalar_code(rule, record, onto, states):
+    """
+    Runs a scalar rule, and returns the code of its result
+    """
+    try:
+        state = rule(record, onto)
+    except ValueError:
+        return NOT_DETERMINABLE
+    return NOT_DETERMINABLE if state is None else states.index(state.name)
+
+
+def _patient(gender=None, hemoglobin_level=np.nan, wbc_level=np.nan):
+    patient = PatientRecord()
+    patient.gender = [gender] if gender is not None else []
+    patient.hemoglobin_level = [hemoglobin_level] if not np.isnan(hemoglobin_level) else []
+    patient.wbc_level = [wbc_level] if not np.isnan(wbc_level) else []
+    return patient
+
+
+def _symptom_patient(fever, chills, skin_look, allergic_state):
+    symptom = SymptomRecord()
+    for attr, value in zip(SymptomRecord.__slots__, [fever, chills, skin_look, allergic_state]):
+        setattr(symptom, attr, [] if pd.isna(value) else [value])
+    patient = PatientRecord()
+    if symptom.fever or symptom.chills or symptom.skin_look or symptom.allergic_state:
+        patient.has_symptom = [symptom]
+    return patient
+
+
+def test_hemoglobin_and_hematological_states_match_scalar_rules(onto):
+    grid = list(itertools.product(GENDERS, HEMOGLOBIN_LEVELS, WBC_LEVELS))
+    gender, hemoglobin_level, wbc_level = (np.array(column, dtype=object) for column in zip(*grid))
+    hemoglobin_codes = classify_hemoglobin_state(gender, hemoglobin_level.astype(float))
+    hematological_codes = classify_hematological_state(gender, hemoglobin_level.astype(float), wbc_level.astype(float))
+    for i, (g, hemoglobin, wbc) in enumerate(grid):
+        patient = _patient(g, hemoglobin, wbc)
+        assert hemoglobin_codes[i] == _scalar_code(determine_hemoglobin_state, patient, onto,
+                                                   HEMOGLOBIN_STATES), grid[i]
+        assert hematological_codes[i] == _scalar_code(determine_hematological_state, patient, onto,
+                                                      HEMATOLOGICAL_STATES), grid[i]
+
+
+def test_systemic_toxicity_matches_scalar_rule(onto):
+    grid = list(itertools.product(FEVERS, CHILLS_VALUES, SKIN_LOOKS, ALLERGIC_STATES))
+    fever, chills, skin_look, allergic_state = (np.array(column, dtype=object) for column in zip(*grid))
+    toxicity_codes = classify_systemic_toxicity(fever.astype(float), chills, skin_look, allergic_state)
+    for i, values in enumerate(grid):
+        assert toxicity_codes[i] == _scalar_code(determine_systemic_toxicity, _symptom_patient(*values), onto,
+                                                 SYSTEMIC_TOXICITY_GRADES), values
+
+
+def test_treatment_matches_scalar_rule(onto):
+    grid = list(itertools.product(GENDERS,
+                                  range(NOT_DETERMINABLE, len(HEMOGLOBIN_STATES)),
+                                  range(NOT_DETERMINABLE, len(HEMATOLOGICAL_STATES)),
+                                  range(NOT_DETERMINABLE, len(SYSTEMIC_TOXICITY_GRADES))))
+    gender, hemoglobin_state, hematological_state, systemic_toxicity = (np.array(column, dtype=object)
+                                                                        for column in zip(*grid))
+    treatment_codes = classify_treatment(gender, hemoglobin_state.astype(int), hematological_state.astype(int),
+                                         systemic_toxicity.astype(int))
+    for i, (g, hemoglobin, hematological, toxicity) in enumerate(grid):
+        patient = _patient(g)
+        patient.has_hemoglobin_state = [onto[HEMOGLOBIN_STATES[hemoglobin]]] if hemoglobin >= 0 else []
+        patient.has_hematological_state = [onto[HEMATOLOGICAL_STATES[hematological]]] if hematological >= 0 else []
+        patient.has_systemic_toxicity = [onto[SYSTEMIC_TOXICITY_GRADES[toxicity]]] if toxicity >= 0 else []
+        assert treatment_codes[i] == _scalar_code(determine_treatment, patient, onto, TREATMENTS), grid[i]
+
+
+@pytest.mark.parametrize('gender, hemoglobin_level, expected', [
+    ('Male', 8.99, 'Severe_Anemia'), ('Male', 9, 'Moderate_Anemia'), ('Male', 11, 'Mild_Anemia'),
+    ('Male', 13, 'Normal_Hemoglobin'), ('Male', 15.99, 'Normal_Hemoglobin'), ('Male', 16, 'Polycythemia'),
+    ('Female', 7.99, 'Severe_Anemia'), ('Female', 8, 'Moderate_Anemia'), ('Female', 10, 'Mild_Anemia'),
+    ('Female', 12, 'Normal_Hemoglobin'), ('Female', 14, 'Polycythemia')])
+def test_hemoglobin_state_boundaries(gender, hemoglobin_level, expected):
+    codes = classify_hemoglobin_state([gender], [hemoglobin_level])
+    assert list(state_names(codes, HEMOGLOBIN_STATES)) == [expected]
+
+
+@pytest.mark.parametrize('gender, hemoglobin_level, wbc_level, expected', [
+    ('Male', 12.9, 3999, 'Pancytopenia'), ('Male', 12.9, 4000, 'Anemia'), ('Male', 12.9, 10000, 'Suspected_Leukemia'),
+    ('Male', 13, 9999, 'Normal_Hematological'), ('Male', 16, 7000, 'Polyhemia'),
+    ('Female', 12, 3999, 'Leukopenia'), ('Female', 13.9, 10000, 'Leukemoid_Reaction'),
+    ('Female', 14, 10000, 'Suspected_Polycythemia_Vera')])
+def test_hematological_state_boundaries(gender, hemoglobin_level, wbc_level, expected):
+    codes = classify_hematological_state([gender], [hemoglobin_level], [wbc_level])
+    assert list(state_names(codes, HEMATOLOGICAL_STATES)) == [expected]
+
+
+@pytest.mark.parametrize('fever, chills, skin_look, allergic_state, expected', [
+    (38.49, None, None, None, 'Grade_I'), (38.5, None, None, None, 'Grade_II'), (40, None, None, None, 'Grade_III'),
+    (np.nan, 'Mild', None, None, 'Grade_I'), (np.nan, 'Rigor', None, None, 'Grade_III'),
+    (37, 'Shaking', 'Exfoliation', None, 'Grade_IV'), (np.nan, None, None, 'Severe Bronchospasm', 'Grade_III')])
+def test_systemic_toxicity_boundaries(fever, chills, skin_look, allergic_state, expected):
+    codes = classify_systemic_toxicity([fever], [chills], [skin_look], [allergic_state])
+    assert list(state_names(codes, SYSTEMIC_TOXICITY_GRADES)) == [expected]
+
+
+def test_missing_inputs_are_not_determinable():
+    states = classify_states(gender=['Male', 'Unknown', 'Female'],
+                             hemoglobin_level=[np.nan, 12, 12],
+                             wbc_level=[5000, 5000, np.nan],
+                             fever=[np.nan] * 3, chills=[None] * 3, skin_look=[None] * 3, allergic_state=[None] * 3)
+    assert list(states['Hemoglobin State']) == [NOT_DETERMINABLE, NOT_DETERMINABLE,
+                                                HEMOGLOBIN_STATES.index('Normal_Hemoglobin')]
+    assert list(states['Hematological State']) == [NOT_DETERMINABLE] * 3
+    assert list(states['Systemic Toxicity']) == [NOT_DETERMINABLE] * 3
+    assert list(states['Treatment']) == [NOT_DETERMINABLE] * 3
+    assert list(state_names(states['Treatment'], TREATMENTS)) == [None] * 3
+
+
+def test_unmatched_combination_has_no_treatment():
+    treatment = classify_treatment(['Male', 'Female'],
+                                   [HEMOGLOBIN_STATES.index('Severe_Anemia')] * 2,
+                                   [HEMATOLOGICAL_STATES.index('Pancytopenia'), HEMATOLOGICAL_STATES.index('Anemia')],
+                                   [SYSTEMIC_TOXICITY_GRADES.index('Grade_I')] * 2)
+    assert list(state_names(treatment, TREATMENTS)) == ['M_I Measure_BP_once_a_week', None]
@@ -0,0 +1,159 @@
+import numpy as np
+import pandas as pd
+
+from build_ontology import *
+
+# Code returned for an element whose state can not be determined (missing inputs or no matching rule)
+NOT_DETERMINABLE = -1
+
+# The state codes are the positions of the states in these tuples, of the names of the states individuals
+HEMOGLOBIN_STATES = tuple(HEMOGLOBIN_STATE_INDIVIDUALS.values())
+HEMATOLOGICAL_STATES = tuple(HEMATOLOGICAL_STATE_INDIVIDUALS.values())
+SYSTEMIC_TOXICITY_GRADES = tuple(SYSTEMIC_TOXICITY_INDIVIDUALS.values())
+TREATMENTS = tuple(TREATMENT_INDIVIDUALS.values())
+
+# Upper limits of the hemoglobin levels of each hemoglobin state (the last state is open ended)
+HEMOGLOBIN_BINS = {'Male': [9, 11, 13, 16], 'Female': [8, 10, 12, 14]}
+# Hemoglobin and WBC levels splitting the hematological states table
+HEMATOLOGICAL_HEMOGLOBIN_BINS = {'Male': [13, 16], 'Female': [12, 14]}
+WBC_BINS = [4000, 10000]
+HEMATOLOGICAL_TABLE = np.array([
+    [HEMATOLOGICAL_STATES.index('Pancytopenia'), HEMATOLOGICAL_STATES.index('Anemia'),
+     HEMATOLOGICAL_STATES.index('Suspected_Leukemia')],
+    [HEMATOLOGICAL_STATES.index('Leukopenia'), HEMATOLOGICAL_STATES.index('Normal_Hematological'),
+     HEMATOLOGICAL_STATES.index('Leukemoid_Reaction')],
+    [HEMATOLOGICAL_STATES.index('Suspected_Polycythemia_Vera'), HEMATOLOGICAL_STATES.index('Polyhemia'),
+     HEMATOLOGICAL_STATES.index('Suspected_Polycythemia_Vera')]])
+
+# Grades of the symptoms, values not listed get Grade I
+FEVER_BINS = [38.5, 40.0]
+CHILLS_GRADES = {'Shaking': 1, 'Rigor': 2}
+SKIN_LOOK_GRADES = {'Vesiculation': 1, 'Desquamation': 2, 'Exfoliation': 3}
+ALLERGIC_STATE_GRADES = {'Bronchospasm': 1, 'Severe Bronchospasm': 2, 'Anaphylactic Shock': 3}
+
+# (hemoglobin state, hematological state, systemic toxicity) combinations of the treatments, per gender
+TREATMENT_RULES = [('Severe_Anemia', 'Pancytopenia', 'Grade_I'),
+                   ('Moderate_Anemia', 'Anemia', 'Grade_II'),
+                   ('Mild_Anemia', 'Suspected_Leukemia', 'Grade_III'),
+                   ('Normal_Hemoglobin', 'Leukemoid_Reaction', 'Grade_IV'),
+                   ('Polycythemia', 'Suspected_Polycythemia_Vera', 'Grade_IV')]
+GENDER_TREATMENTS = {'Male': TREATMENTS[:5], 'Female': TREATMENTS[5:]}
+
+
+def _digitize_by_gender(gender, levels, bins_by_gender):
+    """
+    Returns the bin of each level, using the bins of its gender. Unknown genders and missing levels get -1
+    """
+    codes = np.full(len(levels), NOT_DETERMINABLE, dtype=np.int8)
+    measured = ~np.isnan(levels)
+    for gender_name, bins in bins_by_gender.items():
+        rows = (gender == gender_name) & measured
+        codes[rows] = np.digitize(levels[rows], bins)
+    return codes
+
+
+def _categorical_grades(values, grades):
+    """
+    Returns the grade of each categorical symptom value, -1 for missing values
+    """
+    values = np.asarray(values, dtype=object)
+    codes = np.select([values == name for name in grades], list(grades.values()), default=0).astype(np.int8)
+    codes[pd.isna(values)] = NOT_DETERMINABLE
+    return codes
+
+
+def classify_hemoglobin_state(gender, hemoglobin_level):
+    """
+    Array version of determine_hemoglobin_state
+    :param gender: array of 'Male' / 'Female'
+    :param hemoglobin_level: array of hemoglobin levels, NaN where not measured
+    :return: int8 array of HEMOGLOBIN_STATES codes, NOT_DETERMINABLE where inputs are missing
+    """
+    gender = np.asarray(gender, dtype=object)
+    hemoglobin_level = np.asarray(hemoglobin_level, dtype=float)
+    return _digitize_by_gender(gender, hemoglobin_level, HEMOGLOBIN_BINS)
+
+
+def classify_hematological_state(gender, hemoglobin_level, wbc_level):
+    """
+    Array version of determine_hematological_state
+    :param gender: array of 'Male' / 'Female'
+    :param hemoglobin_level: array of hemoglobin levels, NaN where not measured
+    :param wbc_level: array of WBC levels, NaN where not measured
+    :return: int8 array of HEMATOLOGICAL_STATES codes, NOT_DETERMINABLE where inputs are missing
+    """
+    gender = np.asarray(gender, dtype=object)
+    hemoglobin_level = np.asarray(hemoglobin_level, dtype=float)
+    wbc_level = np.asarray(wbc_level, dtype=float)
+    hemoglobin_bin = _digitize_by_gender(gender, hemoglobin_level, HEMATOLOGICAL_HEMOGLOBIN_BINS)
+    wbc_bin = np.digitize(wbc_level, WBC_BINS)
+    determinable = (hemoglobin_bin != NOT_DETERMINABLE) & ~np.isnan(wbc_level)
+    return np.where(determinable, HEMATOLOGICAL_TABLE[hemoglobin_bin * determinable, wbc_bin * determinable],
+                    NOT_DETERMINABLE).astype(np.int8)
+
+
+def classify_systemic_toxicity(fever, chills, skin_look, allergic_state):
+    """
+    Array version of determine_systemic_toxicity - the grade is the highest grade of the measured symptoms
+    :param fever: array of body temperatures, NaN where not measured
+    :param chills: array of chills descriptions, None / NaN where not measured
+    :param skin_look: array of skin look descriptions, None / NaN where not measured
+    :param allergic_state: array of allergic state descriptions, None / NaN where not measured
+    :return: int8 array of SYSTEMIC_TOXICITY_GRADES codes, NOT_DETERMINABLE where no symptom was measured
+    """
+    fever = np.asarray(fever, dtype=float)
+    fever_grade = np.where(np.isnan(fever), NOT_DETERMINABLE, np.digitize(fever, FEVER_BINS)).astype(np.int8)
+    return np.maximum.reduce([fever_grade,
+                              _categorical_grades(chills, CHILLS_GRADES),
+                              _categorical_grades(skin_look, SKIN_LOOK_GRADES),
+                              _categorical_grades(allergic_state, ALLERGIC_STATE_GRADES)])
+
+
+def classify_treatment(gender, hemoglobin_state, hematological_state, systemic_toxicity):
+    """
+    Array version of determine_treatment
+    :param gender: array of 'Male' / 'Female'
+    :param hemoglobin_state: array of HEMOGLOBIN_STATES codes
+    :param hematological_state: array of HEMATOLOGICAL_STATES codes
+    :param systemic_toxicity: array of SYSTEMIC_TOXICITY_GRADES codes
+    :return: int8 array of TREATMENTS codes, NOT_DETERMINABLE where no treatment matches
+    """
+    gender = np.asarray(gender, dtype=object)
+    hemoglobin_state = np.asarray(hemoglobin_state)
+    hematological_state = np.asarray(hematological_state)
+    systemic_toxicity = np.asarray(systemic_toxicity)
+
+    conditions, choices = [], []
+    for gender_name, treatments in GENDER_TREATMENTS.items():
+        for (hemoglobin, hematological, toxicity), treatment in zip(TREATMENT_RULES, treatments):
+            conditions.append((gender == gender_name) &
+                              (hemoglobin_state == HEMOGLOBIN_STATES.index(hemoglobin)) &
+                              (hematological_state == HEMATOLOGICAL_STATES.index(hematological)) &
+                              (systemic_toxicity == SYSTEMIC_TOXICITY_GRADES.index(toxicity)))
+            choices.append(TREATMENTS.index(treatment))
+    return np.select(conditions, choices, default=NOT_DETERMINABLE).astype(np.int8)
+
+
+def classify_states(gender, hemoglobin_level, wbc_level, fever, chills, skin_look, allergic_state):
+    """
+    Classifies all the states at once
+    :return: dictionary of state codes arrays, keyed like the states of DSSEngine.infer_patients_states_for_timepoint
+    """
+    hemoglobin_state = classify_hemoglobin_state(gender, hemoglobin_level)
+    hematological_state = classify_hematological_state(gender, hemoglobin_level, wbc_level)
+    systemic_toxicity = classify_systemic_toxicity(fever, chills, skin_look, allergic_state)
+    return {'Hemoglobin State': hemoglobin_state,
+            'Hematological State': hematological_state,
+            'Systemic Toxicity': systemic_toxicity,
+            'Treatment': classify_treatment(gender, hemoglobin_state, hematological_state, systemic_toxicity)}
+
+
+def state_names(codes, states):
+    """
+    Translates state codes back to the names of the states in the ontology
+    :param codes: array of state codes
+    :param states: tuple of the states the codes refer to, e.g. HEMOGLOBIN_STATES
+    :return: object array of state names, None where the state is not determinable
+    """
+    names = np.array(list(states) + [None], dtype=object)
+    return names[np.asarray(codes)]  # NOT_DETERMINABLE (-1) picks the trailing None